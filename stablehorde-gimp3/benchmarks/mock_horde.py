@@ -0,0 +1,247 @@
+# Local stand in of the AI Horde for the benchmarks of the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, NamedTuple
+from urllib.parse import urlsplit, urlunsplit
+
+from sdhorde.encoding import encode_png
+
+API_PREFIX = "/api/v2/"
+
+
+class MockSettings(NamedTuple):
+    """
+    How the local Horde behaves
+    """
+
+    queue_delay: float = 2.0
+    """
+    Seconds a request waits for a worker
+    """
+    processing_delay: float = 1.0
+    """
+    Seconds a worker takes to generate the images
+    """
+    image_width: int = 512
+    image_height: int = 512
+    noise: int = 4
+    """
+    Random bits per channel of the served images, more bits compress
+    worse and make bigger downloads
+    """
+    failure_rate: float = 0.0
+    """
+    Fraction of the API requests answered with 503
+    """
+    seed: int = 0
+
+
+class Counter:
+    """
+    Requests, bytes and connections seen by the server, by kind
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.received: Dict[str, int] = {}
+        self.sent: Dict[str, int] = {}
+        self.failures = 0
+        self.connections = 0
+
+    def add(self, kind: str, received: int, sent: int) -> None:
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.received[kind] = self.received.get(kind, 0) + received
+            self.sent[kind] = self.sent.get(kind, 0) + sent
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "bytes_received": dict(self.received),
+                "bytes_sent": dict(self.sent),
+                "failures": self.failures,
+                "connections": self.connections,
+            }
+
+
+class MockHorde(ThreadingHTTPServer):
+    """
+    Answers generate/async, generate/check, generate/status and the
+    image urls it hands out, following settings
+    """
+
+    daemon_threads = True
+
+    def __init__(self, settings: MockSettings, port: int = 0):
+        super().__init__(("127.0.0.1", port), MockHordeHandler)
+        self.settings = settings
+        self.counter = Counter()
+        self.jobs: Dict[str, Dict] = {}
+        self.random = random.Random(settings.seed)
+        self._lock = threading.Lock()
+        self.image = self._make_image()
+
+    @property
+    def root(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def _make_image(self) -> bytes:
+        width, height = self.settings.image_width, self.settings.image_height
+        mask = (1 << self.settings.noise) - 1
+        table = bytes(value & mask for value in range(256))
+        noise = self.random.randbytes(width * height * 3).translate(table)
+        return encode_png(noise, width, height, 3)
+
+    def fails(self) -> bool:
+        with self._lock:
+            failed = self.random.random() < self.settings.failure_rate
+            if failed:
+                self.counter.failures += 1
+            return failed
+
+    def add_job(self, payload: Dict) -> str:
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            self.jobs[job_id] = {
+                "submitted": time.monotonic(),
+                "count": payload.get("params", {}).get("n", 1),
+                "seed": payload.get("params", {}).get("seed", "0"),
+                "model": (payload.get("models") or ["stable_diffusion"])[0],
+            }
+        return job_id
+
+    def state(self, job_id: str) -> Dict:
+        job = self.jobs[job_id]
+        elapsed = time.monotonic() - job["submitted"]
+        queued = self.settings.queue_delay - elapsed
+        total = self.settings.queue_delay + self.settings.processing_delay
+        done = elapsed >= total
+        return {
+            "finished": job["count"] if done else 0,
+            "processing": job["count"] if queued <= 0 and not done else 0,
+            "waiting": job["count"] if queued > 0 else 0,
+            "restarted": 0,
+            "done": done,
+            "faulted": False,
+            "is_possible": True,
+            "wait_time": max(0, int(total - elapsed)),
+            "queue_position": 1 if queued > 0 else 0,
+            "kudos": 10.0 * job["count"],
+        }
+
+
+class MockHordeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockHorde
+
+    def setup(self):
+        super().setup()
+        with self.server._lock:
+            self.server.counter.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, kind: str, status: int, body: bytes, received: int, ctype: str):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.counter.add(kind, received, len(body))
+
+    def reply_json(self, kind: str, data, received: int, status: int = 200):
+        body = json.dumps(data).encode("utf-8")
+        self.reply(kind, status, body, received, "application/json")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path != API_PREFIX + "generate/async":
+            return self.reply_json("other", {"message": "Not found"}, length, 404)
+        if self.server.fails():
+            return self.reply_json("submit", {"message": "Busy"}, length, 503)
+        job_id = self.server.add_job(json.loads(body))
+        self.reply_json("submit", {"id": job_id, "kudos": 10}, length, 202)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        for kind in ("check", "status"):
+            prefix = f"{API_PREFIX}generate/{kind}/"
+            if path.startswith(prefix):
+                return self.job_reply(kind, path[len(prefix) :])
+        if path.startswith("/images/"):
+            return self.reply("download", 200, self.server.image, 0, "image/png")
+        if path.startswith(API_PREFIX + "status/models"):
+            models = [{"name": "stable_diffusion", "count": 1, "type": "image"}]
+            return self.reply_json("models", models, 0)
+        self.reply_json("other", {"message": "Not found"}, 0, 404)
+
+    def job_reply(self, kind: str, job_id: str):
+        if job_id not in self.server.jobs:
+            return self.reply_json(kind, {"message": "Not found"}, 0, 404)
+        if self.server.fails():
+            return self.reply_json(kind, {"message": "Busy"}, 0, 503)
+        data = self.server.state(job_id)
+        if kind == "status":
+            job = self.server.jobs[job_id]
+            data["generations"] = (
+                [
+                    {
+                        "img": f"{self.server.root}/images/{job_id}-{i}.png",
+                        "seed": str(job["seed"]),
+                        "id": f"{job_id}-{i}",
+                        "censored": False,
+                        "model": job["model"],
+                        "worker_id": "mock",
+                        "worker_name": "mock",
+                    }
+                    for i in range(job["count"])
+                ]
+                if data["done"]
+                else []
+            )
+        self.reply_json(kind, data, 0)
+
+
+class RedirectHandler(urllib.request.BaseHandler):
+    """
+    Sends every http and https request to the mock server, so that the
+    code measured keeps using the real Horde urls
+    """
+
+    handler_order = 100
+
+    def __init__(self, root: str):
+        self.root = urlsplit(root)
+
+    def redirect(self, request):
+        parts = urlsplit(request.full_url)
+        request.full_url = urlunsplit(
+            (self.root.scheme, self.root.netloc, parts.path, parts.query, "")
+        )
+        return request
+
+    http_request = redirect
+    https_request = redirect
+
+
+def start(settings: MockSettings) -> MockHorde:
+    """
+    Starts a mock Horde in a background thread
+    """
+    server = MockHorde(settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
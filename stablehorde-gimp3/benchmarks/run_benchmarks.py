@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+#
+# End to end benchmarks of the AiHorde Gimp3 plugin against a local stand
+# in of the AI Horde, nothing is sent to the real Horde.
+#
+#   benchmarks/run_benchmarks.py [--scenario NAME] [--iterations N]
+#                                [--client aihordeclient|sdhorde]
+#                                [--output FILE] [--compare FILE]
+#
+# Each scenario sets how the local Horde behaves: queue and generation
+# delays, size of the images and how often it fails.  Each iteration
+# generates the images of the scenario and the time of each phase is
+# measured: encode of the source image, submit, queue, generate and
+# download.  By default the images are generated with AiHordeClient, the
+# client the plugin uses, and the phases are the ones the plugin records,
+# learnt from its requests.  With --client sdhorde they come instead from
+# HordeAPI of sdhorde.horde, a separate client the plugin does not
+# generate with, useful only to compare the two.  When a scenario sends
+# parallel requests, each phase adds the time spent by all of them.
+# Results are saved as JSON to compare versions.
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import argparse
+import base64
+import json
+import platform
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple
+
+HERE = Path(__file__).resolve().parent
+PLUGIN_DIR = HERE.parent
+sys.path[:0] = [
+    str(PLUGIN_DIR),
+    str(PLUGIN_DIR / "modules" / "aihordeclient" / "src"),
+]
+
+from mock_horde import MockHorde, MockSettings, RedirectHandler, start  # noqa: E402
+from sdhorde.dispatch import HordeDispatcher, HordeJob  # noqa: E402
+from sdhorde.download import Downloader  # noqa: E402
+from sdhorde.encoding import encode_png  # noqa: E402
+from sdhorde.horde import HordeAPI, build_payload  # noqa: E402
+from sdhorde.metrics import JobMetrics, MetricsSink  # noqa: E402
+from sdhorde.session import KeepAliveHandler, install_session  # noqa: E402
+
+PHASES = ["encode", "submit", "queue", "generate", "status", "download", "total"]
+"""
+Phases reported, each client measures some of them
+"""
+
+CLIENT_NOTES = {
+    "aihordeclient": "phases of AiHordeClient, the client of the plugin",
+    "sdhorde": "phases of sdhorde.horde.HordeAPI, "
+    "not the client the plugin generates with",
+}
+
+
+class Scenario(NamedTuple):
+    settings: MockSettings
+    mode: str = "MODE_TEXT2IMG"
+    nimages: int = 1
+    parallel_jobs: int = 1
+
+
+SCENARIOS = {
+    "t2i-512": Scenario(MockSettings()),
+    "i2i-1024": Scenario(
+        MockSettings(queue_delay=3.0, image_width=1024, image_height=1024),
+        mode="MODE_IMG2IMG",
+        nimages=2,
+    ),
+    "parallel-4": Scenario(MockSettings(), nimages=4, parallel_jobs=4),
+    "big-downloads": Scenario(
+        MockSettings(queue_delay=1.0, image_width=1024, image_height=1024, noise=8),
+        nimages=4,
+        parallel_jobs=2,
+    ),
+    "flaky": Scenario(MockSettings(failure_rate=0.1), nimages=2),
+}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    Nearest rank percentile
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "count": len(values),
+    }
+
+
+def make_options(scenario: Scenario) -> Dict[str, Any]:
+    width = scenario.settings.image_width
+    height = scenario.settings.image_height
+    options = {
+        "model": "stable_diffusion",
+        "mode": scenario.mode,
+        "init_strength": 0.3,
+        "prompt_strength": 8,
+        "steps": 20,
+        "nsfw": False,
+        "censor_nsfw": False,
+        "api_key": "",
+        "max_wait_minutes": 5,
+        "seed": "",
+        "nimages": scenario.nimages,
+        "image_width": width,
+        "image_height": height,
+        "prompt": "a lighthouse on a cliff at dawn",
+        "source_image": "",
+    }
+    return options
+
+
+def source_pixels(width: int, height: int) -> bytes:
+    """
+    A gradient, standing for the pixels read from Gimp
+    """
+    row = bytes(x * 255 // max(1, width - 1) for x in range(width) for _ in range(3))
+    return b"".join(row for _ in range(height))
+
+
+def encode_source(options: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Sets the source image of the modes that send one, returns the
+    seconds it took
+    """
+    if options["mode"] == "MODE_TEXT2IMG":
+        return {}
+    start = time.perf_counter()
+    width, height = options["image_width"], options["image_height"]
+    pixels = source_pixels(width, height)
+    options["source_image"] = base64.b64encode(
+        encode_png(pixels, width, height, 3)
+    ).decode("ascii")
+    return {"encode": time.perf_counter() - start}
+
+
+def run_sdhorde(
+    options: Dict[str, Any],
+    scenario: Scenario,
+    server: MockHorde,
+    session: KeepAliveHandler,
+) -> Dict[str, float]:
+    """
+    One generation with HordeAPI, returns the seconds of each phase.  The
+    images of a request are downloaded at the same time, download adds
+    the time of each one.
+    """
+    timings = {phase: 0.0 for phase in ["submit", "queue", "status", "download"]}
+    lock = threading.Lock()
+
+    def add(phase: str, seconds: float) -> None:
+        with lock:
+            timings[phase] += seconds
+
+    start = time.perf_counter()
+    timings.update(encode_source(options))
+
+    def on_request(kind: str, seconds: float, sent: int, received: int) -> None:
+        # The checks are part of the queue phase
+        if kind != "check":
+            add(kind, seconds)
+
+    def run_job(job: HordeJob) -> List[str]:
+        api = HordeAPI(on_request=on_request)
+        job_id = api.submit(build_payload(job.options))
+        waiting = time.perf_counter()
+        api.wait(job_id, job.options["max_wait_minutes"] * 60)
+        add("queue", time.perf_counter() - waiting)
+        generations = api.generations(job_id)
+        downloader = Downloader(
+            on_request=on_request, extra_handlers=[RedirectHandler(server.root)]
+        )
+        with tempfile.TemporaryDirectory() as folder:
+            downloader.fetch_all(
+                [
+                    (generation["img"], Path(folder) / f"{generation['id']}.png")
+                    for generation in generations
+                ]
+            )
+        return [generation["id"] for generation in generations]
+
+    dispatcher = HordeDispatcher(run_job, scenario.parallel_jobs)
+    dispatcher.add_jobs(options, scenario.parallel_jobs)
+    dispatcher.run()
+    timings["total"] = time.perf_counter() - start
+    errors = dispatcher.errors()
+    if errors:
+        raise errors[0]
+    return timings
+
+
+def run_aihordeclient(
+    options: Dict[str, Any],
+    scenario: Scenario,
+    server: MockHorde,
+    session: KeepAliveHandler,
+) -> Dict[str, float]:
+    """
+    One generation with AiHordeClient, each request with its own client
+    as the plugin does.  The phases are the ones of the JobMetrics of the
+    requests, learnt listening to the session through MetricsSink.
+    """
+    from aihordeclient import AiHordeClient, InformerFrontend
+
+    class BenchmarkInformer(InformerFrontend):
+        def update_status(self, text, progress=0.0):
+            pass
+
+        def set_finished(self):
+            pass
+
+        def show_error(self, message, url="", title="", buttons=0):
+            if title != "warning":
+                raise Exception(message)
+
+        def show_message(self, message, url="", title="", buttons=0):
+            pass
+
+        def get_frontend_property(self, property_name):
+            return True
+
+        def set_frontend_property(self, property_name, value):
+            pass
+
+        def has_asked_for_update(self):
+            return True
+
+        def just_asked_for_update(self):
+            pass
+
+        def path_store_directory(self):
+            return None
+
+    def run_job(job: HordeJob) -> List[str]:
+        job.metrics = JobMetrics(job.index, job.options["model"])
+        with sink.bind(job.metrics):
+            client = AiHordeClient(
+                "benchmark", "", "", "", job.options, "Benchmark", BenchmarkInformer()
+            )
+            file_names = client.generate_image(job.options)
+        for file_name in file_names:
+            Path(file_name).unlink()
+        return file_names
+
+    start = time.perf_counter()
+    timings = {phase: 0.0 for phase in ["submit", "queue", "generate", "download"]}
+    timings.update(encode_source(options))
+    dispatcher = HordeDispatcher(run_job, scenario.parallel_jobs)
+    dispatcher.add_jobs(options, scenario.parallel_jobs)
+    with tempfile.TemporaryDirectory() as folder:
+        # The same binding of the requests to their job as the plugin
+        sink = MetricsSink(Path(folder))
+        session.listeners.append(sink.observe)
+        try:
+            dispatcher.run()
+        finally:
+            session.listeners.remove(sink.observe)
+    timings["total"] = time.perf_counter() - start
+    errors = dispatcher.errors()
+    if errors:
+        raise errors[0]
+    for job in dispatcher.jobs:
+        for phase, seconds in job.metrics.phases.items():
+            timings[phase] = timings.get(phase, 0.0) + seconds
+    return timings
+
+
+def run_scenario(name: str, scenario: Scenario, iterations: int, client: str):
+    server = start(scenario.settings)
+    session = install_session(extra_handlers=[RedirectHandler(server.root)])
+    runner = run_aihordeclient if client == "aihordeclient" else run_sdhorde
+    measured: Dict[str, List[float]] = {}
+    errors = 0
+    try:
+        for iteration in range(iterations):
+            try:
+                timings = runner(make_options(scenario), scenario, server, session)
+            except Exception as ex:
+                errors += 1
+                print(f"  {name} #{iteration + 1} failed: {ex}")
+                continue
+            for phase, seconds in timings.items():
+                measured.setdefault(phase, []).append(seconds)
+            print(f"  {name} #{iteration + 1}: {timings['total']:.2f}s")
+    finally:
+        server.shutdown()
+        server.server_close()
+        session.close_all()
+    counted = server.counter.snapshot()
+    generations = max(1, iterations - errors)
+    return {
+        "settings": scenario.settings._asdict(),
+        "mode": scenario.mode,
+        "nimages": scenario.nimages,
+        "parallel_jobs": scenario.parallel_jobs,
+        "iterations": iterations,
+        "errors": errors,
+        "phases": {phase: summary(values) for phase, values in measured.items()},
+        "polls_per_generation": counted["requests"].get("check", 0) / generations,
+        "bytes_sent": sum(counted["bytes_received"].values()),
+        "bytes_received": sum(counted["bytes_sent"].values()),
+        "server": counted,
+    }
+
+
+def plugin_version() -> str:
+    text = (PLUGIN_DIR / "gimp-stable-diffusion.py").read_text(encoding="utf-8")
+    found = re.search(r'^VERSION = "(.+)"', text, re.MULTILINE)
+    return found.group(1) if found else "unknown"
+
+
+def compare(results: Dict, previous: Dict) -> None:
+    print(f"\nChange against {previous.get('version')} {previous.get('date')}")
+    for name, scenario in results["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        now_p50 = scenario["phases"]["total"]["p50"]
+        before_p50 = before["phases"]["total"]["p50"]
+        change = (now_p50 - before_p50) / before_p50 * 100 if before_p50 else 0.0
+        print(
+            f"  {name:16} total p50 {before_p50:7.2f}s -> {now_p50:7.2f}s "
+            f"({change:+.1f}%), polls {before['polls_per_generation']:.1f} -> "
+            f"{scenario['polls_per_generation']:.1f}"
+        )
+
+
+def report(results: Dict) -> None:
+    print(f"\nClient {results['client']}, {CLIENT_NOTES[results['client']]}")
+    for name, scenario in results["scenarios"].items():
+        print(f"\n{name}: {scenario['errors']} errors")
+        for phase in PHASES:
+            values = scenario["phases"].get(phase)
+            if values is None or not values["count"]:
+                continue
+            print(
+                f"  {phase:9} p50 {values['p50']:7.3f}s  p90 {values['p90']:7.3f}s"
+                f"  p99 {values['p99']:7.3f}s"
+            )
+        print(
+            f"  polls per generation {scenario['polls_per_generation']:.1f}, "
+            f"sent {scenario['bytes_sent']} bytes, "
+            f"received {scenario['bytes_received']} bytes, "
+            f"{scenario['server']['connections']} connections"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks against a local Horde")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run, can be repeated, all by default",
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--client",
+        choices=sorted(CLIENT_NOTES),
+        default="aihordeclient",
+        help="Client that generates, only aihordeclient is the one of the plugin",
+    )
+    parser.add_argument("--output", type=Path, help="JSON file for the results")
+    parser.add_argument("--compare", type=Path, help="Previous JSON results")
+    arguments = parser.parse_args()
+
+    results = {
+        "version": plugin_version(),
+        "client": arguments.client,
+        "phases_from": CLIENT_NOTES[arguments.client],
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": {},
+    }
+    for name in arguments.scenario or list(SCENARIOS):
+        print(f"Running {name}")
+        results["scenarios"][name] = run_scenario(
+            name, SCENARIOS[name], arguments.iterations, arguments.client
+        )
+    report(results)
+
+    output = arguments.output or HERE / "results" / (
+        f"{results['version']}-{arguments.client}-"
+        f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"\nResults saved in {output}")
+    if arguments.compare:
+        compare(results, json.loads(arguments.compare.read_text(encoding="utf-8")))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,9 @@
 # MIT lICENSE
 # https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
 
+from __future__ import annotations
 
+import atexit
 import base64
 import getpass
 import gettext
@@ -18,53 +20,44 @@ import gi
 import logging
 import os
 import platform
+import random
 import sys
 import tempfile
+import threading
+import time
 
 from pathlib import Path
-from typing import Union
+from typing import Callable, Optional, Union
 
 gi.require_version("Gimp", "3.0")
 from gi.repository import Gimp  # noqa: E402
 
+# GIMP starts the plug-in also to query and create the procedures, GimpUi,
+# Gtk, Gegl and the network modules are imported only when they are used
 gi.require_version("GimpUi", "3.0")
-from gi.repository import GimpUi  # noqa: E402
-
 gi.require_version("Gegl", "0.4")
-from gi.repository import Gegl  # noqa: E402
 from gi.repository import Gio  # noqa: E402
 from gi.repository import GLib  # noqa: E402
 from gi.repository import GObject  # noqa: E402
-from gi.repository import Gtk  # noqa: E402
 
 import_message_error = None
 
-# Change the next line replacing False to True if you need to debug. Case matters
-DEBUG = True
-
 # Localization helpers
 GETTEXT_DOMAIN = "gimp-stable-diffusion"
 _ = gettext.gettext
 gettext.textdomain(GETTEXT_DOMAIN)
 
 logger = logging.getLogger(__name__)
-LOGGING_LEVEL = logging.ERROR
-script_path = os.path.realpath(__file__)
-if DEBUG:
-    LOGGING_LEVEL = logging.DEBUG
-else:
-    print(_("To enable debugging change DEBUG to True in") + "\n\n " + script_path)
-
 
 log_file = os.path.join(tempfile.gettempdir(), "gimp-stable-diffusion.log")
-logging.basicConfig(
-    filename=log_file,
-    level=LOGGING_LEVEL,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
 
 try:
     expected_dir = Path(Gimp.directory()) / "plug-ins" / "gimp-stable-diffusion"
+    from sdhorde.logs import LEVEL_VARIABLE, initial_level, setup_logging
+
+    # A thread writes the log, the records below the level chosen in the
+    # dialog are only written when an error happens
+    log_handler = setup_logging(Path(log_file), initial_level())
     submodule_path = expected_dir / "module"
     sys.path.append(str(submodule_path))
     from aihordeclient import (
@@ -84,6 +77,7 @@ try:
         HordeClientSettings,
         ProcedureInformation,
     )
+    from sdhorde.catalog import ModelCatalog
 except ModuleNotFoundError as ex:
     import_message_error = "Make sure the plug-in is installed in {} ".format(
         expected_dir
@@ -134,17 +128,34 @@ For example, make use of a prompt like:
   very inspirational, arthouse.
 """
 
-INIT_FILE = "init.png"
-GENERATED_FILE = "stablehorde-generated.png"
+HTTP_POOL_SIZE = 4
+"""
+Idle keep-alive connections kept per host while talking to the Horde
+"""
 
-init_file = r"{}".format(os.path.join(tempfile.gettempdir(), INIT_FILE))
-generated_file = r"{}".format(os.path.join(tempfile.gettempdir(), GENERATED_FILE))
+SETTINGS_LOCK = "settings.lock"
+"""
+File in the plug-in cache folder locked while the settings are read or
+written, several Gimp processes can run the plug-in at the same time
+"""
+
+UPLOAD_EXPORTERS = {
+    "webp-lossless": ("file-webp-export", ".webp", {"lossless": True}),
+    "webp": ("file-webp-export", ".webp", {"quality": 95.0}),
+    "jpeg": ("file-jpeg-export", ".jpg", {"quality": 0.95}),
+}
+"""
+Gimp export procedure, file suffix and settings of each upload format
+other than PNG
+"""
 
 
 class StableDiffusion(Gimp.PlugIn):
     plug_in_proc_t2i = "ikks-py3-stablehorde-t2i"
     plug_in_proc_i2i = "ikks-py3-stablehorde-i2i"
     plug_in_proc_inpaint = "ikks-py3-stablehorde-inpaint"
+    plug_in_proc_outpaint = "ikks-py3-stablehorde-outpaint"
+    plug_in_proc_batch = "ikks-py3-stablehorde-batch"
     plug_in_binary = "py3-stablehorde"
 
     def __init__(self, *args, **kwargs):
@@ -166,15 +177,28 @@ class StableDiffusion(Gimp.PlugIn):
             cache_key="inpainting",
             default_model="stable_diffusion_inpainting",
         )
+        self.out_paint = ProcedureInformation(
+            model_choices=INPAINT_MODELS,
+            action="MODE_INPAINTING",
+            cache_key="inpainting",
+            default_model="stable_diffusion_inpainting",
+        )
+
+        self.batch = ProcedureInformation(
+            model_choices=MODELS,
+            action="MODE_TEXT2IMG",
+            cache_key="models",
+            default_model="stable_diffusion",
+        )
 
         self.procedures = {
             self.plug_in_proc_t2i: self.t2i,
             self.plug_in_proc_i2i: self.i2i,
             self.plug_in_proc_inpaint: self.in_paint,
+            self.plug_in_proc_outpaint: self.out_paint,
+            self.plug_in_proc_batch: self.batch,
         }
         self.plug_in_procs = list(self.procedures.keys())
-        if DEBUG:
-            print(_("Your log is at ") + log_file)
         super().__init__(*args, **kwargs)
 
     def do_query_procedures(self) -> list[str]:
@@ -183,6 +207,8 @@ class StableDiffusion(Gimp.PlugIn):
         * TXT2IMG
         * IMG2IMG
         * INPAINT
+        * OUTPAINT
+        * TXT2IMG from a prompt list
         """
         return self.plug_in_procs
 
@@ -192,6 +218,8 @@ class StableDiffusion(Gimp.PlugIn):
         * TXT2IMG
         * IMG2IMG
         * INPAINT
+        * OUTPAINT
+        * TXT2IMG from a prompt list
 
         """
 
@@ -202,6 +230,7 @@ class StableDiffusion(Gimp.PlugIn):
             return locdir
 
         gettext.bindtextdomain(GETTEXT_DOMAIN, get_locale_dir())
+        from sdhorde.dispatch import MAX_JOBS_IN_FLIGHT
 
         procedure = None
         self.check_counter = 0
@@ -210,15 +239,21 @@ class StableDiffusion(Gimp.PlugIn):
         logging.debug(self.plug_in_procs)
         if name not in self.plug_in_procs:
             return procedure
-        global DEBUG
-        additional = ""
-        if DEBUG:
-            additional = "\n" + _("Log at: ") + log_file + "\n"
+        additional = "\n" + _("Log at: ") + log_file + "\n"
+
+        from sdhorde.cache import FileLock
 
         self.st_manager = HordeClientSettings(
             Path(Gimp.cache_directory()) / "ikks-py3-stablehorde"
         )
-        self.procedures[name].update_choices_from(self.st_manager.load())
+        with FileLock(
+            Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / SETTINGS_LOCK
+        ):
+            self.procedures[name].update_choices_from(self.st_manager.load())
+        self.catalog = ModelCatalog(
+            Path(Gimp.cache_directory()) / "ikks-py3-stablehorde"
+        )
+        self.use_catalog(self.procedures[name])
         # TRANSLATORS: This is the menu, the _ indicates the fast key in the menu
         self.t2i.menu_label = _("_Text to Image")
         # TRANSLATORS: Dialog title
@@ -240,10 +275,24 @@ class StableDiffusion(Gimp.PlugIn):
         self.in_paint.dialog_description = (
             _("Replace transparent portion of the image") + "\n" + additional
         )
+        # TRANSLATORS: This is the menu, the _ indicates the fast key in the menu
+        self.out_paint.menu_label = _("_Outpainting")
+        # TRANSLATORS: Dialog title
+        self.out_paint.dialog_title = _("Outpaint") + " - " + VERSION
+        self.out_paint.dialog_description = (
+            _("Extend the image, generating the new borders") + "\n" + additional
+        )
+        # TRANSLATORS: This is the menu, the _ indicates the fast key in the menu
+        self.batch.menu_label = _("Text to Images from a _List")
+        # TRANSLATORS: Dialog title
+        self.batch.dialog_title = _("TXT2IMG List") + " - " + VERSION
+        self.batch.dialog_description = (
+            _("Generate images for each prompt of a file") + "\n" + additional
+        )
         procedure = Gimp.ImageProcedure.new(
             self, name, Gimp.PDBProcType.PLUGIN, self.run, None
         )
-        if name == self.plug_in_proc_t2i:
+        if name in [self.plug_in_proc_t2i, self.plug_in_proc_batch]:
             procedure.set_sensitivity_mask(
                 Gimp.ProcedureSensitivityMask.DRAWABLE
                 | Gimp.ProcedureSensitivityMask.NO_DRAWABLES
@@ -346,6 +395,28 @@ class StableDiffusion(Gimp.PlugIn):
             GObject.ParamFlags.READWRITE,
         )
 
+        procedure.add_int_argument(
+            "parallel-jobs",
+            _("_Parallel requests"),
+            _(
+                "Split the images in this many requests sent at the same time. When many workers are free, all the images arrive sooner"
+            ),
+            1,
+            MAX_JOBS_IN_FLIGHT,
+            1,
+            GObject.ParamFlags.READWRITE,
+        )
+
+        procedure.add_boolean_argument(
+            "stream-results",
+            _("Show each image as it a_rrives"),
+            _(
+                "With parallel requests, ask each image on its own request and add it as soon as it is ready, the source image is sent with each one"
+            ),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+
         procedure.add_string_argument(
             "seed",
             _("S_eed (optional)"),
@@ -403,6 +474,216 @@ class StableDiffusion(Gimp.PlugIn):
             8,
             GObject.ParamFlags.READWRITE,
         )
+        procedure.add_boolean_argument(
+            "use-cache",
+            _("Reuse _cached images"),
+            _(
+                "When a seed is given, reuse the images generated before with the same request instead of asking the Horde again"
+            ),
+            True,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "region-only",
+            _("Only the _selection or transparent area"),
+            _(
+                "Send only the selection, or the transparent area when inpainting, with some context around it and blend the result back in place"
+            ),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "context-margin",
+            _("Conte_xt around the area"),
+            _(
+                "Pixels around the selection or the transparent area sent as context, half of them are used to blend the result"
+            ),
+            64,
+            512,
+            64,
+            GObject.ParamFlags.READWRITE,
+        )
+        for side, label in (
+            ("left", _("_Left")),
+            ("top", _("To_p")),
+            ("right", _("_Right")),
+            ("bottom", _("_Bottom")),
+        ):
+            procedure.add_int_argument(
+                f"extend-{side}",
+                label,
+                _("Pixels to add on this side of the image"),
+                0,
+                1024,
+                256 if side == "right" else 0,
+                GObject.ParamFlags.READWRITE,
+            )
+        procedure.add_boolean_argument(
+            "tiled",
+            _("_Tiles for big images"),
+            _(
+                "Images bigger than the Horde allows are split in overlapping tiles sent at the same time with the same seed, the results are blended in a single layer"
+            ),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "tile-overlap",
+            _("Tile o_verlap"),
+            _("Pixels shared by neighbour tiles, used to blend the seams"),
+            32,
+            512,
+            128,
+            GObject.ParamFlags.READWRITE,
+        )
+        upload_formats = Gimp.Choice.new()
+        for i, (nick, label) in enumerate(
+            [
+                ("png", _("PNG, lossless")),
+                ("webp-lossless", _("WebP, lossless and smaller")),
+                ("webp", _("WebP, high quality")),
+                ("jpeg", _("JPEG, high quality")),
+            ]
+        ):
+            upload_formats.add(nick, i, label, "")
+        procedure.add_choice_argument(
+            "upload-format",
+            _("Send the image _as"),
+            _(
+                "Format of the image sent to the Horde, the lossy ones are the smallest and the fastest to send. Inpainting never uses JPEG, it has no transparency"
+            ),
+            upload_formats,
+            "png",
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "downscale",
+            _("Send at the _generation size"),
+            _(
+                "The image, or the area sent, is resampled to the size generated before sending it when it has more than the generation megapixels, keeping its proportions. Big images are sent faster and fit the Horde"
+            ),
+            True,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_double_argument(
+            "generation-megapixels",
+            _("Generation _megapixels"),
+            _(
+                "Pixels generated when sending at the generation size, in millions. Fewer are faster and cost less kudos"
+            ),
+            0.25,
+            4.0,
+            4.0,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "upscale-result",
+            _("Scale the result to the _image size"),
+            _(
+                "The generated images are scaled to cover the image, otherwise they keep the generation size. A region is always covered"
+            ),
+            True,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "estimate-only",
+            _("Only _estimate the cost"),
+            _(
+                "Tell the kudos and the wait the request would take, without sending it"
+            ),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "check-cost",
+            _("_Check the cost before sending"),
+            _(
+                "Ask the Horde the kudos and the wait first, requests that would not finish in time are not sent. Always done with a daily limit of kudos"
+            ),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_int_argument(
+            "daily-kudos",
+            _("_Kudos per day"),
+            _(
+                "Kudos the plug-in can spend each day, counting all the Gimp windows. 0 is no limit"
+            ),
+            0,
+            1000000,
+            0,
+            GObject.ParamFlags.READWRITE,
+        )
+        over_budget = Gimp.Choice.new()
+        for i, (nick, label) in enumerate(
+            [
+                ("warn", _("Send it and warn")),
+                ("block", _("Do not send it")),
+                ("scale", _("Ask fewer images or steps")),
+            ]
+        ):
+            over_budget.add(nick, i, label, "")
+        procedure.add_choice_argument(
+            "over-budget",
+            _("_Over the budget"),
+            _(
+                "What to do when the request costs more than the kudos left for today. Requests that would take longer than the max wait are only sent when warning"
+            ),
+            over_budget,
+            "warn",
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_boolean_argument(
+            "trace",
+            _("Save a _timeline"),
+            _(
+                "Save where the time of the run went next to the log, it opens in chrome://tracing or ui.perfetto.dev"
+            ),
+            False,
+            GObject.ParamFlags.READWRITE,
+        )
+        log_levels = Gimp.Choice.new()
+        for i, (nick, label) in enumerate(
+            [
+                ("error", _("Errors")),
+                ("warning", _("Warnings")),
+                ("info", _("Information")),
+                ("debug", _("Everything")),
+            ]
+        ):
+            log_levels.add(nick, i, label, "")
+        procedure.add_choice_argument(
+            "log-level",
+            _("_Log"),
+            _(
+                "What is written to the log. The details below it are kept in memory and written only when an error happens"
+            ),
+            log_levels,
+            "warning",
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_file_argument(
+            "prompt-list",
+            _("Prompt _list"),
+            _(
+                "Text file with a prompt per line, or a JSON object per line that can also set model, seed, steps, width, height, nimages and cfg_scale"
+            ),
+            Gimp.FileChooserAction.OPEN,
+            True,
+            None,
+            GObject.ParamFlags.READWRITE,
+        )
+        procedure.add_file_argument(
+            "output-folder",
+            _("Output _folder (optional)"),
+            _(
+                "Folder to save the images and the report, when empty the images are added as layers of a new image"
+            ),
+            Gimp.FileChooserAction.SELECT_FOLDER,
+            True,
+            None,
+            GObject.ParamFlags.READWRITE,
+        )
         procedure.add_boolean_argument(
             "new-image",
             _("As_ a new image "),
@@ -412,12 +693,84 @@ class StableDiffusion(Gimp.PlugIn):
         )
         return procedure
 
+    def use_catalog(self, information: ProcedureInformation) -> None:
+        """
+        Offers the models from the catalog, when it has been fetched, the
+        client then does not need to ask for them while generating
+        """
+        choices = self.catalog.choices(information.cache_key)
+        if not choices:
+            return
+        if information.default_model in choices:
+            choices.remove(information.default_model)
+            choices.insert(0, information.default_model)
+        information.model_choices = choices
+        information.refreshed_date = self.catalog.refreshed_date(
+            information.cache_key
+        )
+
     def run(self, procedure, run_mode, image, drawables, config, data):
+        """
+        Runs the procedure, with the trace option its timeline is saved
+        next to the log
+        """
+        from sdhorde.trace import Tracer
+
+        self.tracer = Tracer()
+        try:
+            return self.run_procedure(
+                procedure, run_mode, image, drawables, config, data
+            )
+        finally:
+            if self.tracer.enabled:
+                trace_file = self.tracer.save(Path(log_file).parent)
+                if trace_file is not None:
+                    logging.info(f"Timeline saved in {trace_file}")
+
+    def run_procedure(self, procedure, run_mode, image, drawables, config, data):
+        from sdhorde.cache import FileLock, GenerationCache, request_key
+        from sdhorde.dispatch import HordeDispatcher
+        from sdhorde.estimate import (
+            BUDGET_FILE,
+            CostEstimator,
+            KudosBudget,
+            megapixelsteps,
+            scale_down,
+        )
+        from sdhorde.horde import HordeAPI
+        from sdhorde.inflight import InFlightRegistry
+        from sdhorde.journal import JobJournal, job_id_from
+        from sdhorde.metrics import JobMetrics, MetricsSink
+        from sdhorde.session import UploadSpeed, install_session
+        from sdhorde.workspace import Workspaces
+
         procedure_name = procedure.get_name()
+        session = install_session(HTTP_POOL_SIZE)
+        # Each request tells its phases, polls and bytes, kept to follow
+        # the latency of the Horde over time
+        self.metrics = None
+        try:
+            self.metrics = MetricsSink(
+                Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / "metrics"
+            )
+            session.listeners.append(self.metrics.observe)
+        except OSError as ex:
+            logging.debug(f"The metrics are not recorded: {ex}")
+        session.listeners.append(self.tracer.observe)
+        # Each request writes its images in a folder of its own, removed
+        # when the plug-in ends
+        self.workspaces = Workspaces()
+        atexit.register(self.workspaces.close)
+        upload_speed = UploadSpeed(
+            Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / "link.json"
+        )
+        # While the user fills the dialog
+        self.catalog.refresh_in_background()
         created_image = False
         if image is None and procedure_name in [
             self.plug_in_proc_i2i,
             self.plug_in_proc_inpaint,
+            self.plug_in_proc_outpaint,
         ]:
             return procedure.new_return_values(
                 Gimp.PDBStatusType.CALLING_ERROR,
@@ -438,6 +791,8 @@ class StableDiffusion(Gimp.PlugIn):
                 )
 
         if run_mode == Gimp.RunMode.INTERACTIVE:
+            from gi.repository import GimpUi, Gtk
+
             GimpUi.init(self.plug_in_binary)
 
             dialog = GimpUi.ProcedureDialog.new(
@@ -447,6 +802,7 @@ class StableDiffusion(Gimp.PlugIn):
             )
             dialog.get_widget("prompt-strength", GimpUi.SpinScale.__gtype__)
             dialog.get_widget("nimages", GimpUi.SpinScale.__gtype__)
+            dialog.get_widget("parallel-jobs", GimpUi.SpinScale.__gtype__)
             dialog.get_widget("init-strength", GimpUi.SpinScale.__gtype__)
             dialog.get_widget("steps", GimpUi.SpinScale.__gtype__)
             dialog.get_widget("max-wait-minutes", GimpUi.SpinScale.__gtype__)
@@ -462,10 +818,19 @@ class StableDiffusion(Gimp.PlugIn):
                 False,
             )
             controls_to_show = ["header-text", "prompt"]
-            if procedure_name == self.plug_in_proc_t2i:
+            if procedure_name == self.plug_in_proc_batch:
+                controls_to_show = ["header-text", "prompt-list", "output-folder"]
+            if procedure_name in [self.plug_in_proc_t2i, self.plug_in_proc_batch]:
                 box = dialog.fill_flowbox("size-box", ["width", "height"])
                 box.set_orientation(Gtk.Orientation.HORIZONTAL)
                 controls_to_show.extend(["size-box"])
+            if procedure_name == self.plug_in_proc_outpaint:
+                box = dialog.fill_flowbox(
+                    "extend-box",
+                    ["extend-left", "extend-top", "extend-right", "extend-bottom"],
+                )
+                box.set_orientation(Gtk.Orientation.HORIZONTAL)
+                controls_to_show.extend(["extend-box"])
             controls_to_show.extend(
                 [
                     "model",
@@ -475,7 +840,9 @@ class StableDiffusion(Gimp.PlugIn):
             if procedure_name == self.plug_in_proc_i2i:
                 controls_to_show.append("init-strength")
             if procedure_name in [self.plug_in_proc_i2i, self.plug_in_proc_inpaint]:
-                controls_to_show.append("nimages")
+                controls_to_show.extend(["nimages", "parallel-jobs", "stream-results"])
+            if procedure_name == self.plug_in_proc_batch:
+                controls_to_show.extend(["nimages", "parallel-jobs"])
 
             controls_to_show.extend(
                 [
@@ -484,9 +851,41 @@ class StableDiffusion(Gimp.PlugIn):
                     "censor-nsfw",
                     "max-wait-minutes",
                     "seed",
+                    "use-cache",
                     "api-key",
+                    "estimate-only",
+                    "check-cost",
+                    "daily-kudos",
+                    "over-budget",
+                    "trace",
+                    "log-level",
                 ]
             )
+            if procedure_name == self.plug_in_proc_batch:
+                for name in [
+                    "use-cache",
+                    "estimate-only",
+                    "check-cost",
+                    "daily-kudos",
+                    "over-budget",
+                ]:
+                    controls_to_show.remove(name)
+            if procedure_name in [self.plug_in_proc_i2i, self.plug_in_proc_inpaint]:
+                controls_to_show.extend(["region-only", "context-margin"])
+            if procedure_name == self.plug_in_proc_outpaint:
+                controls_to_show.append("context-margin")
+            if procedure_name == self.plug_in_proc_i2i:
+                controls_to_show.extend(["tiled", "tile-overlap"])
+            if procedure_name in [
+                self.plug_in_proc_i2i,
+                self.plug_in_proc_inpaint,
+                self.plug_in_proc_outpaint,
+            ]:
+                controls_to_show.append("upload-format")
+            if procedure_name in [self.plug_in_proc_i2i, self.plug_in_proc_inpaint]:
+                controls_to_show.extend(
+                    ["downscale", "generation-megapixels", "upscale-result"]
+                )
             if procedure_name == self.plug_in_proc_t2i and image:
                 controls_to_show.append("new-image")
 
@@ -494,9 +893,14 @@ class StableDiffusion(Gimp.PlugIn):
             if not dialog.run():
                 return procedure.new_return_values(Gimp.PDBStatusType.CANCEL, None)
             dialog.destroy()
-        global DEBUG
-        if DEBUG:
-            print(_("Your log is at ") + log_file)
+        if LEVEL_VARIABLE not in os.environ:
+            log_handler.use_level(config.get_property("log-level"))
+        if config.get_property("trace"):
+            self.tracer.start(procedure_name)
+        validation_start = time.perf_counter()
+
+        if procedure_name == self.plug_in_proc_batch:
+            return self.run_batch(procedure, config)
 
         prompt = config.get_property("prompt")
         if prompt == "":
@@ -505,9 +909,111 @@ class StableDiffusion(Gimp.PlugIn):
                 GLib.Error(_("Please enter a prompt.")),
             )
 
+        from sdhorde.encoding import png_level
+
         source_image = ""
+        export_seconds = 0.0
+        upload_format = config.get_property("upload-format")
+        if upload_format == "jpeg" and procedure_name in [
+            self.plug_in_proc_inpaint,
+            self.plug_in_proc_outpaint,
+        ]:
+            # The transparent area is what gets inpainted, JPEG has no alpha
+            upload_format = "webp-lossless"
+        compress_level = png_level(upload_speed.load())
+        region = None
+        pieces = None
+        """
+        Regions generated on their own and blended in a single layer, with
+        the feather of each side
+        """
+        extend = None
+        generation = None
+        """
+        Size the source is resampled to and generated at
+        """
+        placement = None
+        """
+        Where the images go, the region or the whole image when they are
+        scaled back to it
+        """
+        context_margin = config.get_property("context-margin")
+        tile_overlap = config.get_property("tile-overlap")
         if image is not None and not config.get_property("new-image"):
-            source_image = self.get_image_data(image)
+            if procedure_name in [
+                self.plug_in_proc_i2i,
+                self.plug_in_proc_inpaint,
+            ] and config.get_property("region-only"):
+                region = self.get_region_of_interest(
+                    image, procedure_name, context_margin
+                )
+            if procedure_name == self.plug_in_proc_outpaint:
+                from sdhorde.regions import SIDES
+
+                extend = {
+                    side: config.get_property(f"extend-{side}") for side in SIDES
+                }
+                pieces = self.extend_canvas(image, extend, context_margin)
+                if not pieces:
+                    return procedure.new_return_values(
+                        Gimp.PDBStatusType.CALLING_ERROR,
+                        GLib.Error(
+                            _("Choose how many pixels to add on each side")
+                            if pieces is not None
+                            else _("The image is too big to extend it")
+                        ),
+                    )
+            elif (
+                region is None
+                and procedure_name == self.plug_in_proc_i2i
+                and config.get_property("tiled")
+                and not self.fits_generation(image.get_width(), image.get_height())
+            ):
+                from sdhorde.regions import tile_feather, tile_regions
+
+                pieces = [
+                    (tile, tile_feather(tile, tile_overlap))
+                    for tile in tile_regions(
+                        image.get_width(),
+                        image.get_height(),
+                        MAX_WIDTH,
+                        MAX_HEIGHT,
+                        MAX_MP,
+                        tile_overlap,
+                    )
+                ]
+                logging.debug(f"Tiles {pieces}")
+            if (
+                not pieces
+                and procedure_name in [self.plug_in_proc_i2i, self.plug_in_proc_inpaint]
+                and config.get_property("downscale")
+            ):
+                from sdhorde.regions import Region, generation_size
+
+                sent = region or Region(0, 0, image.get_width(), image.get_height())
+                max_pixels = min(
+                    MAX_MP, int(config.get_property("generation-megapixels") * 2**20)
+                )
+                # Sources within the limits are sent as they are, resampling
+                # them would only lose detail
+                if (
+                    sent.width * sent.height > max_pixels
+                    or sent.width > MAX_WIDTH
+                    or sent.height > MAX_HEIGHT
+                ):
+                    generation = generation_size(
+                        sent.width, sent.height, max_pixels, MAX_WIDTH, MAX_HEIGHT
+                    )
+                    if region is None and config.get_property("upscale-result"):
+                        placement = sent
+                    logging.debug(f"Sending {sent} as {generation}")
+            if not pieces:
+                start = time.perf_counter()
+                source_image = self.get_image_data(
+                    image, region, upload_format, compress_level, generation
+                )
+                export_seconds = time.perf_counter() - start
+                self.tracer.add("get_image_data", start, format=upload_format)
         elif procedure_name == self.plug_in_proc_t2i:
             width = config.get_property("width")
             height = config.get_property("height")
@@ -561,8 +1067,22 @@ class StableDiffusion(Gimp.PlugIn):
         max_wait_minutes = config.get_property("max-wait-minutes")
         seed = config.get_property("seed")
         nimages = config.get_property("nimages")
+        parallel_jobs = config.get_property("parallel-jobs")
+        stream_results = config.get_property("stream-results")
         image_width = image.get_width()
         image_height = image.get_height()
+        if region is not None:
+            image_width, image_height = region.width, region.height
+            placement = region
+        if generation is not None:
+            image_width, image_height = generation
+        if pieces:
+            image_width = max(piece[0].width for piece in pieces)
+            image_height = max(piece[0].height for piece in pieces)
+            # A single image, all the pieces share the seed to look alike
+            nimages = 1
+            if not seed.strip():
+                seed = str(random.randrange(2**32))
         if (
             image_width < MIN_WIDTH
             or image_width > MAX_WIDTH
@@ -572,6 +1092,8 @@ class StableDiffusion(Gimp.PlugIn):
             if created_image:
                 image.delete()
                 Gimp.displays_flush()
+            elif extend:
+                self.restore_canvas(image, extend)
             return procedure.new_return_values(
                 Gimp.PDBStatusType.CALLING_ERROR,
                 GLib.Error(
@@ -584,6 +1106,8 @@ class StableDiffusion(Gimp.PlugIn):
             if created_image:
                 image.delete()
                 Gimp.displays_flush()
+            elif extend:
+                self.restore_canvas(image, extend)
             return procedure.new_return_values(
                 Gimp.PDBStatusType.CALLING_ERROR,
                 GLib.Error(
@@ -593,7 +1117,10 @@ class StableDiffusion(Gimp.PlugIn):
                 ),
             )
 
-        if mode == "MODE_INPAINTING" and drawables[0].has_alpha == 0:
+        if (
+            procedure_name == self.plug_in_proc_inpaint
+            and drawables[0].has_alpha == 0
+        ):
             return procedure.new_return_values(
                 Gimp.PDBStatusType.CALLING_ERROR,
                 GLib.Error(_("When inpainting, the image must have an alpha channel.")),
@@ -621,47 +1148,353 @@ class StableDiffusion(Gimp.PlugIn):
             "models": self.procedures[procedure_name].model_choices,
             "date_refreshed_models": self.procedures[procedure_name].refreshed_date,
         }
+        self.tracer.add("validation", validation_start)
+
+        # The requests of earlier runs are checked by a daemon thread, only
+        # while this run lasts, the ones left go on in the next run
+        journal = None
+        try:
+            journal = JobJournal(
+                Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / "journal"
+            )
+            self.place_resumed(journal)
+            journal.resume_in_background(
+                HordeAPI(client_agent=f"{HORDE_CLIENT_NAME}:{VERSION}:{URL_DOWNLOAD}")
+            )
+        except OSError as ex:
+            logging.debug(f"The journal is not available: {ex}")
+            journal = None
+
+        cache = None
+        cache_key = None
+        if config.get_property("use-cache") and not pieces:
+            try:
+                cache = GenerationCache(
+                    Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / "generations"
+                )
+                cache_key = cache.key_for(options)
+            except OSError as ex:
+                logging.debug(f"The cache is not available: {ex}")
+        estimate_only = config.get_property("estimate-only")
+        if cache_key is not None and not estimate_only:
+            cached = cache.get(cache_key)
+            logging.debug(f"Cache {cache_key} {cached is not None}, {cache.stats()}")
+            if cached is not None:
+                self.display_generated(
+                    image, cached["files"], model, placement, context_margin // 2
+                )
+                self.store_metadata(
+                    image, cached["model"], cached["prompt"], cached["description"]
+                )
+                if created_image:
+                    self.remove_background(image)
+                return procedure.new_return_values(
+                    Gimp.PDBStatusType.SUCCESS,
+                    GLib.Error(_("The images were taken from the local cache")),
+                )
+        # Requests that would not finish in time or go over the kudos of
+        # the day are stopped before spending anything
+        preflight_warning = ""
+        budget = None
+        kudos = 0.0
+        estimate = None
+        daily_kudos = config.get_property("daily-kudos")
+        # The estimate costs two requests, only made when asked for
+        check_cost = estimate_only or daily_kudos or config.get_property("check-cost")
+        if check_cost:
+            try:
+                estimator = CostEstimator(
+                    Path(Gimp.cache_directory()) / "ikks-py3-stablehorde",
+                    HordeAPI(
+                        api_key,
+                        client_agent=f"{HORDE_CLIENT_NAME}:{VERSION}:{URL_DOWNLOAD}",
+                    ),
+                )
+                budget = KudosBudget(
+                    daily_kudos,
+                    Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / BUDGET_FILE,
+                )
+                Gimp.progress_init(_("Estimating the cost"))
+                estimate = estimator.estimate(options)
+                Gimp.progress_end()
+            except OSError as ex:
+                logging.debug(f"The cost can not be estimated: {ex}")
+        if estimate is not None:
+            requests = len(pieces) if pieces else 1
+            kudos = estimate.kudos * requests
+            logging.debug(f"Estimated {estimate} for {requests} requests")
+            summary = _("About {} kudos").format(round(kudos))
+            if estimate.wait is not None and estimate.workers:
+                summary += ", " + _("ready in about {} minutes").format(
+                    max(1, round(estimate.wait / 60))
+                )
+            over_budget = config.get_property("over-budget")
+            error = None
+            if estimate_only:
+                error = summary
+            elif estimate.workers == 0:
+                error = _("No worker is serving {} now, try another model").format(
+                    model
+                )
+            elif estimate.wait is not None and estimate.wait > max_wait_minutes * 60:
+                too_long = (
+                    summary + ", " + _("more than the max wait of {} minutes")
+                ).format(max_wait_minutes)
+                if over_budget == "warn":
+                    preflight_warning += "\n " + too_long
+                else:
+                    error = too_long
+            remaining = budget.remaining()
+            if error is None and remaining is not None and kudos > remaining:
+                over = _("{} kudos left for today").format(round(remaining))
+                scaled = None
+                if over_budget == "scale":
+                    scaled = scale_down(options, estimate.kudos, remaining / requests)
+                if over_budget == "warn":
+                    preflight_warning += "\n " + summary + ", " + over
+                elif scaled is None:
+                    error = summary + ", " + over
+                else:
+                    kudos *= megapixelsteps(scaled) / megapixelsteps(options)
+                    preflight_warning += "\n " + _(
+                        "Scaled down to {} images of {} steps, {} kudos left for today"
+                    ).format(scaled["nimages"], scaled["steps"], round(remaining))
+                    options = scaled
+                    nimages = options["nimages"]
+                    if cache is not None:
+                        cache_key = cache.key_for(options)
+            if error is not None:
+                if created_image:
+                    image.delete()
+                    Gimp.displays_flush()
+                elif extend:
+                    self.restore_canvas(image, extend)
+                return procedure.new_return_values(
+                    Gimp.PDBStatusType.SUCCESS
+                    if estimate_only
+                    else Gimp.PDBStatusType.CALLING_ERROR,
+                    GLib.Error(error),
+                )
+        elif estimate_only:
+            if created_image:
+                image.delete()
+                Gimp.displays_flush()
+            elif extend:
+                self.restore_canvas(image, extend)
+            return procedure.new_return_values(
+                Gimp.PDBStatusType.CALLING_ERROR,
+                GLib.Error(_("The cost can not be estimated")),
+            )
+
+        cache_writer = None
+        if cache_key is not None:
+            cache_writer = cache.writer(cache_key)
+
+        # An identical request sent from another run is not sent again,
+        # its images are shared
+        registry = None
+        inflight_key = None
+        if config.get_property("use-cache") and not pieces and seed.strip():
+            try:
+                registry = InFlightRegistry(
+                    Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / "inflight"
+                )
+                inflight_key = request_key(options)
+                if not registry.lead(inflight_key, max_wait_minutes * 60):
+                    Gimp.progress_init(_("Waiting for the same request already sent"))
+                    shared = registry.wait(
+                        inflight_key, lambda marker: Gimp.progress_pulse()
+                    )
+                    Gimp.progress_end()
+                    if shared is not None:
+                        self.display_generated(
+                            image,
+                            shared["files"],
+                            model,
+                            placement,
+                            context_margin // 2,
+                        )
+                        self.store_metadata(
+                            image,
+                            shared["model"],
+                            shared["prompt"],
+                            shared["description"],
+                        )
+                        if created_image:
+                            self.remove_background(image)
+                        return procedure.new_return_values(
+                            Gimp.PDBStatusType.SUCCESS,
+                            GLib.Error(
+                                _("The images of the same request already sent were reused")
+                            ),
+                        )
+                    # The other run failed, this one tries by itself
+                    if not registry.lead(inflight_key, max_wait_minutes * 60):
+                        inflight_key = None
+            except OSError as ex:
+                logging.debug(f"Requests in flight are not shared: {ex}")
+                inflight_key = None
+        inflight_writer = None
+        if inflight_key is not None:
+            inflight_writer = registry.writer(inflight_key)
 
         self.bridge: GimpUtilitiesBridge = GimpUtilitiesBridge(
             procedure, Gimp.version()
         )
         logging.debug(self.bridge.base_info)
-        sh_client = AiHordeClient(
-            VERSION,
-            URL_VERSION_UPDATE,
-            HELP_URL,
-            URL_DOWNLOAD,
-            options,
-            self.bridge.base_info,
-            self.bridge,
-        )
+        self.bridge.append_warning += preflight_warning
+        shared_properties = {
+            PROPERTY_CURRENT_SESSION: self.bridge.has_asked_for_update()
+        }
+        pending_properties = {}
+        run_job = self.job_runner(procedure, shared_properties, pending_properties)
+
+        if pieces:
+            # The pieces are independent, as many as allowed go at the same time
+            dispatcher = HordeDispatcher(run_job, len(pieces), self.report_jobs)
+            for piece, sides in pieces:
+                start = time.perf_counter()
+                job = dispatcher.add_job(
+                    dict(
+                        options,
+                        source_image=self.get_image_data(
+                            image, piece, upload_format, compress_level
+                        ),
+                        image_width=piece.width,
+                        image_height=piece.height,
+                    )
+                )
+                job.metrics = JobMetrics(job.index, model)
+                job.metrics.add_phase("export", time.perf_counter() - start)
+                self.tracer.add("get_image_data", start, format=upload_format)
+        else:
+            dispatcher = HordeDispatcher(run_job, parallel_jobs, self.report_jobs)
+            if stream_results and parallel_jobs > 1:
+                # One image per request, each one is shown as soon as it arrives
+                dispatcher.add_jobs(options, nimages)
+            else:
+                dispatcher.add_jobs(options, parallel_jobs)
+            for job in dispatcher.jobs:
+                job.metrics = JobMetrics(job.index, model)
+            # The source is shared, its export counts once
+            dispatcher.jobs[0].metrics.add_phase("export", export_seconds)
         Gimp.progress_init(_("AI Horde work"))
-        try:
-            images_names = sh_client.generate_image(options)
-        except Exception as ex:
-            log_exception(ex)
-            url_data = self.bridge.get_generated_image_url_status()
-            if url_data:
-                font = Gimp.Font.get_by_name("Monospace")
-                # We try to offer some relief, for the user to still download the image
-                if font is None:
-                    font = Gimp.fonts_get_list()[0]
-                text_layer = Gimp.TextLayer.new(
+        finished_jobs = []
+        for job in dispatcher.as_completed():
+            if job.error is not None:
+                continue
+            finished_jobs.append(job)
+            if job.result and not pieces:
+                # display_generated removes the files
+                if cache_writer is not None:
+                    cache_writer.add(job.result)
+                if inflight_writer is not None:
+                    inflight_writer.add(job.result)
+                with job.metrics.phase("insert"):
+                    self.display_generated(
+                        image, job.result, model, placement, context_margin // 2
+                    )
+                Gimp.progress_update(
+                    len([item for item in dispatcher.jobs if item.done])
+                    / len(dispatcher.jobs)
+                )
+        upload_speed.update(session)
+        if budget is not None and finished_jobs:
+            budget.charge(kudos * len(finished_jobs) / len(dispatcher.jobs))
+        failed_jobs = [job for job in dispatcher.jobs if job.error is not None]
+        if pieces and failed_jobs:
+            # A missing piece would leave a hole, the ones that finished
+            # are not placed
+            for job in finished_jobs:
+                for file_name in job.result or []:
+                    if os.path.exists(file_name):
+                        os.unlink(file_name)
+        elif pieces and finished_jobs:
+            with finished_jobs[0].metrics.phase("insert"):
+                self.assemble_pieces(
                     image,
-                    url_data[2],
-                    font,
-                    10,
-                    Gimp.Unit.pixel(),
+                    [
+                        pieces[job.index] + (job.result[0],)
+                        for job in sorted(finished_jobs, key=lambda job: job.index)
+                        if job.result
+                    ],
+                    f"{model} ({_('outpaint') if extend else _('tiles')})",
                 )
-                text_layer.set_name(url_data[0])
-                image.insert_layer(text_layer, None, 0)
-                Gimp.displays_flush()
+        self.record_metrics(dispatcher.jobs)
+        for property_name, value in pending_properties.items():
+            self.bridge.set_frontend_property(property_name, value)
+
+        for job in dispatcher.jobs:
+            informer = job.context[1]
+            for warning in informer.append_warning.split("\n "):
+                if warning and warning not in self.bridge.append_warning:
+                    self.bridge.append_warning += "\n " + warning
+            for success in informer.append_success_message.split("\n "):
+                if success and success not in self.bridge.append_success_message:
+                    self.bridge.append_success_message += "\n " + success
+
+        for job in failed_jobs:
+            logging.error(f"Request {job.index} failed: {job.error}")
+            log_exception(job.error)
+            url_data = job.context[1].get_generated_image_url_status()
+            # The pieces can not be placed later, their urls go in the error
+            if url_data and not pieces:
+                self.add_url_status_layer(image, url_data)
+                if finished_jobs:
+                    self.bridge.append_warning += "\n " + url_data[2]
+                job_id = job_id_from(url_data)
+                if journal is not None and job_id:
+                    journal.add(
+                        job_id,
+                        job.options,
+                        {
+                            "image_id": image.get_id(),
+                            "layer": url_data[0],
+                            "region": list(placement) if placement else None,
+                            "feather": context_margin // 2,
+                        },
+                    )
+        Gimp.progress_end()
 
+        if failed_jobs:
+            # Only complete generations are reused
+            if cache_writer is not None:
+                cache_writer.discard()
+                cache_writer = None
+            if inflight_writer is not None:
+                inflight_writer.discard()
+                inflight_writer = None
+                registry.release(inflight_key)
+
+        if not finished_jobs or (pieces and failed_jobs):
+            if extend:
+                self.restore_canvas(image, extend)
+            ex = failed_jobs[0].error
+            if pieces:
+                message = _("{} of {} pieces failed, none was placed").format(
+                    len(failed_jobs), len(dispatcher.jobs)
+                )
+                for job in failed_jobs:
+                    url_data = job.context[1].get_generated_image_url_status()
+                    if url_data:
+                        message += "\n  " + url_data[2]
+                return procedure.new_return_values(
+                    Gimp.PDBStatusType.CALLING_ERROR,
+                    GLib.Error(message + "\n" + str(ex)),
+                )
+            url_data = failed_jobs[0].context[1].get_generated_image_url_status()
+            if url_data:
                 message = (
                     _(
                         "It will take too long, You can continue with your activities while the Horde works."
                     )
                     + "\n  "
+                    + (
+                        _("The images will be added the next time you use the plugin.")
+                        + "\n  "
+                        if journal is not None and not pieces
+                        else ""
+                    )
                     + url_data[2]
                     + "\n"
                     + str(ex)
@@ -679,88 +1512,702 @@ class StableDiffusion(Gimp.PlugIn):
                 GLib.Error(str(ex)),
             )
 
-        self.display_generated(image, images_names, model)
-
-        self.store_metadata(image, sh_client)
+        sh_client = finished_jobs[0].context[0]
+        description = sh_client.get_full_description()
+        self.store_metadata(
+            image, sh_client.settings["model"], sh_client.settings["prompt"], description
+        )
+        generated = {
+            "model": sh_client.settings["model"],
+            "prompt": sh_client.settings["prompt"],
+            "description": description,
+        }
+        if cache_writer is not None:
+            cache_writer.commit(generated)
+        if inflight_writer is not None:
+            inflight_writer.commit(generated)
+            registry.release(inflight_key)
 
         message = "The task was succesful"
 
         new_choices = sh_client.settings.get("local_settings", {})
-        logging.debug(new_choices)
-        self.procedures[procedure_name].update_choices_into(
-            new_choices, self.st_manager
-        )
+        logging.debug(f"Settings to update: {sorted(new_choices)}")
+        # Other Gimp windows may be saving their settings too
+        with FileLock(
+            Path(Gimp.cache_directory()) / "ikks-py3-stablehorde" / SETTINGS_LOCK
+        ):
+            self.procedures[procedure_name].update_choices_into(
+                new_choices, self.st_manager
+            )
         logging.debug("Done")
         message += self.bridge.append_success_message
         message += self.bridge.append_warning
         logging.debug(message)
 
         if created_image:
-            layers = [
-                layer
-                for layer in image.get_layers()
-                if layer.get_name() == "background"
-            ]
-            if len(layers):
-                image.remove_layer(layers[0])
+            self.remove_background(image)
+        if journal is not None:
+            # Requests from other runs that finished meanwhile
+            self.place_resumed(journal)
         return procedure.new_return_values(
             Gimp.PDBStatusType.SUCCESS, GLib.Error(message)
         )
 
-    def store_metadata(self, image: Gimp.Image, sh_client: AiHordeClient) -> None:
+    def run_batch(self, procedure: Gimp.ImageProcedure, config) -> Gimp.ValueArray:
+        """
+        Generates the images of each prompt of the prompt list, parallel-jobs
+        rows at the same time.  The images are saved in the output folder,
+        or added as layers of a new image, and a CSV report tells how each
+        row went.
+        """
+        import shutil
+
+        from sdhorde.batch import (
+            output_name,
+            read_prompt_list,
+            row_options,
+            write_report,
+        )
+        from sdhorde.dispatch import HordeDispatcher
+
+        procedure_name = procedure.get_name()
+        prompt_list = config.get_property("prompt-list")
+        if prompt_list is None or prompt_list.get_path() is None:
+            return procedure.new_return_values(
+                Gimp.PDBStatusType.CALLING_ERROR,
+                GLib.Error(_("Choose the file with the prompts.")),
+            )
+        list_path = Path(prompt_list.get_path())
+        try:
+            rows = read_prompt_list(list_path)
+        except (OSError, UnicodeDecodeError) as ex:
+            return procedure.new_return_values(
+                Gimp.PDBStatusType.CALLING_ERROR,
+                GLib.Error(_("Unable to read {}: {}").format(list_path, ex)),
+            )
+        if not rows:
+            return procedure.new_return_values(
+                Gimp.PDBStatusType.CALLING_ERROR,
+                GLib.Error(_("There are no prompts in {}").format(list_path)),
+            )
+        output_folder = config.get_property("output-folder")
+        folder = None
+        if output_folder is not None and output_folder.get_path():
+            folder = Path(output_folder.get_path())
+
+        width = config.get_property("width")
+        height = config.get_property("height")
+        options = {
+            "model": config.get_property("model"),
+            "mode": config.get_property("prompt-type"),
+            "init_strength": config.get_property("init-strength"),
+            "prompt_strength": config.get_property("prompt-strength"),
+            "steps": config.get_property("steps"),
+            "nsfw": config.get_property("nsfw"),
+            "censor_nsfw": config.get_property("censor-nsfw"),
+            "api_key": config.get_property("api-key") or ANONYMOUS_KEY,
+            "max_wait_minutes": config.get_property("max-wait-minutes"),
+            "seed": config.get_property("seed"),
+            "nimages": config.get_property("nimages"),
+            "image_width": width,
+            "image_height": height,
+            "prompt": "",
+            "source_image": "",
+            "default_model": self.procedures[procedure_name].default_model,
+        }
+        options["local_settings"] = {
+            "models": self.procedures[procedure_name].model_choices,
+            "date_refreshed_models": self.procedures[procedure_name].refreshed_date,
+        }
+
+        self.bridge = GimpUtilitiesBridge(procedure, Gimp.version())
+        shared_properties = {
+            PROPERTY_CURRENT_SESSION: self.bridge.has_asked_for_update()
+        }
+        pending_properties = {}
+        dispatcher = HordeDispatcher(
+            self.job_runner(procedure, shared_properties, pending_properties),
+            config.get_property("parallel-jobs"),
+            self.report_jobs,
+        )
+        job_rows = {}
+        for row in rows:
+            row["files"] = []
+            if row["error"]:
+                row["status"] = "invalid"
+                continue
+            row_settings = row_options(options, row)
+            row_width = row_settings["image_width"]
+            row_height = row_settings["image_height"]
+            if (
+                not MIN_WIDTH <= row_width <= MAX_WIDTH
+                or not MIN_HEIGHT <= row_height <= MAX_HEIGHT
+                or row_width * row_height > MAX_MP
+            ):
+                row["status"] = "invalid"
+                row["error"] = f"Size {row_width}x{row_height} is not allowed"
+                continue
+            row["model"] = row_settings["model"]
+            row["seed"] = row_settings["seed"]
+            job_rows[dispatcher.add_job(row_settings).index] = row
+
+        image = None
+        if folder is None and job_rows:
+            image = Gimp.Image.new(width, height, Gimp.ImageBaseType.RGB)
+            layer = Gimp.Layer.new(
+                image,
+                "background",
+                width,
+                height,
+                Gimp.ImageBaseType.RGB,
+                0.0,
+                Gimp.LayerMode.NORMAL,
+            )
+            image.insert_layer(layer, None, 0)
+            Gimp.Display.new(image)
+
+        Gimp.progress_init(_("AI Horde work"))
+        finished = 0
+        for job in dispatcher.as_completed():
+            row = job_rows[job.index]
+            if job.error is not None:
+                logging.error(f"Line {row['line']} failed: {job.error}")
+                log_exception(job.error)
+                row["status"] = "failed"
+                row["error"] = str(job.error)
+                url_data = None
+                if job.context is not None:
+                    url_data = job.context[1].get_generated_image_url_status()
+                if url_data:
+                    row["error"] += " " + url_data[2]
+                continue
+            finished += 1
+            row["status"] = "done"
+            if folder is not None:
+                for index, file_name in enumerate(job.result):
+                    target = folder / output_name(row, index, Path(file_name).suffix)
+                    shutil.move(file_name, target)
+                    row["files"].append(str(target))
+            else:
+                with job.metrics.phase("insert"):
+                    self.display_generated(
+                        image,
+                        job.result,
+                        f"{row['line']}: {row['overrides']['prompt']}",
+                    )
+            Gimp.progress_update(
+                len([item for item in dispatcher.jobs if item.done])
+                / len(dispatcher.jobs)
+            )
+        Gimp.progress_end()
+        self.record_metrics(dispatcher.jobs)
+        for property_name, value in pending_properties.items():
+            self.bridge.set_frontend_property(property_name, value)
+
+        if image is not None:
+            if finished:
+                self.remove_background(image)
+            else:
+                image.delete()
+                Gimp.displays_flush()
+
+        report = (folder or list_path.parent) / f"{list_path.stem}-report.csv"
+        try:
+            write_report(report, rows)
+        except OSError as ex:
+            logging.debug(f"Unable to write the report: {ex}")
+            report = None
+        message = _("{} of {} prompts generated.").format(finished, len(rows))
+        if report is not None:
+            message += "\n" + _("Report at {}").format(report)
+        logging.debug(message)
+        status = Gimp.PDBStatusType.SUCCESS
+        if not finished:
+            status = Gimp.PDBStatusType.CALLING_ERROR
+        return procedure.new_return_values(status, GLib.Error(message))
+
+    def job_runner(
+        self,
+        procedure: Gimp.ImageProcedure,
+        shared_properties: dict,
+        pending_properties: dict,
+    ) -> Callable[[HordeJob], list[str]]:
+        """
+        Returns the run_job for HordeDispatcher, each job generates with its
+        own AiHordeClient in its own folder of self.workspaces, job.context
+        keeps the client and its informer
+        """
+
+        from sdhorde.metrics import JobMetrics
+
+        # libgimp is only called from the main thread, run_job is not
+        gimp_version = Gimp.version()
+
+        def run_job(job: HordeJob) -> list[str]:
+            if job.metrics is None:
+                job.metrics = JobMetrics(job.index, job.options["model"])
+            informer = JobInformer(
+                procedure,
+                gimp_version,
+                job,
+                shared_properties,
+                pending_properties,
+                self.workspaces.new(f"job{job.index}"),
+            )
+            job.context = (None, informer)
+            sh_client = AiHordeClient(
+                VERSION,
+                URL_VERSION_UPDATE,
+                HELP_URL,
+                URL_DOWNLOAD,
+                job.options,
+                self.bridge.base_info,
+                informer,
+            )
+            job.context = (sh_client, informer)
+            if self.metrics is None:
+                with self.tracer.span("generate_image", job=job.index):
+                    return sh_client.generate_image(job.options)
+            with self.metrics.bind(job.metrics):
+                with self.tracer.span("generate_image", job=job.index):
+                    return sh_client.generate_image(job.options)
+
+        return run_job
+
+    def record_metrics(self, jobs: list[HordeJob]) -> None:
+        """
+        Adds the metrics of the jobs to the ones kept in the cache folder
+        """
+        if self.metrics is None:
+            return
+        for job in jobs:
+            if job.metrics is not None:
+                self.metrics.record(
+                    job.metrics, "failed" if job.error is not None else "done"
+                )
+
+    def remove_background(self, image: Gimp.Image) -> None:
+        """
+        Removes the empty layer added to the image created for text2img
+        """
+        layers = [
+            layer for layer in image.get_layers() if layer.get_name() == "background"
+        ]
+        if len(layers):
+            image.remove_layer(layers[0])
+
+    def fits_generation(self, width: int, height: int) -> bool:
+        return width <= MAX_WIDTH and height <= MAX_HEIGHT and width * height <= MAX_MP
+
+    def report_jobs(self, jobs: list[HordeJob]) -> None:
+        """
+        Shows in the progress bar how the requests to the Horde go
+        """
+        if len(jobs) == 1:
+            if jobs[0].status_text:
+                Gimp.progress_set_text(jobs[0].status_text)
+                Gimp.progress_update(jobs[0].progress / 100.0)
+            return
+        finished = len([job for job in jobs if job.done])
+        running = [job for job in jobs if not job.done and job.status_text]
+        text = _("{} of {} requests finished").format(finished, len(jobs))
+        if running:
+            text += " - " + running[0].status_text
+        Gimp.progress_set_text(text)
+        Gimp.progress_update(
+            sum(100.0 if job.done else job.progress for job in jobs) / len(jobs) / 100.0
+        )
+
+    def add_url_status_layer(self, image: Gimp.Image, url_data) -> None:
+        """
+        Adds a text layer with the url to check the status of a request
+        that did not finish in time
+        """
+        font = Gimp.Font.get_by_name("Monospace")
+        # We try to offer some relief, for the user to still download the image
+        if font is None:
+            font = Gimp.fonts_get_list()[0]
+        text_layer = Gimp.TextLayer.new(
+            image,
+            url_data[2],
+            font,
+            10,
+            Gimp.Unit.pixel(),
+        )
+        text_layer.set_name(url_data[0])
+        image.insert_layer(text_layer, None, 0)
+        Gimp.displays_flush()
+
+    def place_resumed(self, journal: JobJournal) -> None:
+        """
+        Adds the images of the journaled requests that finished to the image
+        that asked for them, or another one showing their status layer, or
+        to a new image when none is open
+        """
+        from sdhorde.regions import Region
+
+        for entry in journal.downloaded():
+            target = entry["target"]
+            file_names = entry["files"]
+            name = entry["request"].get("model", "")
+            # Ids are reused by other GIMP sessions, the status layer tells
+            # it is the same image
+            image = Gimp.Image.get_by_id(target["image_id"])
+            if image is None or image.get_layer_by_name(target["layer"]) is None:
+                image = None
+                for candidate in Gimp.get_images():
+                    if candidate.get_layer_by_name(target["layer"]) is not None:
+                        image = candidate
+                        break
+            if image is None:
+                logging.debug(f"The image of {entry['job_id']} is not open")
+                image = Gimp.file_load(
+                    Gimp.RunMode.NONINTERACTIVE, Gio.File.new_for_path(file_names[0])
+                )
+                image.get_layers()[0].set_name(name)
+                Gimp.Display.new(image)
+                os.unlink(file_names[0])
+                self.display_generated(image, file_names[1:], name)
+            else:
+                image.remove_layer(image.get_layer_by_name(target["layer"]))
+                region = Region(*target["region"]) if target["region"] else None
+                self.display_generated(
+                    image, file_names, name, region, target["feather"]
+                )
+            journal.remove(entry["job_id"])
+            logging.debug(f"{entry['job_id']} placed")
+
+    def store_metadata(
+        self, image: Gimp.Image, model_name: str, prompt: str, description: str
+    ) -> None:
         metadata = METADATA_FOR_GIMP.format(
             **{
-                "model_name": sh_client.settings["model"],
+                "model_name": model_name,
                 "user": getpass.getuser(),
-                "prompt": sh_client.settings["prompt"],
+                "prompt": prompt,
                 "plugin_name": HORDE_CLIENT_NAME,
                 "plugin_version": VERSION,
-                "lines_properties": sh_client.get_full_description(),
+                "lines_properties": description,
             }
         )
-        logging.debug(metadata)
-        new_metadata = Gimp.Metadata().deserialize(metadata)
-        logging.debug(new_metadata.serialize())
-        image.set_metadata(new_metadata)
-
-    def get_image_data(self, image: Gimp.Image) -> str:
+        with self.tracer.span("store_metadata"):
+            new_metadata = Gimp.Metadata().deserialize(metadata)
+            image.set_metadata(new_metadata)
+        logging.debug(f"Metadata of {model_name} stored")
+
+    def get_image_data(
+        self,
+        image: Gimp.Image,
+        region: Optional[Region] = None,
+        upload_format: str = "png",
+        level: int = 6,
+        size: Optional[tuple[int, int]] = None,
+    ) -> str:
         """
-        returns a base encoded representation of the Gimp Image
+        returns a base encoded representation of the Gimp Image, or of the
+        region of it, resampled to size when given.  For PNG the visible
+        pixels are read as 8 bit sRGB from a Gegl buffer and compressed in
+        memory with zlib level, the other formats are exported by Gimp.
         """
         if image is None:
             return ""
-        Gimp.file_save(
-            Gimp.RunMode.NONINTERACTIVE, image, Gio.File.new_for_path(init_file), None
+        from gi.repository import Gegl
+        from sdhorde.encoding import encode_png
+        from sdhorde.regions import Region
+
+        if region is None:
+            region = Region(0, 0, image.get_width(), image.get_height())
+        # The visible pixels of region in an image of their own, where
+        # they can be resampled without touching the image of the user
+        export = Gimp.Image.new(
+            image.get_width(), image.get_height(), Gimp.ImageBaseType.RGB
+        )
+        try:
+            layer = Gimp.Layer.new_from_visible(image, export, "init")
+            export.insert_layer(layer, None, 0)
+            export.crop(region.width, region.height, region.x, region.y)
+            width, height = size or (region.width, region.height)
+            if (width, height) != (region.width, region.height):
+                export.scale(width, height)
+            if upload_format in UPLOAD_EXPORTERS:
+                exported = self.export_image_data(export, upload_format)
+                if exported:
+                    return exported
+            if layer.has_alpha():
+                pixel_format, channels = "R'G'B'A u8", 4
+            else:
+                pixel_format, channels = "R'G'B' u8", 3
+            pixels = layer.get_buffer().get(
+                Gegl.Rectangle.new(0, 0, width, height),
+                1.0,
+                pixel_format,
+                Gegl.AbyssPolicy.NONE,
+            )
+        finally:
+            export.delete()
+        with self.tracer.span("encode_png", level=level):
+            data = encode_png(pixels, width, height, channels, level)
+        with self.tracer.span("base64", size=len(data)):
+            return base64.b64encode(data).decode("ascii")
+
+    def export_image_data(
+        self, export: Gimp.Image, upload_format: str
+    ) -> Optional[str]:
+        """
+        export, an 8 bit image, saved by Gimp as upload_format.  None when
+        Gimp could not export it.
+        """
+        procedure_name, suffix, settings = UPLOAD_EXPORTERS[upload_format]
+        descriptor, file_name = tempfile.mkstemp(
+            suffix=suffix, dir=self.workspaces.root
+        )
+        os.close(descriptor)
+        try:
+            exporter = Gimp.get_pdb().lookup_procedure(procedure_name)
+            config = exporter.create_config()
+            config.set_property("run-mode", Gimp.RunMode.NONINTERACTIVE)
+            config.set_property("image", export)
+            config.set_property("file", Gio.File.new_for_path(file_name))
+            for name, value in settings.items():
+                config.set_property(name, value)
+            with self.tracer.span(procedure_name):
+                result = exporter.run(config)
+            if result.index(0) != Gimp.PDBStatusType.SUCCESS:
+                logging.debug(f"{procedure_name} failed")
+                return None
+            with open(file_name, "rb") as stream:
+                data = stream.read()
+        except (AttributeError, TypeError, OSError) as ex:
+            logging.debug(f"Unable to export as {upload_format}: {ex}")
+            return None
+        finally:
+            os.unlink(file_name)
+        logging.debug(f"Sending {len(data)} bytes as {upload_format}")
+        with self.tracer.span("base64", size=len(data)):
+            return base64.b64encode(data).decode("ascii")
+
+    def get_region_of_interest(
+        self, image: Gimp.Image, procedure_name: str, margin: int
+    ) -> Optional[Region]:
+        """
+        Region of the image to send instead of the whole image: the
+        selection, or when inpainting without selection, the transparent
+        area, with margin pixels of context around.  None when the whole
+        image is needed.
+        """
+        from gi.repository import Gegl
+        from sdhorde.regions import alpha_hole_bounds, expand_region
+
+        _, non_empty, x1, y1, x2, y2 = Gimp.Selection.bounds(image)
+        if non_empty:
+            bounds = (x1, y1, x2, y2)
+        elif procedure_name == self.plug_in_proc_inpaint:
+            layer = Gimp.Layer.new_from_visible(image, image, "alpha")
+            width, height = layer.get_width(), layer.get_height()
+            alpha = layer.get_buffer().get(
+                Gegl.Rectangle.new(0, 0, width, height),
+                1.0,
+                "A u8",
+                Gegl.AbyssPolicy.NONE,
+            )
+            layer.delete()
+            bounds = alpha_hole_bounds(alpha, width, height)
+        else:
+            bounds = None
+        if bounds is None:
+            return None
+        region = expand_region(
+            bounds,
+            margin,
+            image.get_width(),
+            image.get_height(),
+            MAX_WIDTH,
+            MAX_HEIGHT,
+            MAX_MP,
+        )
+        logging.debug(f"Region of interest {bounds} sent as {region}")
+        return region
+
+    def place_in_region(
+        self, layer: Gimp.Layer, region: Region, sides: dict[str, int]
+    ) -> None:
+        """
+        Moves layer to region and blends its borders with a mask feathered
+        the pixels given for each side
+        """
+        from gi.repository import Gegl
+        from sdhorde.regions import feather_mask
+
+        if layer.get_width() != region.width or layer.get_height() != region.height:
+            layer.scale(region.width, region.height, False)
+        layer.set_offsets(region.x, region.y)
+        if not any(sides.values()):
+            return
+        mask = layer.create_mask(Gimp.AddMaskType.WHITE)
+        layer.add_mask(mask)
+        buffer = mask.get_buffer()
+        buffer.set(
+            Gegl.Rectangle.new(0, 0, region.width, region.height),
+            "Y u8",
+            feather_mask(region.width, region.height, **sides),
         )
-        with open(init_file, "rb") as init_image:
-            encoded = base64.b64encode(init_image.read()).decode("ascii")
-            return encoded
-        return ""
+        buffer.flush()
+        mask.update(0, 0, region.width, region.height)
 
     def display_generated(
-        self, gimp_image: Gimp.Image, file_names: list[str], name: str
+        self,
+        gimp_image: Gimp.Image,
+        file_names: list[str],
+        name: str,
+        region: Optional[Region] = None,
+        feather: int = 0,
     ):
         """
         Creates a layer in gimp_image for each image from images, sets the name
-        of the layer
+        of the layer.  When region is given, the layers are placed and
+        blended there.
         """
+        from gi.repository import Gegl
+        from sdhorde.regions import region_feather
+
+        if region is not None:
+            # The sides on the border of the image have nothing to blend with
+            sides = region_feather(
+                region, feather, gimp_image.get_width(), gimp_image.get_height()
+            )
         color = Gimp.context_get_foreground()
         Gimp.context_set_foreground(Gegl.Color.new("#000000"))
 
         logging.debug("Creating layers")
-        for file_name in file_names:
-            new_layer = Gimp.file_load_layer(
-                Gimp.RunMode.NONINTERACTIVE,
-                gimp_image,
-                Gio.File.new_for_path(file_name),
-            )
-            new_layer.set_name(name)
-            gimp_image.insert_layer(new_layer, None, 0)
-            os.unlink(file_name)
-        Gimp.context_set_foreground(color)
+        # The whole batch is a single step to undo
+        gimp_image.undo_group_start()
+        try:
+            for file_name in file_names:
+                with self.tracer.span("load_layer", file=file_name):
+                    new_layer = self.load_layer(gimp_image, file_name)
+                new_layer.set_name(name)
+                gimp_image.insert_layer(new_layer, None, 0)
+                if region is not None:
+                    self.place_in_region(new_layer, region, sides)
+                os.unlink(file_name)
+        finally:
+            gimp_image.undo_group_end()
+            Gimp.context_set_foreground(color)
         logging.debug("Layers added")
         Gimp.displays_flush()
 
+    def load_layer(self, gimp_image: Gimp.Image, file_name: str) -> Gimp.Layer:
+        """
+        New layer of gimp_image with the image in file_name, not inserted.
+        Gegl decodes it in this process and writes the pixels straight into
+        the buffer of the layer.  Gimp loads it with its file plug-ins when
+        Gegl can not or the image is indexed.
+        """
+        from gi.repository import Gegl
+
+        layer_type = {
+            Gimp.ImageBaseType.RGB: Gimp.ImageType.RGBA_IMAGE,
+            Gimp.ImageBaseType.GRAY: Gimp.ImageType.GRAYA_IMAGE,
+        }.get(gimp_image.get_base_type())
+        if layer_type is not None:
+            try:
+                graph = Gegl.Node()
+                source = graph.create_child("gegl:load")
+                source.set_property("path", file_name)
+                bounds = source.get_bounding_box()
+                if bounds.width > 0 and bounds.height > 0:
+                    layer = Gimp.Layer.new(
+                        gimp_image,
+                        "",
+                        bounds.width,
+                        bounds.height,
+                        layer_type,
+                        100.0,
+                        Gimp.LayerMode.NORMAL,
+                    )
+                    buffer = layer.get_buffer()
+                    sink = graph.create_child("gegl:write-buffer")
+                    sink.set_property("buffer", buffer)
+                    source.link(sink)
+                    sink.process()
+                    buffer.flush()
+                    return layer
+            except (GLib.Error, TypeError) as ex:
+                logging.debug(f"Gegl could not load {file_name}: {ex}")
+        return Gimp.file_load_layer(
+            Gimp.RunMode.NONINTERACTIVE,
+            gimp_image,
+            Gio.File.new_for_path(file_name),
+        )
+
+    def extend_canvas(
+        self, image: Gimp.Image, extend: dict[str, int], margin: int
+    ) -> Optional[list[tuple[Region, dict[str, int]]]]:
+        """
+        Grows the canvas of image extend pixels on each side and returns
+        the regions to inpaint, the new transparent strips with margin
+        pixels of context.  The canvas stays as it was when there is
+        nothing to extend or the strips can not be generated.
+        """
+        from sdhorde.regions import outpaint_regions
+
+        width, height = image.get_width(), image.get_height()
+        pieces = outpaint_regions(
+            width, height, extend, margin, MAX_WIDTH, MAX_HEIGHT, MAX_MP
+        )
+        if not pieces:
+            return pieces
+        image.resize(
+            width + extend["left"] + extend["right"],
+            height + extend["top"] + extend["bottom"],
+            extend["left"],
+            extend["top"],
+        )
+        logging.debug(f"Outpainting {pieces}")
+        return pieces
+
+    def restore_canvas(self, image: Gimp.Image, extend: dict[str, int]) -> None:
+        """
+        Takes back the canvas grown by extend_canvas, when the outpaint
+        did not finish
+        """
+        image.resize(
+            image.get_width() - extend["left"] - extend["right"],
+            image.get_height() - extend["top"] - extend["bottom"],
+            -extend["left"],
+            -extend["top"],
+        )
+        Gimp.displays_flush()
+
+    def assemble_pieces(
+        self,
+        gimp_image: Gimp.Image,
+        pieces: list[tuple[Region, dict[str, int], str]],
+        name: str,
+    ) -> None:
+        """
+        Places each generated piece in its region and merges them in a
+        single layer, each piece fades in over the ones before it with the
+        feather given for each side, hiding the seams
+        """
+        gimp_image.undo_group_start()
+        try:
+            group = Gimp.GroupLayer.new(gimp_image, name)
+            gimp_image.insert_layer(group, None, 0)
+            for tile, sides, file_name in pieces:
+                with self.tracer.span("load_layer", file=file_name):
+                    layer = self.load_layer(gimp_image, file_name)
+                # Later pieces go on top
+                gimp_image.insert_layer(layer, group, 0)
+                self.place_in_region(layer, tile, sides)
+                os.unlink(file_name)
+            layer = group.merge()
+            layer.set_name(name)
+        finally:
+            gimp_image.undo_group_end()
+        logging.debug(f"{len(pieces)} pieces merged")
+        Gimp.displays_flush()
+
 
 class GimpUtilitiesBridge(InformerFrontend):
     """
@@ -826,6 +2273,69 @@ class GimpUtilitiesBridge(InformerFrontend):
         pass
 
 
+class JobInformer(GimpUtilitiesBridge):
+    """
+    Informer for each request sent by HordeDispatcher.  From the main
+    thread it behaves as GimpUtilitiesBridge, from other threads it only
+    keeps the information, libgimp calls are made from the main thread.
+    """
+
+    def __init__(
+        self,
+        procedure: Gimp.ImageProcedure,
+        gimp_version: str,
+        job: HordeJob,
+        properties: dict,
+        pending_properties: dict,
+        workspace: Optional[Path] = None,
+    ):
+        super().__init__(procedure, gimp_version)
+        self.job = job
+        self.workspace = workspace
+        """
+        Private folder for the files of the job
+        """
+        self.properties = properties
+        """
+        Frontend properties read before starting, shared among the jobs
+        """
+        self.pending_properties = pending_properties
+        """
+        Frontend properties to be stored once the jobs finish
+        """
+
+    def in_main_thread(self) -> bool:
+        return threading.current_thread() is threading.main_thread()
+
+    def set_finished(self):
+        # The progress ends when all the jobs have finished
+        pass
+
+    def update_status(self, text: str, progress: float = 0.0):
+        self.job.report(text, progress)
+        if self.in_main_thread():
+            super().update_status(text, progress)
+
+    def get_frontend_property(self, property_name: str) -> Union[str, bool, None]:
+        if property_name in self.properties:
+            return self.properties[property_name]
+        if self.in_main_thread():
+            return super().get_frontend_property(property_name)
+        return False
+
+    def set_frontend_property(self, property_name: str, value: Union[str, bool]):
+        self.properties[property_name] = value
+        if self.in_main_thread():
+            super().set_frontend_property(property_name, value)
+        else:
+            self.pending_properties[property_name] = value
+
+    def path_store_directory(self) -> Optional[str]:
+        if self.workspace is None:
+            return super().path_store_directory()
+        return str(self.workspace)
+
+
 Gimp.main(StableDiffusion.__gtype__, sys.argv)
 
 # TBD
@@ -838,7 +2348,7 @@ Gimp.main(StableDiffusion.__gtype__, sys.argv)
 # * [ ] Use aihordeclient
 # * [ ] Add styles for apikey users
 # * [ ] Use annotations
-# * [ ] Locally make outpaint Extend to left, bottom, right, top:
+# * [X] Locally make outpaint Extend to left, bottom, right, top:
 #      - Enlarge Image with a given amount, max 1.024, transparent
 #      - Send to process as inpaint
 # * [ ] Upscale image locally: Use Image, Scale Image Interpolation Lohab
@@ -0,0 +1,12 @@
+# Helpers for the AiHorde Gimp3 plugin
+# Authors:
+#  * Igor Támara <https://github.com/ikks>
+#
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+"""
+Building blocks used by gimp-stable-diffusion.py around the
+aihordeclient module.  Nothing in this package imports Gimp, so it
+can be used from other front ends.
+"""
@@ -0,0 +1,105 @@
+# Prompt lists for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import csv
+import json
+import re
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+OVERRIDES: Dict[str, Tuple[str, Callable[[Any], Any]]] = {
+    "prompt": ("prompt", str),
+    "model": ("model", str),
+    "seed": ("seed", str),
+    "steps": ("steps", int),
+    "width": ("image_width", int),
+    "height": ("image_height", int),
+    "nimages": ("nimages", int),
+    "cfg_scale": ("prompt_strength", float),
+}
+"""
+Fields a JSON row of a prompt list can set, with the option they
+override and how the value is read
+"""
+
+REPORT_FIELDS = ["line", "status", "prompt", "model", "seed", "files", "error"]
+
+
+def read_prompt_list(path: Path) -> List[Dict[str, Any]]:
+    """
+    Rows of a prompt list file, a prompt per line or a JSON object per
+    line with the fields in OVERRIDES, both can be mixed.  Empty lines
+    and lines starting with # are skipped.  Each row has its line
+    number, the options it overrides and an error when it can not be
+    used.
+    """
+    rows = []
+    with open(path, encoding="utf-8") as stream:
+        for number, line in enumerate(stream, 1):
+            text = line.strip()
+            if not text or text.startswith("#"):
+                continue
+            row: Dict[str, Any] = {"line": number, "overrides": {}, "error": ""}
+            rows.append(row)
+            if not text.startswith("{"):
+                row["overrides"]["prompt"] = text
+                continue
+            try:
+                data = json.loads(text)
+            except ValueError as ex:
+                row["error"] = f"Invalid JSON: {ex}"
+                continue
+            unknown = sorted(set(data) - set(OVERRIDES))
+            if unknown:
+                row["error"] = "Unknown fields: " + ", ".join(unknown)
+                continue
+            try:
+                for name, value in data.items():
+                    option, kind = OVERRIDES[name]
+                    row["overrides"][option] = kind(value)
+            except (TypeError, ValueError) as ex:
+                row["error"] = f"Invalid {name}: {ex}"
+                continue
+            if not row["overrides"].get("prompt", "").strip():
+                row["error"] = "The prompt is missing"
+    return rows
+
+
+def row_options(options: Dict[str, Any], row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    A copy of options with the overrides of row
+    """
+    return dict(options, **row["overrides"])
+
+
+def output_name(row: Dict[str, Any], index: int, suffix: str) -> str:
+    """
+    File name for the index image of row, starts with the line number to
+    keep the order of the list
+    """
+    words = re.sub(r"[^a-z0-9]+", "-", row["overrides"].get("prompt", "").lower())
+    return f"{row['line']:04d}-{words.strip('-')[:40].strip('-')}-{index}{suffix}"
+
+
+def write_report(path: Path, rows: List[Dict[str, Any]]) -> None:
+    """
+    Saves a CSV with the outcome of each row
+    """
+    with open(path, "w", encoding="utf-8", newline="") as stream:
+        writer = csv.DictWriter(stream, REPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                {
+                    "line": row["line"],
+                    "status": row.get("status", ""),
+                    "prompt": row["overrides"].get("prompt", ""),
+                    "model": row.get("model", ""),
+                    "seed": row.get("seed", ""),
+                    "files": " ".join(row.get("files", [])),
+                    "error": row["error"],
+                }
+            )
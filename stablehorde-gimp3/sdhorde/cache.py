@@ -0,0 +1,258 @@
+# Local cache of generated images for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 512 * 1024 * 1024
+"""
+Bytes the cached images can use before the least recently used are removed
+"""
+
+NOT_IN_KEY = (
+    "api_key",
+    "max_wait_minutes",
+    "local_settings",
+    "source_image",
+    "default_model",
+)
+"""
+Options that do not change the generated images
+"""
+
+META_FILE = "meta.json"
+STATS_FILE = "stats.json"
+
+
+def write_json_atomic(path: Path, data: Any) -> None:
+    """
+    Writes data to path so that readers see the old or the new content,
+    never a partial one
+    """
+    write_text_atomic(path, json.dumps(data))
+
+
+def write_text_atomic(path: Path, text: str) -> None:
+    """
+    Writes text to path as write_json_atomic does
+    """
+    descriptor, temporary = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
+            stream.write(text)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+
+class FileLock:
+    """
+    Lock held while in a with block, shared by every process that locks
+    the same path, so that a file read and written by several Gimp
+    processes is not changed by two of them at once
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._stream = None
+
+    def __enter__(self) -> "FileLock":
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._stream = open(self.path, "a+b")
+        if os.name == "nt":
+            import msvcrt
+
+            self._stream.seek(0)
+            msvcrt.locking(self._stream.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(self._stream.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            if os.name == "nt":
+                import msvcrt
+
+                self._stream.seek(0)
+                msvcrt.locking(self._stream.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(self._stream.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._stream.close()
+            self._stream = None
+
+
+def request_key(options: Dict[str, Any]) -> str:
+    """
+    Hash of the canonical request: the options that change the generated
+    images and the source image
+    """
+    request = {
+        name: value for name, value in options.items() if name not in NOT_IN_KEY
+    }
+    digest = hashlib.sha256(
+        json.dumps(request, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    )
+    digest.update(b"\0")
+    digest.update(str(options.get("source_image", "")).encode("ascii"))
+    return digest.hexdigest()
+
+
+def copy_entry(entry: Path) -> Dict[str, Any]:
+    """
+    Metadata stored in the entry directory, with a copy of its images in
+    "files", the caller owns the copies.  Raises OSError or ValueError
+    when the entry is not complete.
+    """
+    with open(entry / META_FILE, encoding="utf-8") as stream:
+        meta = json.load(stream)
+    files = []
+    for stored in sorted(entry.iterdir()):
+        if stored.name == META_FILE:
+            continue
+        descriptor, copy = tempfile.mkstemp(suffix=stored.suffix)
+        os.close(descriptor)
+        shutil.copyfile(stored, copy)
+        files.append(copy)
+    meta["files"] = files
+    return meta
+
+
+class CacheEntryWriter:
+    """
+    Collects the files of a generation while they arrive, they become
+    visible in the cache only when commit is called
+    """
+
+    def __init__(self, cache: Any, key: str):
+        """
+        cache gives the directory, entry_path(key) and evict()
+        """
+        self.cache = cache
+        self.key = key
+        self.staging = Path(tempfile.mkdtemp(dir=cache.directory, prefix=".new-"))
+        self.count = 0
+
+    def add(self, file_names: List[str]) -> None:
+        for file_name in file_names:
+            target = self.staging / f"{self.count:03d}{Path(file_name).suffix}"
+            shutil.copyfile(file_name, target)
+            self.count += 1
+
+    def commit(self, meta: Dict[str, Any]) -> None:
+        write_json_atomic(self.staging / META_FILE, meta)
+        entry = self.cache.entry_path(self.key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        if entry.exists():
+            shutil.rmtree(entry, ignore_errors=True)
+        os.replace(self.staging, entry)
+        self.cache.evict()
+
+    def discard(self) -> None:
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+
+class GenerationCache:
+    """
+    Generated images addressed by a hash of the request and the source
+    image.  Only requests with a seed are cached, without it the Horde
+    gives different images each time.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = CACHE_SIZE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def key_for(self, options: Dict[str, Any]) -> Optional[str]:
+        """
+        Hash of the canonical request, None when it is not cacheable
+        """
+        if not str(options.get("seed", "")).strip():
+            return None
+        return request_key(options)
+
+    def entry_path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the metadata stored with the entry and in "files" a copy of
+        its images, the caller owns the copies.  None when not cached.
+        """
+        entry = self.entry_path(key)
+        try:
+            meta = copy_entry(entry)
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        # Most recently used, the last to be evicted
+        os.utime(entry)
+        self._count("hits")
+        return meta
+
+    def writer(self, key: str) -> CacheEntryWriter:
+        return CacheEntryWriter(self, key)
+
+    def stats(self) -> Dict[str, int]:
+        try:
+            with open(self.directory / STATS_FILE, encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+    def _count(self, name: str) -> None:
+        """
+        Adds one to the stat name, locked so that the counts of other Gimp
+        processes are not lost
+        """
+        path = self.directory / STATS_FILE
+        try:
+            with FileLock(path.with_suffix(".lock")):
+                stats = self.stats()
+                stats[name] = stats.get(name, 0) + 1
+                write_text_atomic(path, json.dumps(stats))
+        except OSError as ex:
+            logger.debug(f"Unable to store cache stats: {ex}")
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in
+        max_bytes
+        """
+        entries = []
+        total = 0
+        for bucket in self.directory.iterdir():
+            if not bucket.is_dir() or bucket.name.startswith("."):
+                continue
+            for entry in bucket.iterdir():
+                size = sum(item.stat().st_size for item in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+                total += size
+        entries.sort()
+        now = time.time()
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            unused = now - entry.stat().st_mtime
+            logger.debug(f"Evicting {entry.name}, unused for {unused:.0f}s")
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
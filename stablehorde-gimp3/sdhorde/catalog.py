@@ -0,0 +1,221 @@
+# Model catalog for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import json
+import logging
+import os
+import threading
+import time
+
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.error import HTTPError, URLError
+
+from sdhorde.cache import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+CATALOG_URL = "https://aihorde.net/api/v2/status/models?type=image"
+"""
+Models served by the Horde workers, both categories come from here
+"""
+
+CATALOG_TTL = {
+    "models": 6 * 60 * 60,
+    "inpainting": 24 * 60 * 60,
+}
+"""
+Seconds each category is considered fresh, inpainting models change
+less often
+"""
+
+CATALOG_FILE = "catalog.json"
+
+LOCK_FILE = "catalog.lock"
+
+LOCK_EXPIRES = 120
+"""
+Seconds after which the lock of a refresh is considered abandoned
+"""
+
+REQUEST_TIMEOUT = 30
+
+
+def categorize(models: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """
+    Splits the Horde model status in the categories, the ones with more
+    workers first
+    """
+    ordered = sorted(
+        models, key=lambda model: (-model.get("count", 0), model.get("name", ""))
+    )
+    categories: Dict[str, List[str]] = {"models": [], "inpainting": []}
+    for model in ordered:
+        name = model.get("name", "")
+        if not name:
+            continue
+        if "inpainting" in name.lower():
+            categories["inpainting"].append(name)
+        else:
+            categories["models"].append(name)
+    return categories
+
+
+class ModelCatalog:
+    """
+    Model names offered in the dialogs, kept in a file shared by all the
+    Gimp processes.  Reading never touches the network, refresh asks the
+    Horde only when a category went stale, and only for changes, using
+    the ETag and Last-Modified the Horde sent when the category was
+    fetched.  Only the stale categories are updated, each one keeps the
+    time it was fetched.
+    """
+
+    def __init__(self, directory: Path, url: str = CATALOG_URL):
+        self.directory = Path(directory)
+        self.url = url
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> Path:
+        return self.directory / CATALOG_FILE
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {"categories": {}, "fetched": {}, "validators": {}}
+
+    def choices(self, category: str) -> List[str]:
+        """
+        Known models for category, empty when it was never fetched
+        """
+        return self.load()["categories"].get(category, [])
+
+    def refreshed_date(self, category: str) -> Optional[str]:
+        fetched = self.load()["fetched"].get(category)
+        if fetched is None:
+            return None
+        return date.fromtimestamp(fetched).isoformat()
+
+    def is_stale(self, category: str) -> bool:
+        fetched = self.load()["fetched"].get(category, 0)
+        return time.time() - fetched > CATALOG_TTL.get(category, 0)
+
+    def stale_categories(self) -> List[str]:
+        fetched = self.load()["fetched"]
+        now = time.time()
+        return [
+            category
+            for category, ttl in CATALOG_TTL.items()
+            if now - fetched.get(category, 0) > ttl
+        ]
+
+    def _acquire_file_lock(self) -> bool:
+        """
+        Only one process refreshes at a time, the lock file is created
+        exclusively and taken over when it was abandoned
+        """
+        lock = self.directory / LOCK_FILE
+        try:
+            descriptor = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - lock.stat().st_mtime < LOCK_EXPIRES:
+                    return False
+                os.unlink(lock)
+            except OSError:
+                return False
+            return self._acquire_file_lock()
+        os.write(descriptor, str(os.getpid()).encode("ascii"))
+        os.close(descriptor)
+        return True
+
+    def _release_file_lock(self) -> None:
+        try:
+            os.unlink(self.directory / LOCK_FILE)
+        except OSError:
+            pass
+
+    def refresh(self) -> bool:
+        """
+        Fetches the models of the stale categories.  Returns True when the
+        catalog changed.
+        """
+        if not self.stale_categories():
+            return False
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if not self._acquire_file_lock():
+                logger.debug("Another process is refreshing the catalog")
+                return False
+            try:
+                # Another process may have refreshed some meanwhile
+                stale = self.stale_categories()
+                return bool(stale) and self._fetch(stale)
+            finally:
+                self._release_file_lock()
+
+    def _fetch(self, stale: List[str]) -> bool:
+        # Loading the catalog must stay cheap, it happens when GIMP starts
+        import urllib.request
+
+        catalog = self.load()
+        validators = catalog.setdefault("validators", {})
+        request = urllib.request.Request(self.url)
+        # The answer only tells whether all the stale categories changed
+        # when they were fetched with the same validators
+        sent = {json.dumps(validators.get(category)) for category in stale}
+        if len(sent) == 1 and validators.get(stale[0]):
+            validator = validators[stale[0]]
+            if validator.get("etag"):
+                request.add_header("If-None-Match", validator["etag"])
+            if validator.get("last_modified"):
+                request.add_header("If-Modified-Since", validator["last_modified"])
+        now = time.time()
+        changed = False
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                models = json.loads(response.read())
+                validator = {
+                    "etag": response.headers.get("ETag", ""),
+                    "last_modified": response.headers.get("Last-Modified", ""),
+                }
+            categories = categorize(models)
+            for category in stale:
+                catalog["categories"][category] = categories[category]
+                validators[category] = validator
+            changed = True
+        except HTTPError as ex:
+            if ex.code != 304:
+                logger.debug(f"Unable to refresh the models: {ex}")
+                return False
+            logger.debug("Models did not change")
+        except (URLError, OSError, ValueError) as ex:
+            logger.debug(f"Unable to refresh the models: {ex}")
+            return False
+        for category in stale:
+            catalog["fetched"][category] = now
+        write_json_atomic(self.path, catalog)
+        return changed
+
+    def refresh_in_background(self) -> Optional[threading.Thread]:
+        """
+        Starts refresh in a daemon thread when some category is stale, the
+        file is replaced atomically, so an interrupted refresh leaves the
+        previous catalog in place
+        """
+        if not self.stale_categories():
+            return None
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+        self._thread = threading.Thread(
+            target=self.refresh, name="model-catalog", daemon=True
+        )
+        self._thread.start()
+        return self._thread
@@ -0,0 +1,460 @@
+# Command line runner of the AiHorde Gimp3 plugin, no GIMP needed
+#
+#   python3 -m sdhorde.cli t2i --prompt TEXT [--prompt-list FILE] -o DIR
+#   python3 -m sdhorde.cli i2i --prompt TEXT -o DIR IMAGE_OR_FOLDER...
+#   python3 -m sdhorde.cli inpaint --prompt TEXT -o DIR IMAGE_OR_FOLDER...
+#
+# Run it from the plug-in folder, or from stablehorde-gimp3 in a checkout.
+# Each prompt or image is a request to the Horde, --jobs of them are sent
+# at the same time.  The generated images are saved in the output folder,
+# a line per request tells how it went and the exit code is 1 when some
+# failed.  --estimate only tells the kudos and wait of each request.
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import argparse
+import base64
+import os
+import platform
+import re
+import shutil
+import sys
+import threading
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sdhorde.batch import output_name, read_prompt_list, row_options, write_report
+from sdhorde.cache import GenerationCache
+from sdhorde.dispatch import MAX_JOBS_IN_FLIGHT, HordeDispatcher, HordeJob
+from sdhorde.encoding import image_size
+from sdhorde.estimate import CostEstimator, KudosBudget
+from sdhorde.horde import HordeAPI
+from sdhorde.metrics import JobMetrics, MetricsSink
+from sdhorde.session import install_session
+from sdhorde.workspace import Workspaces
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+
+CLIENT_NAME = "AiHordeForGimp"
+
+HELP_URL = "https://aihorde.net/faq"
+
+URL_VERSION_UPDATE = "https://raw.githubusercontent.com/ikks/gimp-stable-diffusion/main/stablehorde/version.json"
+
+URL_DOWNLOAD = "https://github.com/ikks/gimp-stable-diffusion/releases"
+
+MODES = {
+    "t2i": "MODE_TEXT2IMG",
+    "i2i": "MODE_IMG2IMG",
+    "inpaint": "MODE_INPAINTING",
+}
+
+DEFAULT_MODELS = {
+    "t2i": "stable_diffusion",
+    "i2i": "stable_diffusion",
+    "inpaint": "stable_diffusion_inpainting",
+}
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp")
+
+API_KEY_VARIABLE = "AI_HORDE_API_KEY"
+
+
+def plugin_version() -> str:
+    try:
+        text = (PLUGIN_DIR / "gimp-stable-diffusion.py").read_text(encoding="utf-8")
+    except OSError:
+        return "unknown"
+    found = re.search(r'^VERSION = "(.+)"', text, re.MULTILINE)
+    return found.group(1) if found else "unknown"
+
+
+def load_client():
+    """
+    Imports aihordeclient from where the plug-in or a checkout keeps it
+    """
+    for folder in (PLUGIN_DIR / "module", PLUGIN_DIR / "modules/aihordeclient/src"):
+        if folder.is_dir() and str(folder) not in sys.path:
+            sys.path.append(str(folder))
+    import aihordeclient
+
+    return aihordeclient
+
+
+def informer_class(aihordeclient, quiet: bool):
+    """
+    InformerFrontend that writes the status of each request to stderr,
+    the frontend properties are shared by all the requests
+    """
+
+    class ConsoleInformer(aihordeclient.InformerFrontend):
+        properties: Dict[str, Any] = {}
+        lock = threading.Lock()
+
+        def __init__(self, label: str, workspace: Optional[Path] = None):
+            super().__init__()
+            self.label = label
+            self.workspace = workspace
+            self.last_text = ""
+            self.warnings: List[str] = []
+
+        def update_status(self, text, progress=0.0):
+            if quiet or text == self.last_text:
+                return
+            self.last_text = text
+            print(f"{self.label}: {text}", file=sys.stderr)
+
+        def set_finished(self):
+            pass
+
+        def show_error(self, message, url="", title="", buttons=0):
+            if title == "warning":
+                self.warnings.append(message)
+                return
+            raise Exception(message)
+
+        def show_message(self, message, url="", title="", buttons=0):
+            if not quiet:
+                print(f"{self.label}: {message}", file=sys.stderr)
+
+        def get_frontend_property(self, property_name):
+            with self.lock:
+                return self.properties.get(property_name, False)
+
+        def set_frontend_property(self, property_name, value):
+            with self.lock:
+                self.properties[property_name] = value
+
+        def has_asked_for_update(self):
+            # Nobody to ask on a render node
+            return True
+
+        def just_asked_for_update(self):
+            pass
+
+        def path_store_directory(self):
+            return str(self.workspace) if self.workspace is not None else None
+
+    return ConsoleInformer
+
+
+def find_images(paths: List[Path]) -> List[Path]:
+    """
+    The images given and the ones inside the folders given, in order
+    """
+    images = []
+    for path in paths:
+        if path.is_dir():
+            images.extend(
+                sorted(
+                    item
+                    for item in path.iterdir()
+                    if item.suffix.lower() in IMAGE_SUFFIXES
+                )
+            )
+        else:
+            images.append(path)
+    return images
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python3 -m sdhorde.cli",
+        description="Generate images with the AI Horde without GIMP",
+    )
+    parser.add_argument("mode", choices=sorted(MODES))
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        type=Path,
+        help="Images or folders with images, for i2i and inpaint",
+    )
+    parser.add_argument("-p", "--prompt", default="")
+    parser.add_argument(
+        "--prompt-list",
+        type=Path,
+        help="t2i: a prompt per line or a JSON object per line",
+    )
+    parser.add_argument("-o", "--output", type=Path, required=True)
+    parser.add_argument("-m", "--model")
+    parser.add_argument("--steps", type=int, default=27)
+    parser.add_argument("--cfg", type=float, default=8, help="Prompt strength")
+    parser.add_argument(
+        "--denoising", type=float, default=0.3, help="i2i: how much changes"
+    )
+    parser.add_argument("--seed", default="")
+    parser.add_argument("-n", "--nimages", type=int, default=1)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=384)
+    parser.add_argument("--nsfw", action="store_true")
+    parser.add_argument("--censor-nsfw", action="store_true")
+    parser.add_argument(
+        "--api-key",
+        default=os.environ.get(API_KEY_VARIABLE, ""),
+        help=f"Defaults to ${API_KEY_VARIABLE}, anonymous without it",
+    )
+    parser.add_argument("--max-wait", type=int, default=8, help="Minutes")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=f"Requests sent at the same time, at most {MAX_JOBS_IN_FLIGHT}",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+        / "ikks-py3-stablehorde"
+        / "generations",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Ask the Horde even with a seed"
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="Tell the kudos and the wait of each request without sending it",
+    )
+    parser.add_argument(
+        "--kudos-budget",
+        type=float,
+        default=0,
+        help="Kudos this run can spend, the requests that go over are skipped",
+    )
+    parser.add_argument("-q", "--quiet", action="store_true")
+    arguments = parser.parse_intermixed_args(argv)
+    if arguments.mode == "t2i":
+        if arguments.inputs:
+            parser.error("t2i does not take images")
+        if not arguments.prompt and arguments.prompt_list is None:
+            parser.error("t2i needs --prompt or --prompt-list")
+    else:
+        if not arguments.inputs:
+            parser.error(f"{arguments.mode} needs images or folders")
+        if not arguments.prompt:
+            parser.error(f"{arguments.mode} needs --prompt")
+    return arguments
+
+
+def base_options(arguments: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        "model": arguments.model or DEFAULT_MODELS[arguments.mode],
+        "mode": MODES[arguments.mode],
+        "init_strength": arguments.denoising,
+        "prompt_strength": arguments.cfg,
+        "steps": arguments.steps,
+        "nsfw": arguments.nsfw,
+        "censor_nsfw": arguments.censor_nsfw,
+        "api_key": arguments.api_key,
+        "max_wait_minutes": arguments.max_wait,
+        "seed": arguments.seed,
+        "nimages": arguments.nimages,
+        "image_width": arguments.width,
+        "image_height": arguments.height,
+        "prompt": arguments.prompt,
+        "source_image": "",
+    }
+
+
+def make_rows(
+    arguments: argparse.Namespace, options: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    A row per request, as the rows of a prompt list, with the images
+    read for i2i and inpaint
+    """
+    if arguments.mode == "t2i":
+        if arguments.prompt_list is not None:
+            return read_prompt_list(arguments.prompt_list)
+        return [{"line": 1, "overrides": {"prompt": arguments.prompt}, "error": ""}]
+    rows = []
+    for number, path in enumerate(find_images(arguments.inputs), 1):
+        row: Dict[str, Any] = {"line": number, "overrides": {}, "error": ""}
+        row["source"] = path
+        rows.append(row)
+        try:
+            data = path.read_bytes()
+            width, height = image_size(data)
+        except (OSError, ValueError) as ex:
+            row["error"] = str(ex)
+            continue
+        row["overrides"] = {
+            "prompt": options["prompt"],
+            "source_image": base64.b64encode(data).decode("ascii"),
+            "image_width": width,
+            "image_height": height,
+        }
+    return rows
+
+
+def save_result(
+    row: Dict[str, Any], file_names: List[str], output: Path
+) -> List[str]:
+    """
+    Moves the generated files to output, named after the source image or
+    the prompt
+    """
+    saved = []
+    for index, file_name in enumerate(file_names):
+        suffix = Path(file_name).suffix
+        if "source" in row:
+            # With the extension, image.png and image.jpg do not collide
+            target = output / f"{row['source'].name}-{index}{suffix}"
+        else:
+            target = output / output_name(row, index, suffix)
+        shutil.move(file_name, target)
+        saved.append(str(target))
+    return saved
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    arguments = parse_arguments(argv)
+    try:
+        aihordeclient = load_client()
+    except ImportError as ex:
+        print(f"aihordeclient is not available: {ex}", file=sys.stderr)
+        return 2
+    arguments.output.mkdir(parents=True, exist_ok=True)
+    options = base_options(arguments)
+    rows = make_rows(arguments, options)
+    cache = None
+    if not arguments.no_cache:
+        try:
+            cache = GenerationCache(arguments.cache_dir)
+        except OSError as ex:
+            print(f"The cache is not available: {ex}", file=sys.stderr)
+
+    version = plugin_version()
+    base_info = "-_".join(
+        [
+            CLIENT_NAME,
+            version,
+            platform.system(),
+            platform.python_version(),
+            "cli",
+            platform.machine(),
+        ]
+    )
+
+    ConsoleInformer = informer_class(aihordeclient, arguments.quiet)
+
+    def run_job(job: HordeJob) -> List[str]:
+        row = job.context
+        client = aihordeclient.AiHordeClient(
+            version,
+            URL_VERSION_UPDATE,
+            HELP_URL,
+            URL_DOWNLOAD,
+            job.options,
+            base_info,
+            ConsoleInformer(f"#{row['line']}", workspaces.new(f"row{row['line']}")),
+        )
+        job.metrics = JobMetrics(job.index, job.options["model"])
+        if metrics is None:
+            file_names = client.generate_image(job.options)
+        else:
+            with metrics.bind(job.metrics):
+                file_names = client.generate_image(job.options)
+        row["description"] = client.get_full_description()
+        return file_names
+
+    session = install_session()
+    metrics = None
+    try:
+        metrics = MetricsSink(arguments.cache_dir.parent / "metrics")
+        session.listeners.append(metrics.observe)
+    except OSError as ex:
+        print(f"The metrics are not recorded: {ex}", file=sys.stderr)
+    # Each request downloads to a folder of its own, parallel runs of the
+    # command never share files
+    workspaces = Workspaces()
+    dispatcher = HordeDispatcher(run_job, arguments.jobs)
+    estimator = None
+    if arguments.estimate or arguments.kudos_budget:
+        estimator = CostEstimator(
+            arguments.cache_dir.parent,
+            HordeAPI(
+                arguments.api_key,
+                client_agent=f"{CLIENT_NAME}:{version}:{URL_DOWNLOAD}",
+            ),
+        )
+    budget = KudosBudget(arguments.kudos_budget)
+    for row in rows:
+        row["files"] = []
+        if row["error"]:
+            row["status"] = "invalid"
+            continue
+        settings = row_options(options, row)
+        row["model"] = settings["model"]
+        row["seed"] = settings["seed"]
+        key = cache.key_for(settings) if cache is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            row["status"] = "cached"
+            row["files"] = save_result(row, cached["files"], arguments.output)
+            continue
+        if estimator is not None:
+            estimate = estimator.estimate(settings)
+            summary = f"about {round(estimate.kudos)} kudos"
+            if estimate.workers == 0:
+                summary += ", no worker serves the model"
+            elif estimate.wait is not None:
+                summary += f", ready in about {round(estimate.wait / 60)} minutes"
+            if arguments.estimate:
+                row["status"] = "estimate"
+                row["error"] = summary
+                continue
+            remaining = budget.remaining()
+            if remaining is not None and estimate.kudos > remaining:
+                row["status"] = "skipped"
+                row["error"] = f"Over the budget, {summary}"
+                continue
+            budget.charge(estimate.kudos)
+        row["key"] = key
+        dispatcher.add_job(settings).context = row
+
+    try:
+        for job in dispatcher.as_completed():
+            row = job.context
+            if metrics is not None and job.metrics is not None:
+                metrics.record(job.metrics, "failed" if job.error else "done")
+            if job.error is not None:
+                row["status"] = "failed"
+                row["error"] = str(job.error)
+                continue
+            row["status"] = "done"
+            if row["key"] is not None:
+                writer = cache.writer(row["key"])
+                writer.add(job.result)
+                writer.commit(
+                    {
+                        "model": row["model"],
+                        "prompt": row["overrides"]["prompt"],
+                        "description": row["description"],
+                    }
+                )
+            row["files"] = save_result(row, job.result, arguments.output)
+    finally:
+        session.close_all()
+        workspaces.close()
+
+    for row in rows:
+        name = str(row.get("source", row["overrides"].get("prompt", "")))
+        detail = " ".join(row["files"]) or row["error"]
+        print(f"{row['line']:4d} {row['status']:8} {name}: {detail}")
+    if arguments.prompt_list is not None:
+        write_report(
+            arguments.output / f"{arguments.prompt_list.stem}-report.csv", rows
+        )
+    return (
+        1
+        if any(row["status"] in ("failed", "invalid", "skipped") for row in rows)
+        else 0
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# Concurrent Horde jobs for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import logging
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_JOBS_IN_FLIGHT = 5
+"""
+Upper limit of simultaneous requests sent to the Horde by a single run
+"""
+
+REFRESH_EACH = 0.5
+"""
+Seconds between progress reports while jobs are running
+"""
+
+
+def split_count(total: int, parts: int) -> List[int]:
+    """
+    Splits total images in at most parts chunks as even as possible,
+    split_count(10, 3) is [4, 3, 3]
+    """
+    parts = max(1, min(parts, total))
+    base, extra = divmod(total, parts)
+    return [base + 1 if i < extra else base for i in range(parts)]
+
+
+def split_options(options: Dict[str, Any], parts: int) -> List[Dict[str, Any]]:
+    """
+    Returns a copy of options for each chunk of options["nimages"].  When
+    a numeric seed is given, each chunk starts where the previous one
+    would have continued, so that the images are not repeated.
+    """
+    chunks = []
+    offset = 0
+    for count in split_count(options["nimages"], parts):
+        chunk = dict(options)
+        chunk["nimages"] = count
+        seed = str(options.get("seed", "")).strip()
+        if offset and seed.isdigit():
+            chunk["seed"] = str(int(seed) + offset)
+        chunks.append(chunk)
+        offset += count
+    return chunks
+
+
+class HordeJob:
+    """
+    One request sent to the Horde, tracked on its own
+    """
+
+    def __init__(self, index: int, options: Dict[str, Any]):
+        self.index = index
+        self.options = options
+        self.status_text: str = ""
+        self.progress: float = 0.0
+        self.result: Optional[List[str]] = None
+        self.error: Optional[BaseException] = None
+        self.context: Any = None
+        """
+        Whatever the runner wants to keep, like the client used
+        """
+        self.future: Optional[Future] = None
+        self.metrics: Any = None
+        """
+        JobMetrics of the request, when they are recorded
+        """
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None or self.error is not None
+
+    def report(self, text: str, progress: float = 0.0) -> None:
+        """
+        Called by the runner, from any thread, to tell how the job goes
+        """
+        self.status_text = text
+        self.progress = progress
+
+
+class HordeDispatcher:
+    """
+    Sends several Horde requests at the same time, each one handled by
+    run_job(job), which returns the list of generated files.  At most
+    max_in_flight jobs run at the same time.  With max_in_flight 1 the
+    jobs run one after the other in the calling thread.
+
+    on_progress(jobs) is called from the calling thread while waiting,
+    it's the place to update the UI.
+    """
+
+    def __init__(
+        self,
+        run_job: Callable[[HordeJob], List[str]],
+        max_in_flight: int = 1,
+        on_progress: Optional[Callable[[List[HordeJob]], None]] = None,
+    ):
+        self.run_job = run_job
+        self.max_in_flight = max(1, min(max_in_flight, MAX_JOBS_IN_FLIGHT))
+        self.on_progress = on_progress
+        self.jobs: List[HordeJob] = []
+        self._lock = threading.Lock()
+
+    def add_jobs(self, options: Dict[str, Any], parts: int) -> List[HordeJob]:
+        """
+        Splits options in parts requests and queues them
+        """
+        with self._lock:
+            start = len(self.jobs)
+            jobs = [
+                HordeJob(start + i, chunk)
+                for i, chunk in enumerate(split_options(options, parts))
+            ]
+            self.jobs.extend(jobs)
+        return jobs
+
+    def add_job(self, options: Dict[str, Any]) -> HordeJob:
+        """
+        Queues a request with options as they are
+        """
+        with self._lock:
+            job = HordeJob(len(self.jobs), options)
+            self.jobs.append(job)
+        return job
+
+    def _execute(self, job: HordeJob) -> List[str]:
+        try:
+            job.result = self.run_job(job) or []
+        except Exception as ex:
+            logger.debug(f"Job {job.index} failed: {ex}")
+            job.error = ex
+            raise
+        return job.result
+
+    def _progress(self) -> None:
+        if self.on_progress is not None:
+            self.on_progress(self.jobs)
+
+    def as_completed(self) -> Iterator[HordeJob]:
+        """
+        Runs all the queued jobs and yields each one, in the calling
+        thread, as soon as it finishes.  Each job holds its result or its
+        error.
+        """
+        pending = [job for job in self.jobs if not job.done]
+        if self.max_in_flight == 1 or len(pending) == 1:
+            for job in pending:
+                try:
+                    self._execute(job)
+                except Exception:
+                    pass
+                self._progress()
+                yield job
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            futures = {}
+            for job in pending:
+                job.future = executor.submit(self._execute, job)
+                futures[job.future] = job
+            while futures:
+                finished, _ = wait(
+                    futures, timeout=REFRESH_EACH, return_when=FIRST_COMPLETED
+                )
+                self._progress()
+                for future in finished:
+                    yield futures.pop(future)
+        finally:
+            executor.shutdown(wait=True)
+
+    def run(self) -> List[HordeJob]:
+        """
+        Runs all the queued jobs and returns them once all have finished
+        """
+        for _ in self.as_completed():
+            pass
+        return self.jobs
+
+    def results(self) -> List[str]:
+        """
+        Files of all the successful jobs, in the order the jobs were added
+        """
+        files: List[str] = []
+        for job in self.jobs:
+            if job.result:
+                files.extend(job.result)
+        return files
+
+    def errors(self) -> List[BaseException]:
+        return [job.error for job in self.jobs if job.error is not None]
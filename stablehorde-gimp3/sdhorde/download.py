@@ -0,0 +1,215 @@
+# Parallel downloads of the generated images for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.error import HTTPError, URLError
+from urllib.request import BaseHandler
+
+logger = logging.getLogger(__name__)
+
+MAX_DOWNLOADS = 4
+"""
+Images downloaded at the same time
+"""
+
+CHUNK_SIZE = 64 * 1024
+"""
+Bytes read and written at a time, the image is never held whole in
+memory
+"""
+
+MAX_ATTEMPTS = 4
+
+RETRY_WAIT = 1
+"""
+Seconds before the first retry, it doubles each time
+"""
+
+DOWNLOAD_TIMEOUT = 60
+
+PROGRESS_EACH = 0.2
+"""
+Seconds between progress reports while waiting for the downloads
+"""
+
+
+class BandwidthLimit:
+    """
+    Bytes per second shared by all the downloads, each chunk waits until
+    the downloads are back under the limit
+    """
+
+    def __init__(self, bytes_per_second: float):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._free_at = time.monotonic()
+
+    def take(self, amount: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._free_at = max(self._free_at, now) + amount / self.bytes_per_second
+            delay = self._free_at - now - 1.0
+        # A second of burst is allowed, the rest waits
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Downloader:
+    """
+    Downloads urls to files, max_downloads at the same time.  Each one is
+    streamed to disk in chunks, a dropped transfer is retried asking for
+    the bytes missing with a Range request.  bytes_per_second caps all of
+    them together, 0 is no cap.  on_progress(received, expected) is
+    called from the thread that calls fetch_all, expected is 0 while the
+    sizes are unknown.  on_request has the signature of the one of
+    HordeAPI, with kind download.
+
+    The transfers do not go through the keep-alive session, that one reads
+    whole bodies, each download has its own connection.
+    """
+
+    def __init__(
+        self,
+        max_downloads: int = MAX_DOWNLOADS,
+        bytes_per_second: float = 0,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        on_request: Optional[Callable[[str, float, int, int], None]] = None,
+        extra_handlers: Sequence[BaseHandler] = (),
+    ):
+        self.max_downloads = max(1, max_downloads)
+        self.limit = BandwidthLimit(bytes_per_second) if bytes_per_second else None
+        self.on_progress = on_progress
+        self.on_request = on_request
+        self.opener = urllib.request.build_opener(*extra_handlers)
+        self._lock = threading.Lock()
+        self.received = 0
+        self._sizes: Dict[Path, int] = {}
+
+    @property
+    def expected(self) -> int:
+        """
+        Bytes of the downloads whose size is known
+        """
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def _add(self, received: int) -> None:
+        with self._lock:
+            self.received += received
+
+    def _transfer(self, url: str, partial: Path) -> None:
+        """
+        Appends to partial what is missing of url, from the start when
+        the server ignores the Range asked
+        """
+        offset = partial.stat().st_size if partial.exists() else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        with self.opener.open(request, timeout=DOWNLOAD_TIMEOUT) as response:
+            if offset and response.status != 206:
+                self._add(-offset)
+                offset = 0
+            length = response.headers.get("Content-Length")
+            if length is not None:
+                with self._lock:
+                    self._sizes[partial] = offset + int(length)
+            received = 0
+            with open(partial, "ab" if offset else "wb") as stream:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if self.limit is not None:
+                        self.limit.take(len(chunk))
+                    stream.write(chunk)
+                    received += len(chunk)
+                    self._add(len(chunk))
+        if length is not None and received < int(length):
+            # The connection dropped, what arrived is kept for the retry
+            raise URLError(f"{url} ended after {offset + received} bytes")
+
+    def fetch(self, url: str, path: Path) -> Path:
+        """
+        Downloads url to path, retrying MAX_ATTEMPTS times
+        """
+        path = Path(path)
+        partial = path.with_name(path.name + ".part")
+        start = time.perf_counter()
+        wait = RETRY_WAIT
+        try:
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    self._transfer(url, partial)
+                    break
+                except HTTPError as ex:
+                    if ex.code == 416:
+                        # The bytes kept do not match, start over
+                        self._add(-partial.stat().st_size)
+                        partial.unlink()
+                    elif ex.code < 500 and ex.code not in (408, 429):
+                        # The request itself is wrong, trying again changes nothing
+                        raise
+                    if attempt == MAX_ATTEMPTS:
+                        raise
+                    logger.debug(f"Download of {url} failed, retrying: {ex}")
+                except (URLError, OSError) as ex:
+                    if attempt == MAX_ATTEMPTS:
+                        raise
+                    logger.debug(f"Download of {url} failed, retrying: {ex}")
+                time.sleep(wait)
+                wait *= 2
+            os.replace(partial, path)
+        except BaseException:
+            try:
+                os.unlink(partial)
+            except OSError:
+                pass
+            raise
+        finally:
+            if self.on_request is not None:
+                size = path.stat().st_size if path.exists() else 0
+                self.on_request("download", time.perf_counter() - start, 0, size)
+        return path
+
+    def fetch_all(self, targets: List[Tuple[str, Path]]) -> List[Path]:
+        """
+        Downloads each url to its path, returns the paths in the same
+        order.  When some fail, the rest are still finished, the files
+        downloaded are removed and the first error is raised.
+        """
+        if not targets:
+            return []
+        with self._lock:
+            self.received = 0
+            self._sizes = {}
+        with ThreadPoolExecutor(
+            min(self.max_downloads, len(targets)), thread_name_prefix="download"
+        ) as executor:
+            futures = [executor.submit(self.fetch, url, path) for url, path in targets]
+            while not all(future.done() for future in futures):
+                if self.on_progress is not None:
+                    self.on_progress(self.received, self.expected)
+                time.sleep(PROGRESS_EACH)
+        if self.on_progress is not None:
+            self.on_progress(self.received, self.expected)
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            for future in futures:
+                if future.exception() is None:
+                    try:
+                        os.unlink(future.result())
+                    except OSError:
+                        pass
+            raise errors[0]
+        return [future.result() for future in futures]
@@ -0,0 +1,200 @@
+# Image encoding for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import struct
+import zlib
+
+from typing import Optional, Tuple
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+"""
+PNG color type for each number of 8 bit channels: gray, gray with
+alpha, RGB and RGBA
+"""
+
+UPLOAD_FORMATS = ["png", "webp-lossless", "webp", "jpeg"]
+"""
+Formats to send the source images, the lossy ones are the smallest
+"""
+
+PNG_LEVELS = [
+    (8 * 1024 * 1024, 1),
+    (2 * 1024 * 1024, 3),
+    (512 * 1024, 6),
+]
+"""
+zlib level for uploads of at least these bytes per second, slower
+links get 9.  On fast links compressing harder takes longer than
+sending the bytes saved.
+"""
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    )
+
+
+class _RowFilter:
+    """
+    The five PNG filters of a row of stride bytes, choosing the one whose
+    bytes, taken as signed, add up the least.  Each byte of a row is a
+    16 bit lane of a Python int, so that the filters are computed for
+    the whole row at once without carrying from one byte to the next.
+    """
+
+    def __init__(self, stride: int, channels: int):
+        self.stride = stride
+        self.shift = 16 * channels
+        """
+        Bits from a byte to the one of the pixel at its left
+        """
+        self.full = (1 << (16 * stride)) - 1
+        self.one = int.from_bytes(b"\x00\x01" * stride, "big")
+        self.low = self.one * 0xFF
+        self.bit8 = self.one << 8
+        self.bit10 = self.one << 10
+        # Every other lane, to add them in pairs without overflowing
+        self.pairs = int.from_bytes(
+            (b"\x00\x00\xff\xff" * ((stride + 1) // 2))[-2 * stride :], "big"
+        )
+
+    def widen(self, row: bytes) -> int:
+        wide = bytearray(2 * self.stride)
+        wide[1::2] = row
+        return int.from_bytes(wide, "big")
+
+    def _at_least(self, x: int, y: int) -> int:
+        """
+        All bits set in the lanes where x >= y, both under 1024
+        """
+        return (((x + self.bit10 - y) >> 10) & self.one) * 0xFFFF
+
+    def _distance(self, x: int, y: int) -> int:
+        bigger = self._at_least(x, y)
+        smaller = bigger ^ self.full
+        return ((x & bigger) | (y & smaller)) - ((y & bigger) | (x & smaller))
+
+    def _cost(self, filtered: int) -> int:
+        negated = self.bit8 - filtered
+        bigger = self._at_least(filtered, negated)
+        magnitude = (negated & bigger) | (filtered & (bigger ^ self.full))
+        pairs = (magnitude & self.pairs) + ((magnitude >> 16) & self.pairs)
+        # The 32 bit words add up modulo 2**32 - 1, and never reach it
+        return pairs % 0xFFFFFFFF
+
+    def apply(self, row: int, above: int) -> bytes:
+        """
+        Filter type and filtered bytes of row, both rows widened
+        """
+        left = row >> self.shift
+        corner = above >> self.shift
+        # Paeth predicts with the neighbour closest to left + above - corner
+        to_left = self._distance(above, corner)
+        to_above = self._distance(left, corner)
+        to_corner = self._distance(left + above, corner << 1)
+        use_left = self._at_least(to_above, to_left) & self._at_least(
+            to_corner, to_left
+        )
+        use_above = (use_left ^ self.full) & self._at_least(to_corner, to_above)
+        use_corner = (use_left | use_above) ^ self.full
+        paeth = (left & use_left) | (above & use_above) | (corner & use_corner)
+        shifted = row + self.bit8
+        candidates = [
+            row,
+            (shifted - left) & self.low,
+            (shifted - above) & self.low,
+            (shifted - (((left + above) >> 1) & self.low)) & self.low,
+            (shifted - paeth) & self.low,
+        ]
+        costs = [self._cost(candidate) for candidate in candidates]
+        kind = costs.index(min(costs))
+        return bytes((kind,)) + candidates[kind].to_bytes(2 * self.stride, "big")[1::2]
+
+
+def encode_png(
+    pixels: bytes, width: int, height: int, channels: int = 4, level: int = 6
+) -> bytes:
+    """
+    Returns a PNG with the 8 bit pixels given, rows top to bottom without
+    padding, so the image never needs to touch the disk.  Each row goes
+    with the filter that suits it, as libpng does.
+    """
+    if channels not in PNG_COLOR_TYPES:
+        raise ValueError(f"PNG can not hold {channels} channels")
+    stride = width * channels
+    if len(pixels) != stride * height:
+        raise ValueError(
+            f"Expected {stride * height} bytes for {width}x{height}, got {len(pixels)}"
+        )
+    header = struct.pack(
+        ">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0
+    )
+    rows = _RowFilter(stride, channels)
+    filtered = []
+    above = 0
+    for offset in range(0, stride * height, stride):
+        row = rows.widen(pixels[offset : offset + stride])
+        filtered.append(rows.apply(row, above))
+        above = row
+    raw = b"".join(filtered)
+    return (
+        PNG_SIGNATURE
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(raw, level))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def image_size(data: bytes) -> Tuple[int, int]:
+    """
+    Width and height of a PNG, JPEG or WebP image, read from its header.
+    Raises ValueError for other formats.
+    """
+    if data.startswith(PNG_SIGNATURE):
+        return struct.unpack(">II", data[16:24])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        kind = data[12:16]
+        if kind == b"VP8X":
+            return (
+                1 + int.from_bytes(data[24:27], "little"),
+                1 + int.from_bytes(data[27:30], "little"),
+            )
+        if kind == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if kind == b"VP8 ":
+            return (
+                int.from_bytes(data[26:28], "little") & 0x3FFF,
+                int.from_bytes(data[28:30], "little") & 0x3FFF,
+            )
+    if data[:2] == b"\xff\xd8":
+        offset = 2
+        while offset + 9 <= len(data) and data[offset] == 0xFF:
+            marker = data[offset + 1]
+            # Start of frame, except the huffman and arithmetic tables
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[offset + 5 : offset + 9])
+                return width, height
+            offset += 2 + struct.unpack(">H", data[offset + 2 : offset + 4])[0]
+    raise ValueError("Only PNG, JPEG and WebP images are supported")
+
+
+def png_level(bytes_per_second: Optional[float]) -> int:
+    """
+    zlib level for a PNG to be sent at bytes_per_second, 6 when the speed
+    is unknown
+    """
+    if bytes_per_second is None:
+        return 6
+    for speed, level in PNG_LEVELS:
+        if bytes_per_second >= speed:
+            return level
+    return 9
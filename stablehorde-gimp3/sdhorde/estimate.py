@@ -0,0 +1,241 @@
+# Kudos and wait estimates for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import json
+import logging
+import math
+import time
+
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+from urllib.error import URLError
+
+from sdhorde.cache import FileLock, write_json_atomic
+from sdhorde.horde import HordeAPI, HordeError, build_payload
+
+logger = logging.getLogger(__name__)
+
+COSTS_FILE = "costs.json"
+
+BUDGET_FILE = "kudos.json"
+
+KUDOS_PER_MEGAPIXELSTEP = 1.3
+"""
+Kudos charged per million pixels and step of each image, until the
+Horde has been asked
+"""
+
+COST_WEIGHT = 0.3
+"""
+Weight of a new dry run in the kudos per megapixelstep remembered
+"""
+
+MODELS_TTL = 5 * 60
+"""
+Seconds the queue of the models is considered fresh, it changes fast
+"""
+
+MIN_STEPS = 10
+"""
+Fewest steps left when scaling a request down, fewer give noise
+"""
+
+OVER_BUDGET = ("warn", "block", "scale")
+"""
+What to do with a request that does not fit the kudos left
+"""
+
+
+class Estimate(NamedTuple):
+    """
+    What a request is expected to cost.  wait is the seconds until it is
+    done, None when the queue is unknown, workers is None as well then.
+    source is horde when the kudos come from a dry run, local when they
+    come from the cost remembered.
+    """
+
+    kudos: float
+    wait: Optional[float]
+    workers: Optional[int]
+    source: str
+
+
+def megapixelsteps(options: Dict[str, Any]) -> float:
+    """
+    Work of the request of options, the unit the Horde measures it with
+    """
+    return (
+        options["image_width"]
+        * options["image_height"]
+        * options["steps"]
+        * options["nimages"]
+        / 1_000_000
+    )
+
+
+def scale_down(
+    options: Dict[str, Any], kudos: float, allowed: float
+) -> Optional[Dict[str, Any]]:
+    """
+    A copy of options expected to cost at most allowed, knowing that
+    options cost kudos.  Fewer images are asked first, then fewer steps,
+    the size is kept because the result has to fit the image.  None when
+    even an image with MIN_STEPS costs more.
+    """
+    if kudos <= allowed:
+        return dict(options)
+    if allowed <= 0:
+        return None
+    per_image = kudos / options["nimages"]
+    nimages = min(options["nimages"], int(allowed // per_image))
+    if nimages >= 1:
+        return dict(options, nimages=nimages)
+    steps = int(options["steps"] * allowed / per_image)
+    if steps < MIN_STEPS:
+        return None
+    return dict(options, nimages=1, steps=steps)
+
+
+class CostEstimator:
+    """
+    Estimates kudos and wait of a request before sending it.  The kudos
+    are asked to the Horde with a dry run, each answer teaches the kudos
+    per megapixelstep kept in directory, which is used when the Horde
+    can not be reached.  The wait comes from the queue and speed of the
+    model, fetched at most each MODELS_TTL.
+    """
+
+    def __init__(self, directory: Path, api: HordeAPI):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.api = api
+
+    @property
+    def path(self) -> Path:
+        return self.directory / COSTS_FILE
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {
+                "kudos_per_megapixelstep": KUDOS_PER_MEGAPIXELSTEP,
+                "models": {},
+                "fetched": 0,
+            }
+
+    def _save(self, costs: Dict[str, Any]) -> None:
+        try:
+            write_json_atomic(self.path, costs)
+        except OSError as ex:
+            logger.debug(f"Unable to save the costs: {ex}")
+
+    def kudos(self, options: Dict[str, Any]) -> Tuple[float, str]:
+        """
+        Kudos of options and where they come from
+        """
+        work = megapixelsteps(options)
+        # The cost depends on how the source is processed, not on the
+        # source itself, which is not uploaded
+        payload = build_payload(dict(options, source_image="-"))
+        payload.pop("source_image", None)
+        try:
+            kudos = self.api.dry_run(payload)
+        except (HordeError, URLError, OSError, ValueError) as ex:
+            logger.debug(f"Dry run failed, using the cost remembered: {ex}")
+            return work * self.load()["kudos_per_megapixelstep"], "local"
+        if work > 0 and kudos > 0:
+            costs = self.load()
+            costs["kudos_per_megapixelstep"] += COST_WEIGHT * (
+                kudos / work - costs["kudos_per_megapixelstep"]
+            )
+            self._save(costs)
+        return kudos, "horde"
+
+    def model_status(self, model: str) -> Optional[Dict[str, Any]]:
+        """
+        Queue of model as the Horde reported it, None when unknown
+        """
+        costs = self.load()
+        if time.time() - costs["fetched"] > MODELS_TTL:
+            try:
+                costs["models"] = {
+                    item["name"]: {
+                        "count": item.get("count", 0),
+                        "eta": item.get("eta", 0) or 0,
+                        "performance": item.get("performance", 0) or 0,
+                    }
+                    for item in self.api.models()
+                    if item.get("name")
+                }
+                costs["fetched"] = time.time()
+                self._save(costs)
+            except (HordeError, URLError, OSError, ValueError) as ex:
+                logger.debug(f"Unable to fetch the queue of the models: {ex}")
+        return costs["models"].get(model)
+
+    def estimate(self, options: Dict[str, Any]) -> Estimate:
+        kudos, source = self.kudos(options)
+        status = self.model_status(options["model"])
+        if status is None:
+            return Estimate(kudos, None, None, source)
+        if not status["count"]:
+            # Nobody serves the model, it would never finish
+            return Estimate(kudos, math.inf, 0, source)
+        wait = float(status["eta"])
+        if status["performance"] > 0:
+            wait += megapixelsteps(options) / status["performance"]
+        return Estimate(kudos, wait, status["count"], source)
+
+
+class KudosBudget:
+    """
+    Kudos that can be spent, limit 0 is no limit.  With a path, the
+    kudos spent are the ones of today, shared by all the Gimp processes,
+    without it the ones of this session.
+    """
+
+    def __init__(self, limit: float, path: Optional[Path] = None):
+        self.limit = limit
+        self.path = Path(path) if path is not None else None
+        self._spent = 0.0
+
+    def _today(self) -> Dict[str, Any]:
+        today = date.today().isoformat()
+        try:
+            with open(self.path, encoding="utf-8") as stream:
+                data = json.load(stream)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("date") != today:
+            data = {"date": today, "spent": 0.0}
+        return data
+
+    def spent(self) -> float:
+        if self.path is None:
+            return self._spent
+        return self._today()["spent"]
+
+    def remaining(self) -> Optional[float]:
+        """
+        Kudos left, None when there is no limit
+        """
+        if not self.limit:
+            return None
+        return max(0.0, self.limit - self.spent())
+
+    def charge(self, kudos: float) -> None:
+        if self.path is None:
+            self._spent += kudos
+            return
+        try:
+            with FileLock(self.path.with_suffix(".lock")):
+                data = self._today()
+                data["spent"] += kudos
+                write_json_atomic(self.path, data)
+        except OSError as ex:
+            logger.debug(f"Unable to record the kudos spent: {ex}")
@@ -0,0 +1,232 @@
+# AI Horde API for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import json
+import logging
+import time
+import urllib.request
+
+from typing import Any, Callable, Dict, List, Optional
+from urllib.error import HTTPError, URLError
+
+logger = logging.getLogger(__name__)
+
+API_ROOT = "https://aihorde.net/api/v2/"
+
+ANONYMOUS_KEY = "0000000000"
+
+MIN_CHECK_WAIT = 1
+"""
+Seconds between checks once a worker is generating
+"""
+
+MAX_CHECK_WAIT = 30
+
+ERROR_CHECK_WAIT = 2
+"""
+First wait after the Horde could not be reached, it doubles each time
+"""
+
+MAX_CHECK_ERRORS = 5
+
+REQUEST_TIMEOUT = 60
+
+SOURCE_PROCESSING = {
+    "MODE_IMG2IMG": "img2img",
+    "MODE_INPAINTING": "inpainting",
+}
+
+
+class HordeError(Exception):
+    """
+    The Horde refused or could not finish a request, code is the HTTP
+    status when the Horde answered with an error
+    """
+
+    def __init__(self, message: str, code: Optional[int] = None):
+        super().__init__(message)
+        self.code = code
+
+
+def build_payload(options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Body of generate/async for the options used by the plugin
+    """
+    params = {
+        "cfg_scale": options["prompt_strength"],
+        "steps": options["steps"],
+        "n": options["nimages"],
+        # Models work with sides multiple of 64
+        "width": options["image_width"] // 64 * 64,
+        "height": options["image_height"] // 64 * 64,
+    }
+    seed = str(options.get("seed", "")).strip()
+    if seed:
+        params["seed"] = seed
+    payload = {
+        "prompt": options["prompt"],
+        "params": params,
+        "nsfw": options["nsfw"],
+        "censor_nsfw": options["censor_nsfw"],
+        "models": [options["model"]],
+        "r2": True,
+    }
+    mode = options.get("mode", "")
+    if mode in SOURCE_PROCESSING and options.get("source_image"):
+        payload["source_image"] = options["source_image"]
+        payload["source_processing"] = SOURCE_PROCESSING[mode]
+        if mode == "MODE_IMG2IMG":
+            params["denoising_strength"] = options["init_strength"]
+    return payload
+
+
+def next_check_delay(data: Dict[str, Any], errors: int = 0) -> float:
+    """
+    Seconds to wait before checking again a request, following what the
+    Horde reported in data
+    """
+    if errors > 0:
+        return min(MAX_CHECK_WAIT, ERROR_CHECK_WAIT * (2 ** (errors - 1)))
+    # A worker is already generating, finish is close
+    if data.get("processing", 0) > 0 or data.get("finished", 0) > 0:
+        return MIN_CHECK_WAIT
+    wait_time = data.get("wait_time", 0) or 0
+    return max(MIN_CHECK_WAIT, min(MAX_CHECK_WAIT, wait_time / 2.0))
+
+
+class HordeAPI:
+    """
+    Requests to the AI Horde, the connections are the ones of the
+    installed session.  on_request(kind, seconds, sent, received) is
+    called after each request, kind is submit, estimate, check, status,
+    models or download.
+    """
+
+    def __init__(
+        self,
+        api_key: str = ANONYMOUS_KEY,
+        api_root: str = API_ROOT,
+        client_agent: str = "",
+        on_request: Optional[Callable[[str, float, int, int], None]] = None,
+    ):
+        self.api_key = api_key or ANONYMOUS_KEY
+        self.api_root = api_root
+        self.client_agent = client_agent
+        self.on_request = on_request
+
+    def _open(self, kind: str, url: str, body: Optional[bytes] = None) -> bytes:
+        headers = {"Accept": "application/json", "apikey": self.api_key}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        if self.client_agent:
+            headers["Client-Agent"] = self.client_agent
+        request = urllib.request.Request(url, data=body, headers=headers)
+        start = time.perf_counter()
+        data = b""
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                data = response.read()
+        except HTTPError as ex:
+            data = ex.read()
+            message = str(ex)
+            try:
+                message = json.loads(data).get("message", message)
+            except ValueError:
+                pass
+            raise HordeError(message, ex.code) from ex
+        finally:
+            if self.on_request is not None:
+                self.on_request(
+                    kind, time.perf_counter() - start, len(body or b""), len(data)
+                )
+        return data
+
+    def _json(self, kind: str, url: str, payload: Optional[Dict] = None) -> Dict:
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode("utf-8")
+        return json.loads(self._open(kind, url, body))
+
+    def submit(self, payload: Dict[str, Any]) -> str:
+        """
+        Queues a generation, returns its id
+        """
+        data = self._json("submit", self.api_root + "generate/async", payload)
+        if "id" not in data:
+            raise HordeError(
+                data.get("message", "The Horde did not accept the request")
+            )
+        return data["id"]
+
+    def dry_run(self, payload: Dict[str, Any]) -> float:
+        """
+        Kudos the Horde would charge for payload, nothing is queued
+        """
+        data = self._json(
+            "estimate", self.api_root + "generate/async", dict(payload, dry_run=True)
+        )
+        if "kudos" not in data:
+            raise HordeError(data.get("message", "The Horde did not estimate the cost"))
+        return float(data["kudos"])
+
+    def models(self) -> List[Dict[str, Any]]:
+        """
+        Workers, queue and speed of each image model
+        """
+        return json.loads(
+            self._open("models", self.api_root + "status/models?type=image")
+        )
+
+    def check(self, job_id: str) -> Dict[str, Any]:
+        return self._json("check", self.api_root + "generate/check/" + job_id)
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        return self._json("status", self.api_root + "generate/status/" + job_id)
+
+    def download(self, url: str) -> bytes:
+        return self._open("download", url)
+
+    def status_url(self, job_id: str) -> str:
+        return self.api_root + "generate/status/" + job_id
+
+    def wait(
+        self,
+        job_id: str,
+        max_wait: float,
+        on_status: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Checks job_id following the wait time reported by the Horde until
+        it is done, returns the last check.  Raises HordeError when it
+        faults, is impossible, or takes longer than max_wait seconds.
+        """
+        deadline = time.monotonic() + max_wait
+        errors = 0
+        data: Dict[str, Any] = {}
+        while True:
+            try:
+                data = self.check(job_id)
+                errors = 0
+            except (URLError, HordeError) as ex:
+                errors += 1
+                logger.debug(f"Check of {job_id} failed: {ex}")
+                if errors >= MAX_CHECK_ERRORS:
+                    raise HordeError(f"The Horde can not be reached: {ex}") from ex
+            if on_status is not None and data:
+                on_status(data)
+            if data.get("faulted"):
+                raise HordeError("The Horde could not generate the image")
+            if data.get("is_possible") is False:
+                raise HordeError("No worker can generate with these options")
+            if data.get("done"):
+                return data
+            delay = next_check_delay(data, errors)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise HordeError(f"Timeout waiting for {self.status_url(job_id)}")
+            time.sleep(min(delay, remaining))
+
+    def generations(self, job_id: str) -> List[Dict[str, Any]]:
+        return self.status(job_id).get("generations", [])
@@ -0,0 +1,164 @@
+# Requests in flight for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import json
+import logging
+import os
+import shutil
+import time
+
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from sdhorde.cache import META_FILE, CacheEntryWriter, copy_entry, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+CHECK_EACH = 1.0
+"""
+Seconds between looks at a request sent by someone else
+"""
+
+KEEP_RESULTS = 120
+"""
+Seconds the results of a request stay for the ones that were waiting
+for it
+"""
+
+KEEP_STAGING = 24 * 60 * 60
+"""
+Seconds after which the images of a request never published are removed
+"""
+
+
+def process_alive(pid: int) -> bool:
+    """
+    False only when it is sure the process pid is gone
+    """
+    if os.name != "posix":
+        # On Windows signal 0 would interrupt the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class InFlightRegistry:
+    """
+    Requests sent to the Horde and not finished yet, shared by all the
+    Gimp processes through files in directory.  The first one sending a
+    request leads it, the ones sending an identical request meanwhile
+    wait and get a copy of the same images instead of paying again.
+
+    For each request key there is key.json while it is in flight and a
+    key directory with the images once published.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _marker(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def entry_path(self, key: str) -> Path:
+        return self.directory / key
+
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._marker(key), encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return None
+
+    def _expired(self, marker: Dict[str, Any]) -> bool:
+        return marker.get("deadline", 0) < time.time() or not process_alive(
+            marker.get("pid", 0)
+        )
+
+    def lead(self, key: str, max_wait: float) -> bool:
+        """
+        Registers the request as in flight by this process.  False when an
+        identical request is already in flight or has just been published,
+        then wait for it.
+        """
+        self.evict()
+        if (self.entry_path(key) / META_FILE).exists():
+            return False
+        marker = {"pid": os.getpid(), "deadline": time.time() + max_wait}
+        try:
+            descriptor = os.open(
+                self._marker(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+            )
+        except FileExistsError:
+            current = self._read(key)
+            if current is not None and not self._expired(current):
+                return False
+            logger.debug(f"Taking over the abandoned request {key}")
+            write_json_atomic(self._marker(key), marker)
+            return True
+        with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
+            json.dump(marker, stream)
+        return True
+
+    def writer(self, key: str) -> CacheEntryWriter:
+        """
+        Collects the images of the request while they arrive, commit
+        publishes them for the ones waiting
+        """
+        return CacheEntryWriter(self, key)
+
+    def release(self, key: str) -> None:
+        """
+        The request is not in flight anymore, published or not
+        """
+        try:
+            os.unlink(self._marker(key))
+        except OSError:
+            pass
+
+    def wait(
+        self,
+        key: str,
+        on_wait: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Waits for the request in flight with key, returns its metadata with
+        a copy of its images in "files".  None when it finished without
+        images or was abandoned, then the caller is on its own.
+        """
+        while True:
+            try:
+                return copy_entry(self.entry_path(key))
+            except (OSError, ValueError):
+                pass
+            marker = self._read(key)
+            if marker is None or self._expired(marker):
+                # Published right before the marker was removed
+                try:
+                    return copy_entry(self.entry_path(key))
+                except (OSError, ValueError):
+                    return None
+            if on_wait is not None:
+                on_wait(marker)
+            time.sleep(CHECK_EACH)
+
+    def evict(self) -> None:
+        """
+        Removes the results nobody picked up in KEEP_RESULTS seconds
+        """
+        now = time.time()
+        for entry in self.directory.iterdir():
+            # The ones still arriving are in hidden directories
+            keep = KEEP_STAGING if entry.name.startswith(".") else KEEP_RESULTS
+            try:
+                if entry.is_dir() and now - entry.stat().st_mtime > keep:
+                    shutil.rmtree(entry, ignore_errors=True)
+            except OSError:
+                pass
@@ -0,0 +1,282 @@
+# Journal of the Horde requests that outlived a run of the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sdhorde.cache import write_json_atomic, write_text_atomic
+from sdhorde.download import Downloader
+from sdhorde.horde import MIN_CHECK_WAIT, HordeAPI, HordeError, next_check_delay
+from sdhorde.inflight import process_alive
+
+logger = logging.getLogger(__name__)
+
+JOB_EXPIRES = 30 * 60
+"""
+Seconds the Horde keeps a request that nobody checks, after that it is
+removed from the journal
+"""
+
+KEEP_DOWNLOADED = 7 * 24 * 60 * 60
+"""
+Seconds the downloaded images wait for a run to place them
+"""
+
+NOT_JOURNALED = ("api_key", "source_image", "local_settings")
+"""
+Options not written to disk, the key is secret and the source image big
+"""
+
+RESUME_BANDWIDTH = 2 * 1024 * 1024
+"""
+Bytes per second used by the downloads of the resumed requests, they
+run in the background while the artist keeps working
+"""
+
+CLAIM_EXPIRES = 10 * 60
+"""
+Seconds after which the claim of a request that was not renewed is
+considered abandoned, for the systems where a dead process can not be
+told apart
+"""
+
+JOB_ID = re.compile(r"generate/(?:status|check)/([0-9a-fA-F-]+)")
+
+
+def job_id_from(texts: List[Any]) -> Optional[str]:
+    """
+    The Horde id found in the status url among texts
+    """
+    for text in texts:
+        found = JOB_ID.search(str(text))
+        if found:
+            return found.group(1)
+    return None
+
+
+class JobJournal:
+    """
+    Requests still queued in the Horde when the plugin stopped waiting for
+    them.  Each one is a json file in directory with the Horde id, the
+    request, where the images go and a deadline.  resume checks them, and
+    downloads the images of the finished ones next to the file with
+    downloader, the plugin places them from the main thread.  Each
+    request is resumed by a single process, the one that claims it with
+    a job_id.claim file, so that two of them do not download the same
+    images.
+    """
+
+    def __init__(self, directory: Path, downloader: Optional[Downloader] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.downloader = downloader or Downloader(bytes_per_second=RESUME_BANDWIDTH)
+        self._thread: Optional[threading.Thread] = None
+
+    def _path(self, job_id: str) -> Path:
+        return self.directory / f"{job_id}.json"
+
+    def _claim_path(self, job_id: str) -> Path:
+        return self.directory / f"{job_id}.claim"
+
+    def claim(self, job_id: str) -> bool:
+        """
+        True when this process resumes job_id, the claim is renewed each
+        time.  A claim of a process that is gone or that was not renewed
+        in CLAIM_EXPIRES is taken over.
+        """
+        path = self._claim_path(job_id)
+        pid = os.getpid()
+        try:
+            descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                owner = int(path.read_text(encoding="ascii") or 0)
+                renewed = path.stat().st_mtime
+            except (OSError, ValueError):
+                owner, renewed = 0, 0.0
+            if owner == pid:
+                os.utime(path)
+                return True
+            if (
+                owner
+                and process_alive(owner)
+                and time.time() - renewed < CLAIM_EXPIRES
+            ):
+                return False
+            logger.debug(f"Taking over the abandoned {job_id}")
+            write_text_atomic(path, str(pid))
+            return True
+        with os.fdopen(descriptor, "w", encoding="ascii") as stream:
+            stream.write(str(pid))
+        return True
+
+    def release(self, job_id: str) -> None:
+        try:
+            os.unlink(self._claim_path(job_id))
+        except OSError:
+            pass
+
+    def add(
+        self,
+        job_id: str,
+        options: Dict[str, Any],
+        target: Dict[str, Any],
+        expires: float = JOB_EXPIRES,
+    ) -> None:
+        """
+        Records job_id, sent with options, target tells where its images go
+        """
+        entry = {
+            "job_id": job_id,
+            "request": {
+                name: value
+                for name, value in options.items()
+                if name not in NOT_JOURNALED
+            },
+            "target": target,
+            "deadline": time.time() + expires,
+            "files": [],
+        }
+        write_json_atomic(self._path(job_id), entry)
+        logger.debug(f"Journaled {job_id}")
+
+    def entries(self) -> List[Dict[str, Any]]:
+        found = []
+        for path in sorted(self.directory.glob("*.json")):
+            try:
+                with open(path, encoding="utf-8") as stream:
+                    found.append(json.load(stream))
+            except (OSError, ValueError):
+                continue
+        return found
+
+    def pending(self) -> List[Dict[str, Any]]:
+        return [entry for entry in self.entries() if not entry["files"]]
+
+    def downloaded(self) -> List[Dict[str, Any]]:
+        """
+        Entries whose images are waiting to be placed
+        """
+        return [
+            entry
+            for entry in self.entries()
+            if entry["files"] and all(os.path.exists(name) for name in entry["files"])
+        ]
+
+    def remove(self, job_id: str) -> None:
+        """
+        Forgets job_id, the caller owns the downloaded images
+        """
+        try:
+            os.unlink(self._path(job_id))
+        except OSError:
+            pass
+        self.release(job_id)
+
+    def purge(self) -> None:
+        """
+        Removes the entries past their deadline, with their images
+        """
+        now = time.time()
+        for entry in self.entries():
+            if entry["deadline"] >= now:
+                continue
+            logger.debug(f"{entry['job_id']} expired")
+            for name in entry["files"]:
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+            self.remove(entry["job_id"])
+
+    def fetch(self, api: HordeAPI, entry: Dict[str, Any]) -> Optional[float]:
+        """
+        Checks the request of entry once, downloading its images when it is
+        done.  Returns the seconds to wait before checking it again, None
+        when there is nothing more to check.  The caller holds the claim of
+        the request.
+        """
+        job_id = entry["job_id"]
+        try:
+            data = api.check(job_id)
+            if data.get("faulted") or data.get("is_possible") is False:
+                logger.debug(f"{job_id} will not finish")
+                self.remove(job_id)
+                return None
+            if not data.get("done"):
+                return next_check_delay(data)
+            targets = []
+            for index, generation in enumerate(api.generations(job_id)):
+                suffix = Path(generation["img"].split("?")[0]).suffix or ".webp"
+                targets.append(
+                    (generation["img"], self.directory / f"{job_id}-{index}{suffix}")
+                )
+            files = [str(path) for path in self.downloader.fetch_all(targets)]
+            if not files:
+                logger.debug(f"{job_id} finished without images")
+                self.remove(job_id)
+                return None
+        except HordeError as ex:
+            if ex.code == 404:
+                logger.debug(f"The Horde forgot {job_id}")
+                self.remove(job_id)
+                return None
+            logger.debug(f"Unable to check {job_id}: {ex}")
+            return MIN_CHECK_WAIT
+        except OSError as ex:
+            logger.debug(f"Unable to check {job_id}: {ex}")
+            return MIN_CHECK_WAIT
+        entry["files"] = files
+        entry["deadline"] = time.time() + KEEP_DOWNLOADED
+        write_json_atomic(self._path(job_id), entry)
+        self.release(job_id)
+        logger.debug(f"{job_id} downloaded")
+        return None
+
+    def resume(self, api: HordeAPI) -> None:
+        """
+        Checks the pending requests this process claims until all of them
+        are downloaded or expired, the ones claimed by other processes are
+        left to them
+        """
+        waits: Dict[str, float] = {}
+        while True:
+            self.purge()
+            now = time.monotonic()
+            pending = [
+                entry for entry in self.pending() if self.claim(entry["job_id"])
+            ]
+            if not pending:
+                return
+            for entry in pending:
+                if waits.get(entry["job_id"], 0) > now:
+                    continue
+                delay = self.fetch(api, entry)
+                if delay is not None:
+                    waits[entry["job_id"]] = now + delay
+            soonest = min(waits.values(), default=now + MIN_CHECK_WAIT)
+            time.sleep(max(MIN_CHECK_WAIT, soonest - time.monotonic()))
+
+    def resume_in_background(self, api: HordeAPI) -> Optional[threading.Thread]:
+        """
+        Starts resume in a daemon thread when there are pending requests
+        that no other process is resuming
+        """
+        if not any(self.claim(entry["job_id"]) for entry in self.pending()):
+            return None
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+        self._thread = threading.Thread(
+            target=self.resume, args=(api,), name="job-journal", daemon=True
+        )
+        self._thread.start()
+        return self._thread
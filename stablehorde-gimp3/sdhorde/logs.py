@@ -0,0 +1,148 @@
+# Log of the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import atexit
+import logging
+import os
+import queue
+
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+
+from sdhorde.cache import FileLock
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+LOG_FILE_SIZE = 1024 * 1024
+"""
+Bytes of the log before it is rotated
+"""
+
+LOG_BACKUPS = 2
+
+RECENT_RECORDS = 1000
+"""
+Records below the level kept in memory, written when an error happens
+"""
+
+LEVELS = {
+    "error": logging.ERROR,
+    "warning": logging.WARNING,
+    "info": logging.INFO,
+    "debug": logging.DEBUG,
+}
+
+LEVEL_VARIABLE = "STABLEHORDE_LOG_LEVEL"
+"""
+Environment variable with the level, it wins over the one of the dialog
+"""
+
+
+class RawQueueHandler(QueueHandler):
+    """
+    Queues the records as they come, QueueHandler would format each one
+    in the thread that logs, even the ones that are never written.  The
+    thread of the listener formats them when they reach the file.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler for a file written by several Gimp processes.
+    Each record is written holding a FileLock, so only one process rolls
+    the file over, and a process whose file was rotated by another one
+    opens the new file before writing.
+    """
+
+    def __init__(self, filename: Path, *args, **kwargs):
+        super().__init__(filename, *args, **kwargs)
+        self.lock_path = Path(self.baseFilename + ".lock")
+
+    def _rotated(self) -> bool:
+        try:
+            return (
+                os.fstat(self.stream.fileno()).st_ino
+                != os.stat(self.baseFilename).st_ino
+            )
+        except OSError:
+            return True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            with FileLock(self.lock_path):
+                if self.stream is not None and self._rotated():
+                    self.stream.close()
+                    self.stream = None
+                super().emit(record)
+        except OSError:
+            self.handleError(record)
+
+
+class RecentRecords(logging.Handler):
+    """
+    Writes to target the records of level or more.  The rest are kept,
+    the last capacity of them, and written just before the next error,
+    so that it comes with what led to it.
+    """
+
+    def __init__(
+        self, target: logging.Handler, level: int, capacity: int = RECENT_RECORDS
+    ):
+        super().__init__(logging.DEBUG)
+        self.target = target
+        self.threshold = level
+        self.recent: deque = deque(maxlen=capacity)
+
+    def use_level(self, name: str) -> None:
+        self.threshold = LEVELS.get(name, logging.WARNING)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.levelno < self.threshold:
+            self.recent.append(record)
+            return
+        if record.levelno >= logging.ERROR:
+            while self.recent:
+                self.target.handle(self.recent.popleft())
+        self.target.handle(record)
+
+    def close(self) -> None:
+        self.target.close()
+        super().close()
+
+
+def initial_level() -> int:
+    return LEVELS.get(os.environ.get(LEVEL_VARIABLE, "").lower(), logging.WARNING)
+
+
+def setup_logging(log_file: Path, level: int) -> RecentRecords:
+    """
+    Sends the records of the process through a queue to a thread that
+    writes them to log_file, rotated each LOG_FILE_SIZE, the records are
+    formatted there and only when written.  Returns the handler, to
+    change its level.
+    """
+    file_handler = SharedRotatingFileHandler(
+        log_file,
+        maxBytes=LOG_FILE_SIZE,
+        backupCount=LOG_BACKUPS,
+        encoding="utf-8",
+        delay=True,
+    )
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    recent = RecentRecords(file_handler, level)
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(records, recent)
+    root = logging.getLogger()
+    root.handlers = [RawQueueHandler(records)]
+    # Every record reaches the thread, the ones below the level are kept
+    # in memory there
+    root.setLevel(logging.DEBUG)
+    listener.start()
+    atexit.register(listener.stop)
+    return recent
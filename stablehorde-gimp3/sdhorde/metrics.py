@@ -0,0 +1,305 @@
+# Metrics of the Horde requests of the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import json
+import logging
+import os
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sdhorde.cache import FileLock, write_json_atomic, write_text_atomic
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("export", "submit", "queue", "generate", "download", "insert")
+"""
+Parts of a request timed, in the order they happen
+"""
+
+JOBS_FILE = "jobs.jsonl"
+
+TEXTFILE = "stablehorde.prom"
+"""
+Totals in the Prometheus text format, for the textfile collector of the
+node exporter
+"""
+
+TOTALS_FILE = "totals.json"
+
+LOCK_FILE = "metrics.lock"
+
+JOBS_FILE_SIZE = 8 * 1024 * 1024
+"""
+Bytes of JOBS_FILE before it is rotated, a single older file is kept
+"""
+
+
+class JobMetrics:
+    """
+    What happened to a request: the seconds of each phase, the checks
+    made, the bytes sent and received, the queue positions and wait time
+    the Horde reported and the workers that generated it.  The phases
+    submit, queue, generate and download come from the HTTP traffic, the
+    runner adds export and insert.
+    """
+
+    def __init__(self, job: int, model: str):
+        self.job = job
+        self.model = model
+        self.job_id = ""
+        self.phases: Dict[str, float] = {}
+        self.polls = 0
+        self.sent = 0
+        self.received = 0
+        self.wait_time: Optional[float] = None
+        """
+        Last wait_time reported by the Horde
+        """
+        self.queue_positions: List[Tuple[float, int]] = []
+        """
+        Seconds since the submission and the position, each time it changed
+        """
+        self.workers: List[str] = []
+        self._submitted: Optional[float] = None
+        self._processing: Optional[float] = None
+        self._done = False
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def observe(
+        self,
+        method: str,
+        url: str,
+        seconds: float,
+        sent: int,
+        received: int,
+        body: bytes,
+    ) -> None:
+        """
+        Learns from a request made for the job and its response
+        """
+        now = time.perf_counter()
+        self.sent += sent
+        self.received += received
+        if "/generate/" not in url:
+            self.add_phase("download", seconds)
+            return
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        if method == "POST" and "generate/async" in url:
+            self.add_phase("submit", seconds)
+            self.job_id = data.get("id", self.job_id)
+            self._submitted = now
+            return
+        if "generate/check/" not in url and "generate/status/" not in url:
+            return
+        self.polls += 1
+        if data.get("wait_time") is not None:
+            self.wait_time = float(data["wait_time"])
+        position = data.get("queue_position")
+        started = self._submitted if self._submitted is not None else now
+        if position is not None and (
+            not self.queue_positions or self.queue_positions[-1][1] != position
+        ):
+            self.queue_positions.append((round(now - started, 3), int(position)))
+        if self._processing is None and (
+            data.get("processing", 0) or data.get("finished", 0) or data.get("done")
+        ):
+            self._processing = now
+            self.add_phase("queue", now - started)
+        if data.get("done") and not self._done:
+            self._done = True
+            self.add_phase("generate", now - (self._processing or started))
+        for generation in data.get("generations", []):
+            worker = generation.get("worker_id", "")
+            if worker and worker not in self.workers:
+                self.workers.append(worker)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "job": self.job,
+            "job_id": self.job_id,
+            "model": self.model,
+            "phases": {name: round(value, 3) for name, value in self.phases.items()},
+            "polls": self.polls,
+            "sent": self.sent,
+            "received": self.received,
+            "wait_time": self.wait_time,
+            "queue_positions": self.queue_positions,
+            "workers": self.workers,
+        }
+
+
+def label_value(text: str) -> str:
+    return text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(totals: Dict[str, Any]) -> str:
+    """
+    totals as metrics in the Prometheus text format
+    """
+    lines = [
+        "# HELP stablehorde_jobs_total Requests sent to the Horde",
+        "# TYPE stablehorde_jobs_total counter",
+    ]
+    models = totals.get("models", {})
+    for model, data in sorted(models.items()):
+        for status, count in sorted(data["jobs"].items()):
+            lines.append(
+                f'stablehorde_jobs_total{{model="{label_value(model)}",'
+                f'status="{status}"}} {count}'
+            )
+    lines += [
+        "# HELP stablehorde_phase_seconds Seconds spent in each phase",
+        "# TYPE stablehorde_phase_seconds summary",
+    ]
+    for model, data in sorted(models.items()):
+        for phase in PHASES:
+            if phase not in data["phases"]:
+                continue
+            seconds, count = data["phases"][phase]
+            labels = f'model="{label_value(model)}",phase="{phase}"'
+            lines.append(f"stablehorde_phase_seconds_sum{{{labels}}} {seconds:.3f}")
+            lines.append(f"stablehorde_phase_seconds_count{{{labels}}} {count}")
+    lines += [
+        "# HELP stablehorde_polls_total Status checks made to the Horde",
+        "# TYPE stablehorde_polls_total counter",
+    ]
+    for model, data in sorted(models.items()):
+        lines.append(
+            f'stablehorde_polls_total{{model="{label_value(model)}"}} {data["polls"]}'
+        )
+    lines += [
+        "# HELP stablehorde_bytes_total Bytes sent and received",
+        "# TYPE stablehorde_bytes_total counter",
+    ]
+    for model, data in sorted(models.items()):
+        for direction in ("sent", "received"):
+            lines.append(
+                f'stablehorde_bytes_total{{model="{label_value(model)}",'
+                f'direction="{direction}"}} {data[direction]}'
+            )
+    lines += [
+        "# HELP stablehorde_wait_time_seconds Last wait time told by the Horde",
+        "# TYPE stablehorde_wait_time_seconds gauge",
+    ]
+    for model, data in sorted(models.items()):
+        if data.get("wait_time") is not None:
+            lines.append(
+                f'stablehorde_wait_time_seconds{{model="{label_value(model)}"}} '
+                f'{data["wait_time"]}'
+            )
+    lines += [
+        "# HELP stablehorde_queue_position First queue position of the last request",
+        "# TYPE stablehorde_queue_position gauge",
+    ]
+    for model, data in sorted(models.items()):
+        if data.get("queue_position") is not None:
+            lines.append(
+                f'stablehorde_queue_position{{model="{label_value(model)}"}} '
+                f'{data["queue_position"]}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsSink:
+    """
+    Records the JobMetrics of every request in directory, a line of
+    JOBS_FILE for each one and the totals per model in TEXTFILE, shared
+    by all the Gimp processes.  observe is the listener of the session,
+    it hands each request to the JobMetrics bound to the context that
+    made it.  The binding is a context variable and not a thread local
+    because aihordeclient opens its urls from asyncio.to_thread, in an
+    executor thread that gets a copy of the context of the job.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._current: ContextVar[Optional[JobMetrics]] = ContextVar(
+            "job_metrics", default=None
+        )
+
+    @contextmanager
+    def bind(self, metrics: JobMetrics) -> Iterator[JobMetrics]:
+        """
+        The requests made inside the with block, and by the threads and
+        tasks it starts, are the ones of metrics
+        """
+        token = self._current.set(metrics)
+        try:
+            yield metrics
+        finally:
+            self._current.reset(token)
+
+    def observe(
+        self,
+        method: str,
+        url: str,
+        seconds: float,
+        sent: int,
+        received: int,
+        body: bytes,
+    ) -> None:
+        metrics = self._current.get()
+        if metrics is not None:
+            metrics.observe(method, url, seconds, sent, received, body)
+
+    def _load_totals(self) -> Dict[str, Any]:
+        try:
+            with open(self.directory / TOTALS_FILE, encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {"models": {}}
+
+    def record(self, metrics: JobMetrics, status: str) -> None:
+        """
+        Adds metrics of a request that ended with status, done or failed
+        """
+        entry = dict(metrics.as_dict(), time=round(time.time(), 3), status=status)
+        try:
+            with FileLock(self.directory / LOCK_FILE):
+                jobs = self.directory / JOBS_FILE
+                if jobs.exists() and jobs.stat().st_size > JOBS_FILE_SIZE:
+                    os.replace(jobs, jobs.with_name(JOBS_FILE + ".1"))
+                with open(jobs, "a", encoding="utf-8") as stream:
+                    stream.write(json.dumps(entry) + "\n")
+                totals = self._load_totals()
+                data = totals["models"].setdefault(
+                    metrics.model,
+                    {"jobs": {}, "phases": {}, "polls": 0, "sent": 0, "received": 0},
+                )
+                data["jobs"][status] = data["jobs"].get(status, 0) + 1
+                for phase, seconds in metrics.phases.items():
+                    total, count = data["phases"].get(phase, (0.0, 0))
+                    data["phases"][phase] = (total + seconds, count + 1)
+                data["polls"] += metrics.polls
+                data["sent"] += metrics.sent
+                data["received"] += metrics.received
+                if metrics.wait_time is not None:
+                    data["wait_time"] = metrics.wait_time
+                if metrics.queue_positions:
+                    data["queue_position"] = metrics.queue_positions[0][1]
+                write_json_atomic(self.directory / TOTALS_FILE, totals)
+                write_text_atomic(self.directory / TEXTFILE, prometheus_text(totals))
+        except OSError as ex:
+            logger.debug(f"Unable to record the metrics: {ex}")
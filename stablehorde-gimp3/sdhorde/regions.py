@@ -0,0 +1,310 @@
+# Image regions for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import math
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+SIZE_STEP = 64
+"""
+Models work with sides that are multiple of this
+"""
+
+MIN_MARGIN = SIZE_STEP
+"""
+Least context, in pixels, sent around an area to generate
+"""
+
+_NOT_OPAQUE = bytes(0 if value == 255 else 1 for value in range(256))
+
+
+class Region(NamedTuple):
+    """
+    Rectangle inside an image, in pixels
+    """
+
+    x: int
+    y: int
+    width: int
+    height: int
+
+    @property
+    def right(self) -> int:
+        return self.x + self.width
+
+    @property
+    def bottom(self) -> int:
+        return self.y + self.height
+
+
+def snap_side(length: int, limit: int, step: int = SIZE_STEP) -> int:
+    """
+    Rounds length up to a multiple of step, or to limit when that goes
+    over it
+    """
+    return min(limit, max(step, -(-length // step) * step))
+
+
+def generation_size(
+    width: int, height: int, max_pixels: int, max_width: int, max_height: int
+) -> Tuple[int, int]:
+    """
+    Biggest size with the proportions of width x height, sides multiple
+    of SIZE_STEP, that fits in max_pixels and the side limits.  It is
+    never bigger than width x height, sources are only downscaled.
+    """
+    scale = min(
+        1.0,
+        math.sqrt(max_pixels / (width * height)),
+        max_width / width,
+        max_height / height,
+    )
+    return (
+        max(SIZE_STEP, int(width * scale) // SIZE_STEP * SIZE_STEP),
+        max(SIZE_STEP, int(height * scale) // SIZE_STEP * SIZE_STEP),
+    )
+
+
+def _place(start: int, end: int, side: int, total: int) -> int:
+    """
+    Origin for a side long segment centered on start..end, inside 0..total
+    """
+    origin = (start + end - side) // 2
+    return max(0, min(origin, total - side))
+
+
+def expand_region(
+    bounds: Tuple[int, int, int, int],
+    margin: int,
+    image_width: int,
+    image_height: int,
+    max_width: int,
+    max_height: int,
+    max_mp: int,
+) -> Optional[Region]:
+    """
+    Grows bounds (x1, y1, x2, y2) by margin of context on each side and
+    snaps the size to multiples of SIZE_STEP, keeping it inside the
+    image.  Returns None when the result would not fit the limits of a
+    generation, the caller should then work with the whole image.
+    """
+    x1, y1, x2, y2 = bounds
+    x1, y1 = max(0, x1 - margin), max(0, y1 - margin)
+    x2, y2 = min(image_width, x2 + margin), min(image_height, y2 + margin)
+    width = snap_side(x2 - x1, min(image_width, max_width))
+    height = snap_side(y2 - y1, min(image_height, max_height))
+    if width < x2 - x1 or height < y2 - y1 or width * height > max_mp:
+        return None
+    return Region(
+        _place(x1, x2, width, image_width),
+        _place(y1, y2, height, image_height),
+        width,
+        height,
+    )
+
+
+SIDES = ("left", "top", "right", "bottom")
+
+_OPPOSITE = {"left": "right", "right": "left", "top": "bottom", "bottom": "top"}
+
+
+def outpaint_regions(
+    image_width: int,
+    image_height: int,
+    extend: Dict[str, int],
+    margin: int,
+    max_width: int,
+    max_height: int,
+    max_mp: int,
+) -> Optional[List[Tuple[Region, Dict[str, int]]]]:
+    """
+    Regions to inpaint after growing the canvas extend pixels on each
+    side, in coordinates of the grown canvas, with the feather of each
+    side to blend them in the order given.  Each new strip goes with at
+    least margin pixels of the image as context, never less than
+    MIN_MARGIN, and is split along its length when it does not fit a
+    generation.  None when it can not be split.
+    """
+    margin = max(margin, MIN_MARGIN)
+    left, top, right, bottom = (extend.get(side, 0) for side in SIDES)
+    width = image_width + left + right
+    height = image_height + top + bottom
+    feather = margin // 2
+    regions = []
+    for side, grown in zip(SIDES, (left, top, right, bottom)):
+        if not grown:
+            continue
+        across = width if side in ("left", "right") else height
+        depth = min(across, -(-(grown + margin) // SIZE_STEP) * SIZE_STEP)
+        if side == "left":
+            x, y, strip_width, strip_height = 0, 0, depth, height
+        elif side == "right":
+            x, y, strip_width, strip_height = width - depth, 0, depth, height
+        elif side == "top":
+            x, y, strip_width, strip_height = 0, 0, width, depth
+        else:
+            x, y, strip_width, strip_height = 0, height - depth, width, depth
+        pieces = tile_regions(
+            strip_width, strip_height, max_width, max_height, max_mp, margin
+        )
+        if not pieces:
+            return None
+        for piece in pieces:
+            sides = tile_feather(piece, margin)
+            # Fades into the image on the side opposite to the new strip
+            if depth < across:
+                inner = _OPPOSITE[side]
+                sides[inner] = max(sides[inner], feather)
+            regions.append(
+                (Region(piece.x + x, piece.y + y, piece.width, piece.height), sides)
+            )
+    return regions
+
+
+def _tile_side(length: int, count: int, overlap: int) -> int:
+    """
+    Smallest side, multiple of SIZE_STEP, for count tiles overlapping
+    overlap pixels to cover length.  It is length itself when rounding
+    up passes it, the generation is then scaled back to the tile.
+    """
+    side = -(-(length + (count - 1) * overlap) // count)
+    return min(length, -(-side // SIZE_STEP) * SIZE_STEP)
+
+
+def _tile_origins(length: int, side: int, count: int) -> List[int]:
+    """
+    Origins of count tiles covering length, evenly spread, the last one
+    ends at length
+    """
+    if count == 1:
+        return [0]
+    return [round(i * (length - side) / (count - 1)) for i in range(count)]
+
+
+def tile_regions(
+    image_width: int,
+    image_height: int,
+    max_width: int,
+    max_height: int,
+    max_mp: int,
+    overlap: int,
+    max_tiles: int = 64,
+) -> List[Region]:
+    """
+    Overlapping tiles, all of the same size, that cover the image and fit
+    the limits of a generation, the fewest possible and then the smallest.
+    They are ordered by rows, each tile overlaps the ones at its left and
+    above.  Empty when the image needs more than max_tiles.
+    """
+    best = None
+    for columns in range(1, max_tiles + 1):
+        width = _tile_side(image_width, columns, overlap)
+        if width > max_width:
+            continue
+        for rows in range(1, max_tiles // columns + 1):
+            height = _tile_side(image_height, rows, overlap)
+            if height > max_height or width * height > max_mp:
+                continue
+            cost = (columns * rows, columns * rows * width * height)
+            if best is None or cost < best[0]:
+                best = (cost, columns, rows, width, height)
+            break
+    if best is None:
+        return []
+    _, columns, rows, width, height = best
+    return [
+        Region(x, y, width, height)
+        for y in _tile_origins(image_height, height, rows)
+        for x in _tile_origins(image_width, width, columns)
+    ]
+
+
+def tile_feather(tile: Region, overlap: int) -> Dict[str, int]:
+    """
+    Feather for each side of tile when the tiles are stacked in the order
+    given by tile_regions, each one fades in over the ones at its left and
+    above, which stay opaque underneath
+    """
+    return {
+        "left": overlap if tile.x > 0 else 0,
+        "top": overlap if tile.y > 0 else 0,
+        "right": 0,
+        "bottom": 0,
+    }
+
+
+def alpha_hole_bounds(
+    alpha: bytes, width: int, height: int
+) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Bounding box (x1, y1, x2, y2) of the pixels that are not fully
+    opaque, alpha holds one byte per pixel.  None when all are opaque.
+    """
+    marks = alpha.translate(_NOT_OPAQUE)
+    left, right, top, bottom = width, -1, -1, -1
+    for row in range(height):
+        start = row * width
+        first = marks.find(1, start, start + width)
+        if first < 0:
+            continue
+        if top < 0:
+            top = row
+        bottom = row
+        left = min(left, first - start)
+        right = max(right, marks.rfind(1, start, start + width) - start)
+    if top < 0:
+        return None
+    return left, top, right + 1, bottom + 1
+
+
+def _ramp(length: int, start: int, end: int) -> bytes:
+    """
+    255 in the middle, going down to 0 over start pixels at the beginning
+    and end pixels at the end
+    """
+    values = bytearray(b"\xff" * length)
+    for i in range(min(start, length)):
+        values[i] = min(values[i], (255 * (i + 1)) // (start + 1))
+    for i in range(min(end, length)):
+        values[length - 1 - i] = min(
+            values[length - 1 - i], (255 * (i + 1)) // (end + 1)
+        )
+    return bytes(values)
+
+
+def feather_mask(
+    width: int,
+    height: int,
+    left: int = 0,
+    top: int = 0,
+    right: int = 0,
+    bottom: int = 0,
+) -> bytes:
+    """
+    One byte per pixel mask, opaque in the center and fading linearly to
+    transparent over the given number of pixels at each side
+    """
+    columns = _ramp(width, left, right)
+    rows = _ramp(height, top, bottom)
+    cache: Dict[int, bytes] = {255: columns}
+    lines = []
+    for value in rows:
+        if value not in cache:
+            cache[value] = bytes(min(value, column) for column in columns)
+        lines.append(cache[value])
+    return b"".join(lines)
+
+
+def region_feather(region: Region, feather: int, image_width: int, image_height: int):
+    """
+    Feather for each side of region, the sides on the border of the
+    image are not feathered, there is nothing to blend with
+    """
+    return {
+        "left": feather if region.x > 0 else 0,
+        "top": feather if region.y > 0 else 0,
+        "right": feather if region.right < image_width else 0,
+        "bottom": feather if region.bottom < image_height else 0,
+    }
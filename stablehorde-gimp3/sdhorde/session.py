@@ -0,0 +1,353 @@
+# Persistent HTTP session for the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import http.client
+import io
+import json
+import select
+import threading
+import time
+import urllib.request
+import zlib
+
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.error import URLError
+from urllib.request import BaseHandler
+from urllib.response import addinfourl
+
+POOL_SIZE = 4
+"""
+Idle connections kept open per host
+"""
+
+UPLOAD_SAMPLE = 64 * 1024
+"""
+Smallest request body used to measure the upload speed, the time of
+smaller ones is mostly latency
+"""
+
+SPEED_WEIGHT = 0.3
+"""
+Weight of a new measure in the upload speed remembered
+"""
+
+BUFFERED_TYPES = ("application/json", "text/")
+"""
+Content types read whole before handing the response back, the answers
+of the API.  The rest, the images, are streamed as they arrive.
+"""
+
+IDEMPOTENT = ("GET", "HEAD", "DELETE")
+"""
+Methods sent again when a reused connection fails, a POST may have
+reached the Horde and submitting it twice would spend the kudos twice
+"""
+
+
+def is_stale(connection: http.client.HTTPConnection) -> bool:
+    """
+    True when the server closed the idle connection, it has something to
+    read while nothing was asked
+    """
+    if connection.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+class PooledBody(io.RawIOBase):
+    """
+    Body of a streamed response.  The connection goes back to the pool
+    once the body was read to the end, when it is closed before that the
+    connection is closed too.  on_done gets the bytes read.
+    """
+
+    def __init__(
+        self,
+        response: http.client.HTTPResponse,
+        release: Callable[[], None],
+        discard: Callable[[], None],
+        on_done: Callable[[int], None],
+    ):
+        super().__init__()
+        self._response: Optional[http.client.HTTPResponse] = response
+        self._release = release
+        self._discard = discard
+        self._on_done = on_done
+        self.received = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        if self._response is None:
+            return 0
+        count = self._response.readinto(buffer)
+        self.received += count
+        if not count:
+            self._finish(complete=True)
+        return count
+
+    def _finish(self, complete: bool) -> None:
+        response, self._response = self._response, None
+        if response is None:
+            return
+        if complete and not response.will_close:
+            self._release()
+        else:
+            self._discard()
+        self._on_done(self.received)
+
+    def close(self) -> None:
+        self._finish(complete=False)
+        super().close()
+
+
+class KeepAliveHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+    """
+    urllib handler that keeps up to pool_size idle connections per host,
+    so that status checks, submissions and image downloads reuse the
+    same TCP and TLS session.  Responses are requested gzipped and are
+    handed back already decompressed.  The answers of the API are read
+    whole, images are streamed.  HTTP errors are reported the same way
+    urllib does, raising HTTPError.  Requests sent through a proxy go
+    through the stock handlers, without the pool nor the listeners.
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE):
+        urllib.request.HTTPHandler.__init__(self)
+        urllib.request.HTTPSHandler.__init__(self)
+        self.pool_size = pool_size
+        self._idle: Dict[Tuple[str, str], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+        """
+        Number of new connections, the rest of the requests reused one
+        """
+        self.requests_made = 0
+        self.uploads: List[Tuple[int, float]] = []
+        """
+        Bytes and seconds of the requests with a body of UPLOAD_SAMPLE or
+        more, until the response arrived
+        """
+        self.listeners: List[Callable[[str, str, float, int, int, bytes], None]] = []
+        """
+        Called after each request, from the thread that made it, with
+        the method, url, seconds, bytes sent, bytes received and the body
+        received.  The body is empty for the streamed responses, they are
+        reported once read.
+        """
+
+    def http_open(self, req):
+        if req.has_proxy():
+            return urllib.request.HTTPHandler.http_open(self, req)
+        return self._pooled_open(http.client.HTTPConnection, "http", req)
+
+    def https_open(self, req):
+        if req.has_proxy() or req._tunnel_host:
+            return urllib.request.HTTPSHandler.https_open(self, req)
+        return self._pooled_open(http.client.HTTPSConnection, "https", req)
+
+    def take_uploads(self) -> List[Tuple[int, float]]:
+        """
+        The uploads measured since the last call
+        """
+        with self._lock:
+            uploads, self.uploads = self.uploads, []
+        return uploads
+
+    def close_all(self) -> None:
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+
+    def _new_connection(self, connection_class, host: str, timeout):
+        with self._lock:
+            self.connections_opened += 1
+        if connection_class is http.client.HTTPSConnection:
+            return connection_class(host, timeout=timeout, context=self._context)
+        return connection_class(host, timeout=timeout)
+
+    def _get_connection(self, connection_class, key: Tuple[str, str], timeout):
+        while True:
+            with self._lock:
+                connections = self._idle.get(key, [])
+                if not connections:
+                    break
+                connection = connections.pop()
+            if not is_stale(connection):
+                return connection, True
+            connection.close()
+        return self._new_connection(connection_class, key[1], timeout), False
+
+    def _release_connection(self, key: Tuple[str, str], connection) -> None:
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.pool_size:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _pooled_open(self, connection_class, scheme: str, req):
+        host = req.host
+        if not host:
+            raise URLError("no host given")
+        key = (scheme, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers["Connection"] = "keep-alive"
+        asked_gzip = "Accept-encoding" not in headers
+        if asked_gzip:
+            headers["Accept-encoding"] = "gzip"
+
+        def send(connection):
+            connection.request(req.get_method(), req.selector, req.data, headers)
+            return connection.getresponse()
+
+        connection, reused = self._get_connection(connection_class, key, req.timeout)
+        start = time.perf_counter()
+        try:
+            response = send(connection)
+        except (OSError, http.client.HTTPException) as ex:
+            connection.close()
+            if not reused or req.get_method() not in IDEMPOTENT:
+                raise URLError(ex)
+            # The server closed the idle connection, try once with a new one
+            connection = self._new_connection(connection_class, host, req.timeout)
+            try:
+                response = send(connection)
+            except (OSError, http.client.HTTPException) as ex:
+                connection.close()
+                raise URLError(ex)
+
+        seconds = time.perf_counter() - start
+        sent = len(req.data or b"")
+        with self._lock:
+            self.requests_made += 1
+            if sent >= UPLOAD_SAMPLE:
+                self.uploads.append((sent, seconds))
+
+        def report(received: int, body: bytes = b"") -> None:
+            elapsed = time.perf_counter() - start
+            for listener in self.listeners:
+                listener(req.get_method(), req.full_url, elapsed, sent, received, body)
+
+        gzipped = asked_gzip and response.getheader("Content-Encoding", "") == "gzip"
+        content_type = response.getheader("Content-Type", "")
+        if not gzipped and not content_type.startswith(BUFFERED_TYPES):
+            body = PooledBody(
+                response,
+                lambda: self._release_connection(key, connection),
+                connection.close,
+                report,
+            )
+            result = addinfourl(
+                io.BufferedReader(body), response.msg, req.full_url, response.status
+            )
+            result.msg = response.reason
+            return result
+
+        try:
+            body = response.read()
+        except (OSError, http.client.HTTPException) as ex:
+            connection.close()
+            raise URLError(ex)
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(key, connection)
+
+        received = len(body)
+        headers = response.msg
+        if gzipped:
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            # The headers describe the body handed back
+            del headers["Content-Encoding"]
+            del headers["Content-Length"]
+            headers["Content-Length"] = str(len(body))
+        report(received, body)
+
+        result = addinfourl(BytesIO(body), headers, req.full_url, response.status)
+        result.msg = response.reason
+        return result
+
+
+def install_session(
+    pool_size: int = POOL_SIZE, extra_handlers: Sequence[BaseHandler] = ()
+) -> KeepAliveHandler:
+    """
+    Makes every urllib.request.urlopen call in the process, including the
+    ones made by aihordeclient, go through a pool of keep-alive
+    connections.  Returns the handler to allow inspecting or closing it.
+    extra_handlers are added to the opener, like the ones used by the
+    benchmarks to send the requests to a local server.
+    """
+    handler = KeepAliveHandler(pool_size)
+    urllib.request.install_opener(
+        urllib.request.build_opener(handler, *extra_handlers)
+    )
+    return handler
+
+
+def get_session() -> Optional[KeepAliveHandler]:
+    """
+    Returns the handler installed by install_session, if any
+    """
+    opener = urllib.request._opener
+    if opener is None:
+        return None
+    for handler in opener.handlers:
+        if isinstance(handler, KeepAliveHandler):
+            return handler
+    return None
+
+
+class UploadSpeed:
+    """
+    Upload speed measured by the session, remembered in a file between
+    runs to choose how much to compress the images sent
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def load(self) -> Optional[float]:
+        """
+        Bytes per second, None when it was never measured
+        """
+        try:
+            with open(self.path, encoding="utf-8") as stream:
+                return float(json.load(stream)["bytes_per_second"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def update(self, handler: KeepAliveHandler) -> Optional[float]:
+        """
+        Adds the uploads measured by handler to the speed remembered
+        """
+        from sdhorde.cache import write_json_atomic
+
+        uploads = handler.take_uploads()
+        speed = self.load()
+        for sent, seconds in uploads:
+            measured = sent / max(seconds, 0.001)
+            if speed is None:
+                speed = measured
+            else:
+                speed += SPEED_WEIGHT * (measured - speed)
+        if uploads and speed is not None:
+            try:
+                write_json_atomic(self.path, {"bytes_per_second": speed})
+            except OSError:
+                pass
+        return speed
@@ -0,0 +1,217 @@
+# Timeline of a run of the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sdhorde.cache import write_text_atomic
+
+logger = logging.getLogger(__name__)
+
+TRACE_PREFIX = "gimp-stable-diffusion-"
+
+TRACE_SUFFIX = ".trace.json"
+
+TRACES_KEPT = 20
+"""
+Timelines kept in the folder, the oldest are removed
+"""
+
+REQUEST_KINDS = (
+    ("generate/async", "submit"),
+    ("generate/check/", "poll"),
+    ("generate/status/", "status"),
+)
+"""
+Span name of the Horde requests by the path they use, the rest are
+downloads
+"""
+
+
+class Tracer:
+    """
+    Spans of a run in the Chrome trace-event format, the file opens in
+    chrome://tracing, ui.perfetto.dev or speedscope.  Spans of the same
+    thread nest by their times.  The span open in a context is kept in a
+    context variable, the requests observed are put in the thread of that
+    span, under it, even when they are made from an executor thread as
+    aihordeclient does.  Nothing is recorded until start, so a disabled
+    tracer costs a check per span.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.name = ""
+        self._origin = time.perf_counter()
+        self._started = 0.0
+        self._events: List[Dict[str, Any]] = []
+        self._threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._current: ContextVar[Optional[Tuple[int, int]]] = ContextVar(
+            "trace_span", default=None
+        )
+        """
+        Thread and id of the span open in the context
+        """
+
+    def start(self, name: str) -> None:
+        """
+        Records from now on, name is the one of the span of the whole run
+        """
+        self.enabled = True
+        self.name = name
+        self._started = time.perf_counter()
+
+    def add(
+        self,
+        name: str,
+        start: float,
+        end: Optional[float] = None,
+        tid: Optional[int] = None,
+        **args: Any,
+    ) -> None:
+        """
+        Span name from start to end, perf_counter times, end is now when
+        not given.  It goes in the thread tid, the current one when not
+        given.
+        """
+        if not self.enabled:
+            return
+        if end is None:
+            end = time.perf_counter()
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": round((start - self._origin) * 1_000_000),
+            "dur": round((end - start) * 1_000_000),
+            "pid": os.getpid(),
+            "tid": thread.ident if tid is None else tid,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self._events.append(event)
+            if tid is None:
+                self._threads.setdefault(thread.ident, thread.name)
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        span_id = next(self._ids)
+        token = self._current.set((threading.get_ident(), span_id))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current.reset(token)
+            self.add(name, start, id=span_id, **args)
+
+    def observe(
+        self,
+        method: str,
+        url: str,
+        seconds: float,
+        sent: int,
+        received: int,
+        body: bytes,
+    ) -> None:
+        """
+        Listener of the session, a span for each request, inside the span
+        open in the context that made it
+        """
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        name = "download"
+        for path, kind in REQUEST_KINDS:
+            if path in url:
+                name = kind
+                break
+        tid = None
+        parent = {}
+        current = self._current.get()
+        if current is not None:
+            tid = current[0]
+            parent["parent"] = current[1]
+        self.add(
+            name,
+            end - seconds,
+            end,
+            tid,
+            url=url.split("?")[0],
+            sent=sent,
+            received=received,
+            **parent,
+        )
+
+    def events(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        pid = os.getpid()
+        if self.enabled:
+            events.insert(
+                0,
+                {
+                    "name": self.name,
+                    "ph": "X",
+                    "ts": round((self._started - self._origin) * 1_000_000),
+                    "dur": round((time.perf_counter() - self._started) * 1_000_000),
+                    "pid": pid,
+                    "tid": threading.main_thread().ident,
+                },
+            )
+        for ident, thread_name in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": ident,
+                    "args": {"name": thread_name},
+                }
+            )
+        return events
+
+    def save(self, directory: Path) -> Optional[Path]:
+        """
+        Writes the timeline in directory, named after the time and the
+        process, and removes the oldest ones over TRACES_KEPT
+        """
+        directory = Path(directory)
+        path = directory / (
+            TRACE_PREFIX
+            + time.strftime("%Y%m%d-%H%M%S")
+            + f"-{os.getpid()}"
+            + TRACE_SUFFIX
+        )
+        try:
+            write_text_atomic(
+                path,
+                json.dumps({"traceEvents": self.events(), "displayTimeUnit": "ms"}),
+            )
+            traces = sorted(
+                directory.glob(TRACE_PREFIX + "*" + TRACE_SUFFIX),
+                key=lambda trace: trace.stat().st_mtime,
+            )
+            for trace in traces[:-TRACES_KEPT]:
+                trace.unlink()
+        except OSError as ex:
+            logger.debug(f"Unable to save the timeline: {ex}")
+            return None
+        return path
@@ -0,0 +1,74 @@
+# Private temporary folders of the requests of the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Optional
+
+from sdhorde.inflight import process_alive
+
+logger = logging.getLogger(__name__)
+
+WORKSPACE_PREFIX = "stablehorde-"
+
+KEEP_ORPHANS = 24 * 60 * 60
+"""
+Seconds after which the folder of a run that did not remove it is
+removed, even when its process can not be checked
+"""
+
+
+def purge_orphans(parent: Path) -> None:
+    """
+    Removes the folders left in parent by runs that are gone
+    """
+    now = time.time()
+    for path in Path(parent).glob(WORKSPACE_PREFIX + "*"):
+        pid = path.name[len(WORKSPACE_PREFIX) :].split("-")[0]
+        try:
+            if not path.is_dir():
+                continue
+            if pid.isdigit() and int(pid) == os.getpid():
+                continue
+            gone = pid.isdigit() and not process_alive(int(pid))
+            if gone or now - path.stat().st_mtime > KEEP_ORPHANS:
+                logger.debug(f"Removing the orphan {path}")
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+
+class Workspaces:
+    """
+    Temporary folders of the requests of a run, each request gets its
+    own, so that runs and requests at the same time never write the same
+    files.  They live inside a folder of the run named after the process,
+    close removes it with everything inside.  The folders of runs that
+    died without closing are removed by the next run.
+    """
+
+    def __init__(self, parent: Optional[Path] = None):
+        parent = Path(parent or tempfile.gettempdir())
+        purge_orphans(parent)
+        self.root = Path(
+            tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}-", dir=parent)
+        )
+
+    def new(self, name: str = "job") -> Path:
+        return Path(tempfile.mkdtemp(prefix=f"{name}-", dir=self.root))
+
+    def close(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self) -> "Workspaces":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,49 @@
+# Fixtures of the tests of the sdhorde modules of the AiHorde Gimp3 plugin
+#
+# MIT lICENSE
+# https://github.com/ikks/gimp-stable-diffusion/blob/main/LICENSE
+
+import subprocess
+import sys
+import urllib.request
+
+from pathlib import Path
+
+import pytest
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(PLUGIN_DIR), str(PLUGIN_DIR / "benchmarks")]
+
+from mock_horde import MockSettings, RedirectHandler, start  # noqa: E402
+from sdhorde.session import install_session  # noqa: E402
+
+API_ROOT = "https://aihorde.net/api/v2/"
+
+
+def dead_pid() -> int:
+    """
+    Id of a process that already ended
+    """
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+@pytest.fixture
+def horde():
+    """
+    A local Horde, fast and small, every urlopen of the process is sent
+    to it through the keep-alive session
+    """
+    server = start(
+        MockSettings(
+            queue_delay=0.2, processing_delay=0.2, image_width=64, image_height=64
+        )
+    )
+    session = install_session(extra_handlers=[RedirectHandler(server.root)])
+    server.session = session
+    yield server
+    urllib.request.install_opener(None)
+    session.close_all()
+    server.shutdown()
+    server.server_close()
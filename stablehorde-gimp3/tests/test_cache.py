@@ -0,0 +1,73 @@
+import multiprocessing
+
+from sdhorde.cache import GenerationCache, request_key
+
+OPTIONS = {
+    "prompt": "a cat",
+    "model": "stable_diffusion",
+    "seed": "42",
+    "api_key": "secret",
+    "max_wait_minutes": 5,
+    "source_image": "c291cmNl",
+}
+
+
+def test_the_key_ignores_what_does_not_change_the_images():
+    key = request_key(OPTIONS)
+    assert key == request_key(dict(OPTIONS, api_key="other", max_wait_minutes=1))
+    assert key != request_key(dict(OPTIONS, prompt="a dog"))
+    assert key != request_key(dict(OPTIONS, source_image="b3RoZXI="))
+
+
+def test_requests_without_seed_are_not_cached(tmp_path):
+    cache = GenerationCache(tmp_path)
+    assert cache.key_for(dict(OPTIONS, seed=" ")) is None
+    assert cache.key_for(OPTIONS) == request_key(OPTIONS)
+
+
+def test_committed_images_come_back_as_copies(tmp_path):
+    cache = GenerationCache(tmp_path / "cache")
+    key = cache.key_for(OPTIONS)
+    assert cache.get(key) is None
+    image = tmp_path / "generated.webp"
+    image.write_bytes(b"image")
+    writer = cache.writer(key)
+    writer.add([str(image)])
+    writer.commit({"model": "stable_diffusion"})
+    cached = cache.get(key)
+    assert cached["model"] == "stable_diffusion"
+    with open(cached["files"][0], "rb") as stream:
+        assert stream.read() == b"image"
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def count_misses(directory, times):
+    cache = GenerationCache(directory)
+    for _ in range(times):
+        cache.get("0" * 64)
+
+
+def test_stats_of_several_processes_add_up(tmp_path):
+    workers = [
+        multiprocessing.Process(target=count_misses, args=(tmp_path, 50))
+        for _ in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert GenerationCache(tmp_path).stats()["misses"] == 200
+
+
+def test_the_least_recently_used_entries_are_evicted(tmp_path):
+    cache = GenerationCache(tmp_path / "cache", max_bytes=1500)
+    image = tmp_path / "generated.webp"
+    image.write_bytes(bytes(1000))
+    keys = []
+    for seed in ("1", "2"):
+        keys.append(cache.key_for(dict(OPTIONS, seed=seed)))
+        writer = cache.writer(keys[-1])
+        writer.add([str(image)])
+        writer.commit({})
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) is not None
@@ -0,0 +1,102 @@
+import random
+import struct
+import zlib
+
+import pytest
+
+from sdhorde.encoding import PNG_SIGNATURE, encode_png, image_size
+
+
+def decode_png(data: bytes):
+    """
+    Pixels, width, height and channels of a PNG written by encode_png,
+    undoing the filters as any PNG reader does
+    """
+    assert data.startswith(PNG_SIGNATURE)
+    width, height, _, color_type = struct.unpack(">IIBB", data[16:26])
+    channels = {0: 1, 4: 2, 2: 3, 6: 4}[color_type]
+    length = struct.unpack(">I", data[33:37])[0]
+    assert data[37:41] == b"IDAT"
+    raw = zlib.decompress(data[41 : 41 + length])
+    stride = width * channels
+    above = bytearray(stride)
+    pixels = bytearray()
+    for y in range(height):
+        start = y * (stride + 1)
+        kind, row = raw[start], bytearray(raw[start + 1 : start + 1 + stride])
+        for i in range(stride):
+            a = row[i - channels] if i >= channels else 0
+            b = above[i]
+            c = above[i - channels] if i >= channels else 0
+            if kind == 0:
+                predicted = 0
+            elif kind == 1:
+                predicted = a
+            elif kind == 2:
+                predicted = b
+            elif kind == 3:
+                predicted = (a + b) // 2
+            else:
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                predicted = a if pa <= pb and pa <= pc else b if pb <= pc else c
+            row[i] = (row[i] + predicted) & 0xFF
+        pixels += row
+        above = row
+    return bytes(pixels), width, height, channels
+
+
+def unfiltered_size(pixels: bytes, width: int, channels: int) -> int:
+    """
+    Bytes of the image data compressed with filter 0 on every row
+    """
+    stride = width * channels
+    raw = b"".join(
+        b"\x00" + pixels[offset : offset + stride]
+        for offset in range(0, len(pixels), stride)
+    )
+    return len(zlib.compress(raw, 6))
+
+
+def gradient(width: int, height: int, channels: int, noise: int = 0) -> bytes:
+    rnd = random.Random(width * height)
+    return bytes(
+        (x * 3 + y * 2 + k * 50 + rnd.randint(-noise, noise)) & 0xFF
+        for y in range(height)
+        for x in range(width)
+        for k in range(channels)
+    )
+
+
+@pytest.mark.parametrize("channels", [1, 2, 3, 4])
+def test_encoded_pixels_come_back_unchanged(channels):
+    for pixels, width, height in (
+        (gradient(33, 17, channels, noise=4), 33, 17),
+        (random.Random(1).randbytes(7 * 5 * channels), 7, 5),
+        (bytes(1 * 1 * channels), 1, 1),
+    ):
+        data = encode_png(pixels, width, height, channels)
+        assert decode_png(data) == (pixels, width, height, channels)
+        assert image_size(data) == (width, height)
+
+
+def test_smooth_images_are_smaller_than_unfiltered():
+    pixels = gradient(256, 128, 3, noise=3)
+    data = encode_png(pixels, 256, 128, 3)
+    assert len(data) < unfiltered_size(pixels, 256, 3) * 0.7
+    raw = zlib.decompress(data[41:-12])
+    kinds = {raw[y * (256 * 3 + 1)] for y in range(128)}
+    assert kinds - {0}
+
+
+def test_noise_is_not_bigger_than_unfiltered():
+    pixels = random.Random(2).randbytes(128 * 64 * 4)
+    data = encode_png(pixels, 128, 64, 4)
+    assert len(data) <= unfiltered_size(pixels, 128, 4) * 1.01 + 100
+
+
+def test_wrong_sizes_are_refused():
+    with pytest.raises(ValueError):
+        encode_png(bytes(10), 2, 2, 3)
+    with pytest.raises(ValueError):
+        encode_png(bytes(10), 1, 2, 5)
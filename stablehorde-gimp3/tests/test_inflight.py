@@ -0,0 +1,63 @@
+import json
+import threading
+import time
+
+from conftest import dead_pid
+from sdhorde.inflight import InFlightRegistry
+
+
+def test_the_first_request_leads_and_the_next_ones_wait(tmp_path):
+    registry = InFlightRegistry(tmp_path)
+    assert registry.lead("key", 60)
+    assert not registry.lead("key", 60)
+    marker = json.loads((tmp_path / "key.json").read_text())
+    assert set(marker) == {"pid", "deadline"}
+
+
+def test_waiting_requests_get_a_copy_of_the_images(tmp_path):
+    registry = InFlightRegistry(tmp_path)
+    assert registry.lead("key", 60)
+    image = tmp_path / "generated.webp"
+    image.write_bytes(b"image")
+
+    def publish():
+        time.sleep(0.2)
+        writer = registry.writer("key")
+        writer.add([str(image)])
+        writer.commit({"model": "a model"})
+        registry.release("key")
+
+    thread = threading.Thread(target=publish)
+    thread.start()
+    shared = registry.wait("key")
+    thread.join()
+    assert shared["model"] == "a model"
+    (copy,) = shared["files"]
+    with open(copy, "rb") as stream:
+        assert stream.read() == b"image"
+    # Published, the next identical request takes the images too
+    assert not registry.lead("key", 60)
+
+
+def test_requests_released_without_images_stop_the_wait(tmp_path):
+    registry = InFlightRegistry(tmp_path)
+    assert registry.lead("key", 60)
+    registry.writer("key").discard()
+    registry.release("key")
+    assert registry.wait("key") is None
+    assert registry.lead("key", 60)
+
+
+def test_requests_of_dead_processes_are_taken_over(tmp_path):
+    registry = InFlightRegistry(tmp_path)
+    (tmp_path / "key.json").write_text(
+        json.dumps({"pid": dead_pid(), "deadline": time.time() + 60})
+    )
+    assert registry.wait("key") is None
+    assert registry.lead("key", 60)
+
+
+def test_requests_past_their_deadline_are_taken_over(tmp_path):
+    registry = InFlightRegistry(tmp_path)
+    assert registry.lead("key", -1)
+    assert registry.lead("key", 60)
@@ -0,0 +1,80 @@
+import json
+import os
+
+from conftest import dead_pid
+from sdhorde.horde import HordeAPI, build_payload
+from sdhorde.journal import JobJournal, job_id_from
+
+OPTIONS = {
+    "prompt": "a cat",
+    "prompt_strength": 7,
+    "steps": 10,
+    "nimages": 2,
+    "image_width": 64,
+    "image_height": 64,
+    "nsfw": False,
+    "censor_nsfw": True,
+    "model": "stable_diffusion",
+    "api_key": "secret",
+}
+
+TARGET = {"image_id": 1, "layer": "status", "region": None, "feather": 0}
+
+
+def test_job_id_is_taken_from_the_status_url():
+    url = "https://aihorde.net/api/v2/generate/status/0a1b-2c3d"
+    assert job_id_from(["layer", url]) == "0a1b-2c3d"
+    assert job_id_from(["no url here"]) is None
+
+
+def test_resume_downloads_the_images_of_finished_requests(horde, tmp_path):
+    api = HordeAPI()
+    job_id = api.submit(build_payload(OPTIONS))
+    journal = JobJournal(tmp_path)
+    journal.add(job_id, OPTIONS, TARGET)
+    assert [entry["job_id"] for entry in journal.pending()] == [job_id]
+
+    journal.resume(api)
+
+    assert journal.pending() == []
+    (entry,) = journal.downloaded()
+    assert entry["target"] == TARGET
+    assert "api_key" not in entry["request"]
+    assert len(entry["files"]) == 2
+    for name in entry["files"]:
+        with open(name, "rb") as stream:
+            assert stream.read() == horde.image
+    assert not (tmp_path / f"{job_id}.claim").exists()
+
+
+def test_requests_claimed_by_a_live_process_are_left_to_it(tmp_path):
+    journal = JobJournal(tmp_path)
+    journal.add("alive", OPTIONS, TARGET)
+    (tmp_path / "alive.claim").write_text(str(os.getppid()))
+    assert not journal.claim("alive")
+    assert journal.resume_in_background(HordeAPI()) is None
+
+
+def test_claims_of_dead_processes_are_taken_over(tmp_path):
+    journal = JobJournal(tmp_path)
+    journal.add("dead", OPTIONS, TARGET)
+    (tmp_path / "dead.claim").write_text(str(dead_pid()))
+    assert journal.claim("dead")
+    assert (tmp_path / "dead.claim").read_text() == str(os.getpid())
+
+
+def test_expired_requests_are_purged_with_their_images(tmp_path):
+    journal = JobJournal(tmp_path)
+    journal.add("old", OPTIONS, TARGET, expires=-1)
+    image = tmp_path / "old-0.webp"
+    image.write_bytes(b"image")
+    path = tmp_path / "old.json"
+    entry = json.loads(path.read_text())
+    entry["files"] = [str(image)]
+    path.write_text(json.dumps(entry))
+    journal.add("new", OPTIONS, TARGET)
+
+    journal.purge()
+
+    assert [entry["job_id"] for entry in journal.entries()] == ["new"]
+    assert not image.exists()
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from conftest import API_ROOT
+from sdhorde.metrics import JobMetrics, MetricsSink, prometheus_text
+
+
+def open_in_executor(request) -> bytes:
+    """
+    Opens request the way aihordeclient does, from asyncio.to_thread
+    """
+
+    async def main():
+        return await asyncio.to_thread(lambda: urllib.request.urlopen(request).read())
+
+    return asyncio.run(main())
+
+
+def generate(metrics: JobMetrics) -> None:
+    payload = json.dumps({"prompt": "a cat", "params": {"n": 1}}).encode("utf-8")
+    job_id = json.loads(
+        open_in_executor(
+            urllib.request.Request(
+                API_ROOT + "generate/async",
+                data=payload,
+                headers={"Content-Type": "application/json"},
+            )
+        )
+    )["id"]
+    while not json.loads(open_in_executor(API_ROOT + "generate/check/" + job_id))[
+        "done"
+    ]:
+        time.sleep(0.05)
+    status = json.loads(open_in_executor(API_ROOT + "generate/status/" + job_id))
+    for generation in status["generations"]:
+        open_in_executor(generation["img"])
+
+
+def test_bound_metrics_see_requests_opened_from_executor_threads(horde, tmp_path):
+    sink = MetricsSink(tmp_path)
+    horde.session.listeners.append(sink.observe)
+    metrics = JobMetrics(0, "stable_diffusion")
+
+    def run_job():
+        with sink.bind(metrics):
+            generate(metrics)
+
+    job = threading.Thread(target=run_job)
+    job.start()
+    job.join()
+    assert set(metrics.phases) >= {"submit", "queue", "generate", "download"}
+    assert metrics.job_id
+    assert metrics.polls > 1
+    assert metrics.received > 0
+    assert metrics.workers == ["mock"]
+
+
+def test_requests_outside_bind_are_ignored(horde, tmp_path):
+    sink = MetricsSink(tmp_path)
+    horde.session.listeners.append(sink.observe)
+    metrics = JobMetrics(0, "stable_diffusion")
+    with sink.bind(metrics):
+        pass
+    open_in_executor(API_ROOT + "status/models")
+    assert metrics.phases == {}
+
+
+def test_aihordeclient_phases(horde):
+    pytest.importorskip("aihordeclient")
+    from run_benchmarks import Scenario, make_options, run_aihordeclient
+
+    scenario = Scenario(horde.settings)
+    timings = run_aihordeclient(make_options(scenario), scenario, horde, horde.session)
+    for phase in ("submit", "queue", "download"):
+        assert timings[phase] > 0
+
+
+def test_record_keeps_totals(tmp_path):
+    sink = MetricsSink(tmp_path)
+    metrics = JobMetrics(0, 'model "x"')
+    metrics.add_phase("submit", 0.5)
+    metrics.polls = 3
+    sink.record(metrics, "done")
+    sink.record(metrics, "failed")
+    totals = json.loads((tmp_path / "totals.json").read_text())
+    data = totals["models"]['model "x"']
+    assert data["jobs"] == {"done": 1, "failed": 1}
+    assert data["polls"] == 6
+    assert len((tmp_path / "jobs.jsonl").read_text().splitlines()) == 2
+    assert 'model="model \\"x\\""' in prometheus_text(totals)
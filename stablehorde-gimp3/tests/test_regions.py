@@ -0,0 +1,98 @@
+from sdhorde.regions import (
+    MIN_MARGIN,
+    SIZE_STEP,
+    Region,
+    expand_region,
+    outpaint_regions,
+    tile_regions,
+)
+
+LIMITS = (2048, 2048, 2048 * 2048)
+
+
+def covered(tiles, width, height):
+    """
+    True when every pixel of width x height is inside one of tiles
+    """
+    columns = sorted({(tile.x, tile.right) for tile in tiles})
+    rows = sorted({(tile.y, tile.bottom) for tile in tiles})
+    for spans, length in ((columns, width), (rows, height)):
+        end = 0
+        for start, stop in spans:
+            if start > end:
+                return False
+            end = max(end, stop)
+        if end < length:
+            return False
+    return True
+
+
+def test_sides_that_are_not_multiple_of_the_step_take_one_tile():
+    tiles = tile_regions(2100, 1000, *LIMITS, 64)
+    assert len(tiles) == 2
+    assert {(tile.width, tile.height) for tile in tiles} == {(1088, 1000)}
+    assert covered(tiles, 2100, 1000)
+
+
+def test_the_last_tile_ends_at_the_border():
+    for width, height in ((2100, 1000), (4100, 3000), (2049, 2049), (5000, 77)):
+        tiles = tile_regions(width, height, *LIMITS, 64)
+        assert covered(tiles, width, height)
+        assert max(tile.right for tile in tiles) == width
+        assert max(tile.bottom for tile in tiles) == height
+        assert min(tile.x for tile in tiles) == 0
+        assert min(tile.y for tile in tiles) == 0
+
+
+def test_split_tiles_are_multiple_of_the_step():
+    tiles = tile_regions(4100, 3000, *LIMITS, 64)
+    assert len(tiles) == 3 * 2
+    for tile in tiles:
+        assert tile.width % SIZE_STEP == 0
+        assert tile.height % SIZE_STEP == 0
+        assert tile.width * tile.height <= LIMITS[2]
+
+
+def test_tiles_overlap_at_least_the_overlap():
+    tiles = tile_regions(4100, 1000, *LIMITS, 128)
+    origins = sorted(tile.x for tile in tiles)
+    width = tiles[0].width
+    for previous, following in zip(origins, origins[1:]):
+        assert previous + width - following >= 128
+
+
+def test_too_many_tiles_give_none():
+    assert tile_regions(20000, 20000, *LIMITS, 64, max_tiles=4) == []
+
+
+def test_an_outpaint_strip_goes_in_one_request_when_it_fits():
+    pieces = outpaint_regions(2000, 1500, {"right": 256}, 64, *LIMITS)
+    assert [region for region, _ in pieces] == [Region(1936, 0, 320, 1500)]
+    assert pieces[0][1]["left"] == 32
+
+
+def test_long_outpaint_strips_are_split_without_gaps():
+    pieces = outpaint_regions(1000, 3000, {"left": 100}, 64, *LIMITS)
+    strips = [region for region, _ in pieces]
+    assert len(strips) == 2
+    assert {(region.x, region.width) for region in strips} == {(0, 192)}
+    assert covered(strips, 192, 3000)
+
+
+def test_outpaint_context_is_at_least_the_minimum():
+    pieces = outpaint_regions(1000, 1000, {"bottom": 64}, 0, *LIMITS)
+    region, sides = pieces[0]
+    assert region.height >= 64 + MIN_MARGIN
+    assert sides["top"] == MIN_MARGIN // 2
+
+
+def test_regions_near_the_whole_width_are_kept():
+    region = expand_region((10, 100, 1990, 400), 64, 2000, 1500, *LIMITS)
+    assert region == Region(0, 26, 2000, 448)
+
+
+def test_regions_are_snapped_inside_the_image():
+    region = expand_region((500, 500, 530, 530), 64, 2000, 1500, *LIMITS)
+    assert region.width % SIZE_STEP == 0 and region.height % SIZE_STEP == 0
+    assert region.x <= 436 and region.right >= 594
+    assert expand_region((0, 0, 3000, 10), 0, 3000, 100, *LIMITS) is None
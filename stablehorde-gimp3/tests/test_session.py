@@ -0,0 +1,177 @@
+import gzip
+import socket
+import socketserver
+import threading
+import time
+import urllib.request
+
+from urllib.error import URLError
+
+import pytest
+
+from sdhorde.session import KeepAliveHandler
+
+
+class ScriptedServer(socketserver.ThreadingTCPServer):
+    """
+    Answers each request with the next action of script: "ok", "drop" to
+    read it and close the connection without answering, or "ok-close" to
+    answer and then close
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, script, handler=None):
+        super().__init__(("127.0.0.1", 0), handler or ScriptedHandler)
+        self.script = list(script)
+        self.seen = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+
+class ScriptedHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            method = line.split()[0].decode("ascii")
+            length = 0
+            while True:
+                header = self.rfile.readline()
+                if header in (b"\r\n", b""):
+                    break
+                name, _, value = header.decode("latin-1").partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            self.rfile.read(length)
+            self.server.seen.append(method)
+            action = self.server.script.pop(0) if self.server.script else "ok"
+            if action == "drop":
+                return
+            self.wfile.write(
+                b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n"
+                b"Content-Type: application/json\r\n\r\n{}"
+            )
+            self.wfile.flush()
+            if action == "ok-close":
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+
+
+@pytest.fixture
+def scripted():
+    servers = []
+
+    def make(script, handler=None):
+        server = ScriptedServer(script, handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_post_is_not_sent_again_on_a_dropped_connection(scripted):
+    server = scripted(["ok", "drop"])
+    handler = KeepAliveHandler()
+    opener = urllib.request.build_opener(handler)
+    assert opener.open(server.url).read() == b"{}"
+    with pytest.raises(URLError):
+        opener.open(urllib.request.Request(server.url, data=b"{}", method="POST"))
+    assert server.seen == ["GET", "POST"]
+
+
+def test_get_is_sent_again_on_a_dropped_connection(scripted):
+    server = scripted(["ok", "drop"])
+    handler = KeepAliveHandler()
+    opener = urllib.request.build_opener(handler)
+    opener.open(server.url).read()
+    assert opener.open(server.url).read() == b"{}"
+    assert server.seen == ["GET", "GET", "GET"]
+
+
+def test_connections_closed_by_the_server_are_not_reused(scripted):
+    server = scripted(["ok-close", "ok"])
+    handler = KeepAliveHandler()
+    opener = urllib.request.build_opener(handler)
+    opener.open(server.url).read()
+    time.sleep(0.1)
+    assert (
+        opener.open(
+            urllib.request.Request(server.url, data=b"{}", method="POST")
+        ).read()
+        == b"{}"
+    )
+    assert server.seen == ["GET", "POST"]
+    assert handler.connections_opened == 2
+
+
+class GzipHandler(socketserver.StreamRequestHandler):
+    body = b'{"a": 1}' * 100
+
+    def handle(self):
+        while self.rfile.readline() not in (b"\r\n", b""):
+            pass
+        packed = gzip.compress(self.body)
+        self.wfile.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            b"Content-Encoding: gzip\r\nContent-Length: "
+            + str(len(packed)).encode("ascii")
+            + b"\r\n\r\n"
+            + packed
+        )
+
+
+def test_gzipped_answers_come_back_with_matching_headers(scripted):
+    server = scripted([], GzipHandler)
+    handler = KeepAliveHandler()
+    seen = []
+    handler.listeners.append(lambda *args: seen.append(args))
+    response = urllib.request.build_opener(handler).open(server.url)
+    body = GzipHandler.body
+    assert response.read() == body
+    assert response.headers.get("Content-Encoding") is None
+    assert response.headers["Content-Length"] == str(len(body))
+    # Bytes on the wire, the body decompressed
+    assert seen[0][4] < len(body)
+    assert seen[0][5] == body
+
+
+def test_images_are_streamed_and_their_connection_reused(horde):
+    handler = horde.session
+    seen = []
+    handler.listeners.append(lambda *args: seen.append(args))
+    url = horde.root + "/images/x.png"
+    response = urllib.request.urlopen(url)
+    first = response.read(10)
+    assert len(first) == 10
+    assert seen == []
+    rest = response.read()
+    assert first + rest == horde.image
+    assert seen[0][4] == len(horde.image)
+    assert seen[0][5] == b""
+    opened = handler.connections_opened
+    urllib.request.urlopen(url).read()
+    assert handler.connections_opened == opened
+
+
+def test_requests_through_a_proxy_use_the_stock_handler(monkeypatch):
+    used = []
+    monkeypatch.setattr(
+        urllib.request.HTTPSHandler,
+        "https_open",
+        lambda self, req: used.append(req.host),
+    )
+    handler = KeepAliveHandler()
+    request = urllib.request.Request("https://aihorde.net/api/v2/status/models")
+    request.set_proxy("proxy.local:3128", "https")
+    handler.https_open(request)
+    assert used == ["proxy.local:3128"]
+    assert handler.connections_opened == 0
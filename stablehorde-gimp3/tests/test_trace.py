@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+
+from conftest import API_ROOT
+from sdhorde.trace import Tracer
+from test_metrics import open_in_executor
+
+
+def test_requests_nest_under_the_span_of_their_job(horde):
+    tracer = Tracer()
+    tracer.start("run")
+    horde.session.listeners.append(tracer.observe)
+    idents = []
+
+    def run_job():
+        idents.append(threading.get_ident())
+        with tracer.span("generate_image", job=0):
+            open_in_executor(API_ROOT + "status/models")
+
+    job = threading.Thread(target=run_job)
+    job.start()
+    job.join()
+    events = {event["name"]: event for event in tracer.events()}
+    span, request = events["generate_image"], events["download"]
+    assert request["tid"] == span["tid"] == idents[0]
+    assert request["args"]["parent"] == span["args"]["id"]
+    assert span["ts"] <= request["ts"]
+    assert request["ts"] + request["dur"] <= span["ts"] + span["dur"]
+
+
+def test_disabled_tracer_records_nothing(tmp_path):
+    tracer = Tracer()
+    with tracer.span("ignored"):
+        tracer.observe("GET", API_ROOT + "generate/check/x", 0.1, 0, 2, b"{}")
+    assert tracer.events() == []
+
+
+def test_save_keeps_the_last_timelines(tmp_path, monkeypatch):
+    monkeypatch.setattr("sdhorde.trace.TRACES_KEPT", 2)
+    tracer = Tracer()
+    tracer.start("run")
+    for index in range(3):
+        old = tmp_path / f"gimp-stable-diffusion-old{index}.trace.json"
+        old.write_text("{}")
+        os.utime(old, (index, index))
+    path = tracer.save(tmp_path)
+    assert json.loads(path.read_text())["traceEvents"][0]["name"] == "run"
+    assert len(list(tmp_path.glob("*.trace.json"))) == 2
@@ -5,10 +5,10 @@ import urllib2  # Import the urllib2 library for making HTTP requests
 import tempfile  # Import the tempfile library for working with temporary files
 import array    #Import array library 
 import os  # Import the os library for file operations
+import shutil  # Import the shutil library to remove the temporary folders
 import base64  # Import the base64 library for encoding/decoding data in base64 format
 import json  # Import the json library for working with JSON data
 import ssl  # Import the ssl library for SSL certificate handling
-import sched  # Import the sched library for scheduling tasks
 import random # Import RNG
 import datetime
 import string
@@ -17,15 +17,13 @@ import math  # Import the math library for mathematical operations
 import gimp  # Import the gimp library
 import re  # Import the re library for regular expressions
 from gimpfu import *  # Import necessary functions and classes from the gimpfu module
+import stable_horde_common as common  # Import the helpers shared by the Stablehorde plugins
 
 # Define constants and configuration settings
 VERSION = 135
-INIT_FILE = "init.png"
-GENERATED_FILE = "gen_0_GIMP.png"
 API_ROOT = "https://stablehorde.net/api/v2/"
 
-CHECK_WAIT = 5
-checkMax = None
+maxWait = None
 hordeSelector = ""
 inprompt = ""
 
@@ -33,16 +31,7 @@ horde = ["3DKX", "526Mix-Animated", "Abyss OrangeMix", "AbyssOrangeMix-AfterDark
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
-# Define file paths for initialization and generated images
-initFile = r"{}".format(os.path.join(tempfile.gettempdir(), INIT_FILE))
-generatedFile = r"{}".format(os.path.join(tempfile.gettempdir(), GENERATED_FILE))
 
-# Create a scheduler instance
-s = sched.scheduler(time.time, time.sleep)
-
-# Initialize variables for checking update and tracking generation status
-checkCounter = 0
-id = None
 FileNotFoundError = ""
 
 def load_api_key():
@@ -73,7 +62,7 @@ def checkUpdate():
         try:
             # Check for updates by fetching version information from a URL
             url = "https://raw.githubusercontent.com/blueturtleai/gimp-stable-diffusion/main/stablehorde/version.json"
-            response = urllib2.urlopen(url)
+            response = common.urlopen(url)
             data = response.read()
             data = json.loads(data)
             gimp.set_data("update_checked", "1")
@@ -92,66 +81,42 @@ def displayGenerated(images):
     # Set foreground color to black
     pdb.gimp_context_set_foreground((0, 0, 0))
 
-    for image in images:
-        if re.match("^https.*", image["img"]):
-            response = urllib2.urlopen(image["img"])
-            bytes = response.read()
-        else:
-            bytes = base64.b64decode(image["img"])
-
-        imageFile = open(generatedFile, "wb+")
-        imageFile.write(bytes)
-        imageFile.close()
-
-        imageLoaded = pdb.file_webp_load(generatedFile, generatedFile)
-        pdb.gimp_display_new(imageLoaded)
-        # Add text to the generated image
-        pdb.gimp_text_fontname(imageLoaded, None, 2, 2, str("Seed: " + image["seed"]), -1, TRUE, 12, 1, "Sans")
-        pdb.gimp_image_set_active_layer(imageLoaded, imageLoaded.layers[1])
+    # All the images are downloaded at the same time, each one to its own file in a folder of
+    # this run, runs at the same time never share files
+    workspace = tempfile.mkdtemp(prefix=common.WORKSPACE_PREFIX + "t2i-")
+    try:
+        fileNames = common.downloadImages(images, workspace, showDownload)
+
+        for image, fileName in zip(images, fileNames):
+            imageLoaded = pdb.file_webp_load(fileName, fileName)
+            os.remove(fileName)
+            pdb.gimp_display_new(imageLoaded)
+            # Add text to the generated image
+            pdb.gimp_text_fontname(imageLoaded, None, 2, 2, str("Seed: " + image["seed"]), -1, TRUE, 12, 1, "Sans")
+            pdb.gimp_image_set_active_layer(imageLoaded, imageLoaded.layers[1])
+    finally:
+        shutil.rmtree(workspace, True)
 
     # Restore the original foreground color
     pdb.gimp_context_set_foreground(color)
     return
 
-# Function to get generation status from the API
-def getImages():
-    url = API_ROOT + "generate/status/" + id
-    response = urllib2.urlopen(url)
-    data = response.read()
-    data = json.loads(data)
-    return data["generations"]
-
-# Function to check the generation status
-def checkStatus():
-    url = API_ROOT + "generate/check/" + id
-    response = urllib2.urlopen(url)
-    data = response.read()
-    data = json.loads(data)
-
-    global checkCounter
-    checkCounter = checkCounter + 1
+# Function to show how the download of the images goes
+def showDownload(received, expected):
+    pdb.gimp_progress_set_text("Downloading images...")
+    if expected:
+        pdb.gimp_progress_update(min(1.0, float(received) / expected))
 
+# Function to show the generation status
+def showStatus(data):
     if data["processing"] == 0:
         text = "Queue position: " + str(data["queue_position"]) + ", Wait time: " + str(data["wait_time"]) + "s"
-    elif data["processing"] > 0:
+    else:
         text = "Generating..."
 
     # Set progress text
     pdb.gimp_progress_set_text(text)
 
-    if checkCounter < checkMax and data["done"] is False:
-        if data["is_possible"] is True:
-            # Schedule the next status check
-            s.enter(CHECK_WAIT, 1, checkStatus, ())
-            s.run()
-        else:
-            raise Exception("Currently no worker available to generate your image. Please try again later.")
-    elif checkCounter == checkMax:
-        minutes = (checkMax * CHECK_WAIT) / 60
-        raise Exception("Image generation timed out after " + str(minutes) + " minutes. Please try again later.")
-    elif data["done"] == True:
-        return
-
 # Main function for generating images
 def generate(image, drawable, selector, totalGens, promptStrength, steps, seed, nsfw, censor_nsfw, prompt, maxWaitMin):
      
@@ -174,8 +139,8 @@ def generate(image, drawable, selector, totalGens, promptStrength, steps, seed,
     # Initialize GIMP progress
     pdb.gimp_progress_init("", None)
 
-    global checkMax
-    checkMax = (maxWaitMin * 60) / CHECK_WAIT
+    global maxWait
+    maxWait = maxWaitMin * 60
 
     try:
         params = {
@@ -214,32 +179,10 @@ def generate(image, drawable, selector, totalGens, promptStrength, steps, seed,
         params.update({"width": int(width)})
         params.update({"height": int(height)})
 
-        data = json.dumps(data)
-        
-        
-        
-
-        # Usage example
-        #apikey = load_api_key() if not apikey else apikey
-
         headers = {"Content-Type": "application/json", "Accept": "application/json", "apikey": load_api_key()}
-        url = API_ROOT + "generate/async"
-
-        request = urllib2.Request(url=url, data=data, headers=headers)
-
-        response = urllib2.urlopen(request)
-        data = response.read()
-
-        try:
-            data = json.loads(data)
-            global id
-            id = data["id"]
-        except Exception as ex:
-            raise Exception(data)
 
-        # Check and display generation status
-        checkStatus()
-        images = getImages()
+        # Send the request split in several jobs and display the generated images
+        images = common.dispatchGeneration(API_ROOT, data, totalGens + 1, headers, maxWait, showStatus)
         displayGenerated(images)
 
     except urllib2.HTTPError as ex:
@@ -0,0 +1,504 @@
+# Shared helpers for the Stablehorde GIMP 2.10 plugins
+#
+# This file is not a plugin by itself, it is imported by
+# stable-horde-t2i.py, stable-horde-i2i.py and stable-horde-ip.py and must
+# be copied to the same plug-ins folder as them.
+
+# Import necessary libraries/modules
+import base64  # Import the base64 library to decode inline images
+import httplib  # Import the httplib library for persistent HTTP connections
+import json  # Import the json library for working with JSON data
+import math  # Import the math library to scale the image sizes
+import os  # Import the os library to name and measure the downloaded files
+import select  # Import the select library to find the idle connections closed by the server
+import socket  # Import the socket library for network errors
+import struct  # Import the struct library to write PNG chunks
+import threading  # Import the threading library to protect the connection pool
+import time  # Import the time library for working with time-related functions
+import urllib2  # Import the urllib2 library for making HTTP requests
+import zlib  # Import the zlib library to decompress gzip responses
+from StringIO import StringIO  # Import StringIO to hand back response bodies
+
+# Settings kept out of the arguments of the procedures, so that scripts calling them keep working
+SETTINGS_FILE = "settings.json"  # Read from the folder of api.key
+SETTINGS = {
+    "scaleResult": True,  # Scale the images generated from an image back to its size
+}
+
+# Idle connections kept open per host
+POOL_SIZE = 4
+IDEMPOTENT = ("GET", "HEAD", "DELETE")  # Methods sent again when a reused connection fails, a POST may have reached the server
+
+# Splitting of large image counts in several requests
+IMAGES_PER_JOB = 20  # Images asked in each request, the most the Horde accepts in one
+MAX_JOBS_IN_FLIGHT = 3  # Requests waiting on the server at the same time
+
+# Polling limits in seconds
+MIN_CHECK_WAIT = 1  # Tightest poll, used when the image is being generated
+MAX_CHECK_WAIT = 30  # Longest poll, used when deep in the queue
+ERROR_CHECK_WAIT = 2  # First wait after a failed check, doubled on each failure
+MAX_CHECK_ERRORS = 5  # Consecutive failed checks before giving up
+
+# Downloads of the generated images
+WORKSPACE_PREFIX = "stablehorde2-"  # Folders of the runs, the GIMP 3 plugin removes the stablehorde-* ones of processes that are gone
+MAX_DOWNLOADS = 4  # Images downloaded at the same time
+CHUNK_SIZE = 64 * 1024  # Bytes read and written at a time, images are not held whole in memory
+MAX_DOWNLOAD_ATTEMPTS = 4  # Tries of each image, a retry asks only for the bytes missing
+DOWNLOAD_TIMEOUT = 60  # Seconds without data before a download is retried
+
+
+# Function to tell if the server closed an idle connection, it has something to read while nothing was asked
+def isStale(connection):
+    if connection.sock is None:
+        return True
+    try:
+        readable = select.select([connection.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+# Handler that reuses HTTP and HTTPS connections between requests
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """
+    Keeps up to poolSize idle connections per host, so that status checks,
+    submissions and image downloads do not pay a new TCP and TLS handshake
+    each time. Responses are requested gzipped and are handed back already
+    decompressed. Errors are reported the same way as urllib2 does.
+    """
+
+    def __init__(self, poolSize=POOL_SIZE):
+        urllib2.HTTPHandler.__init__(self)
+        urllib2.HTTPSHandler.__init__(self)
+        self.poolSize = poolSize
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def http_open(self, req):
+        return self.doPooledOpen(httplib.HTTPConnection, "http", req)
+
+    def https_open(self, req):
+        return self.doPooledOpen(httplib.HTTPSConnection, "https", req)
+
+    def getConnection(self, connectionClass, key, timeout):
+        # Reuse an idle connection when there is one the server did not close
+        while True:
+            with self.lock:
+                connections = self.idle.get(key, [])
+                if not connections:
+                    break
+                connection = connections.pop()
+            if not isStale(connection):
+                return connection, True
+            connection.close()
+        return connectionClass(key[1], timeout=timeout), False
+
+    def releaseConnection(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.poolSize:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def closeAll(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+    def doPooledOpen(self, connectionClass, scheme, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+        key = (scheme, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers["Connection"] = "keep-alive"
+        askedGzip = "Accept-encoding" not in headers
+        if askedGzip:
+            headers["Accept-encoding"] = "gzip"
+
+        timeout = getattr(req, "timeout", socket._GLOBAL_DEFAULT_TIMEOUT)
+        connection, reused = self.getConnection(connectionClass, key, timeout)
+        try:
+            connection.request(req.get_method(), req.get_selector(), req.get_data(), headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException) as ex:
+            connection.close()
+            if not reused or req.get_method() not in IDEMPOTENT:
+                raise urllib2.URLError(ex)
+            # The server closed the idle connection, try once with a new one
+            connection = connectionClass(host, timeout=timeout)
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.get_data(), headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException) as ex:
+                connection.close()
+                raise urllib2.URLError(ex)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.releaseConnection(key, connection)
+
+        if askedGzip and response.getheader("content-encoding", "") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        result = urllib2.addinfourl(StringIO(body), response.msg, req.get_full_url(), response.status)
+        result.msg = response.reason
+        return result
+
+
+# Opener shared by all the requests of the plugin
+opener = urllib2.build_opener(KeepAliveHandler())
+
+
+# Function to read a setting from SETTINGS_FILE, the default of SETTINGS when the file does not have it
+def loadSetting(name):
+    try:
+        with open(os.path.join(os.getcwd(), SETTINGS_FILE)) as stream:
+            return json.load(stream).get(name, SETTINGS[name])
+    except (IOError, ValueError, AttributeError):
+        return SETTINGS[name]
+
+
+# Function to open a url or urllib2.Request through the shared connection pool
+def urlopen(url):
+    return opener.open(url)
+
+
+# Opener for the image downloads, the pool reads whole bodies and these are streamed
+streamOpener = urllib2.build_opener()
+
+
+# Function to calculate how long to wait before the next status check
+def nextCheckDelay(data, errors=0):
+    # Back off exponentially when the server could not be reached
+    if errors > 0:
+        return min(MAX_CHECK_WAIT, ERROR_CHECK_WAIT * (2 ** (errors - 1)))
+
+    # A worker is already generating, finish is close
+    if data.get("processing", 0) > 0 or data.get("finished", 0) > 0:
+        return MIN_CHECK_WAIT
+
+    # Still queued, check again when about half of the expected wait has passed
+    waitTime = data.get("wait_time", 0) or 0
+    return max(MIN_CHECK_WAIT, min(MAX_CHECK_WAIT, waitTime / 2.0))
+
+
+# Class to keep track of one request sent to the server
+class HordeJob(object):
+    def __init__(self, requestId, count, maxWaitSeconds, started=None):
+        self.id = requestId
+        self.count = count  # Number of images requested
+        self.maxWait = maxWaitSeconds
+        self.deadline = (started or time.time()) + maxWaitSeconds
+        self.nextCheck = 0
+        self.errors = 0
+        self.data = {}
+
+
+# Function to check once the status of a job
+def checkJob(apiRoot, job, onStatus=None):
+    """
+    Checks generate/check/<job.id> once and schedules the next check with
+    the wait time reported by the server.  Returns True when the job is
+    done.
+    """
+    try:
+        response = urlopen(apiRoot + "generate/check/" + job.id)
+        job.data = json.loads(response.read())
+        job.errors = 0
+    except urllib2.HTTPError as ex:
+        # Client errors other than rate limiting will not fix themselves
+        if ex.code < 500 and ex.code != 429:
+            raise
+        job.errors = job.errors + 1
+    except urllib2.URLError:
+        job.errors = job.errors + 1
+
+    if job.errors >= MAX_CHECK_ERRORS:
+        raise Exception("Lost connection with the server while waiting for your image. Please try again later.")
+
+    if job.errors == 0:
+        if onStatus is not None:
+            onStatus(job.data)
+
+        if job.data.get("done") is True:
+            return True
+        if job.data.get("faulted") is True:
+            raise Exception("The generation of your image failed on the server. Please try again later.")
+        if job.data.get("is_possible") is False:
+            raise Exception("Currently no worker available to generate your image. Please try again later.")
+
+    now = time.time()
+    if now >= job.deadline:
+        minutes = job.maxWait / 60
+        raise Exception("Image generation timed out after " + str(minutes) + " minutes. Please try again later.")
+
+    # Never schedule past the deadline, a last check is made right on it
+    job.nextCheck = min(now + nextCheckDelay(job.data, job.errors), job.deadline)
+    return False
+
+
+# Function to send a generation request, returns the id given by the server
+def submitGeneration(apiRoot, payload, headers):
+    request = urllib2.Request(url=apiRoot + "generate/async", data=json.dumps(payload), headers=headers)
+    data = urlopen(request).read()
+
+    try:
+        return json.loads(data)["id"]
+    except Exception:
+        raise Exception(data)
+
+
+# Function to get the generated images of a finished request
+def getGenerations(apiRoot, requestId):
+    response = urlopen(apiRoot + "generate/status/" + requestId)
+    return json.loads(response.read())["generations"]
+
+
+# Function to cancel a request on the server, its images are no longer awaited
+def cancelGeneration(apiRoot, requestId):
+    request = urllib2.Request(url=apiRoot + "generate/status/" + requestId)
+    request.get_method = lambda: "DELETE"
+    try:
+        urlopen(request).read()
+    except Exception:
+        # The server drops it anyway once it expires
+        pass
+
+
+# Function to split a number of images in requests of at most perJob images
+def splitCount(total, perJob=IMAGES_PER_JOB):
+    jobs = max(1, (total + perJob - 1) // perJob)
+    base, extra = divmod(total, jobs)
+    return [base + 1 if i < extra else base for i in range(jobs)]
+
+
+# Function to generate total images splitting them in concurrent requests
+def dispatchGeneration(apiRoot, payload, total, headers, maxWaitSeconds, onStatus=None, perJob=IMAGES_PER_JOB, maxJobs=MAX_JOBS_IN_FLIGHT):
+    """
+    Sends payload asking for total images, split in requests of at most
+    perJob images with at most maxJobs of them waiting on the server at the
+    same time.  Each request is tracked by its own id and checked when its
+    own wait time says so.  Returns the generations of all the requests,
+    in the order they finished.  When a request fails the ones still on
+    the server are cancelled and the generations already finished are
+    returned, the error is raised only when none finished.
+    """
+    started = time.time()
+    seed = str(payload["params"].get("seed", "")).strip()
+    pending = []
+    offset = 0
+    for count in splitCount(total, perJob):
+        pending.append((count, offset))
+        offset = offset + count
+
+    active = []
+    generations = []
+    error = None
+    while (pending or active) and error is None:
+        try:
+            # Keep the server busy with up to maxJobs requests
+            while pending and len(active) < maxJobs:
+                count, offset = pending.pop(0)
+                jobPayload = dict(payload)
+                jobPayload["params"] = dict(payload["params"], n=count)
+                # A given seed continues where the previous request would have
+                if offset and seed.isdigit():
+                    jobPayload["params"]["seed"] = str(int(seed) + offset)
+                requestId = submitGeneration(apiRoot, jobPayload, headers)
+                active.append(HordeJob(requestId, count, maxWaitSeconds, started))
+
+            # Check the job that asked to be checked first
+            job = min(active, key=lambda item: item.nextCheck)
+            time.sleep(max(0, job.nextCheck - time.time()))
+            if checkJob(apiRoot, job, onStatus):
+                active.remove(job)
+                generations.extend(getGenerations(apiRoot, job.id))
+        except Exception as ex:
+            error = ex
+
+    if error is not None:
+        # Nobody will wait for the rest, the kudos are not spent on them
+        for job in active:
+            cancelGeneration(apiRoot, job.id)
+        if not generations:
+            raise error
+
+    return generations
+
+
+# Class to add up the bytes received by the downloads running at the same time
+class DownloadProgress(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.sizes = {}  # Size of each file, once the server tells it
+
+    def add(self, amount):
+        with self.lock:
+            self.received = self.received + amount
+
+    def setSize(self, fileName, size):
+        with self.lock:
+            self.sizes[fileName] = size
+
+    def expected(self):
+        with self.lock:
+            return sum(self.sizes.values())
+
+
+# Function to tell if fileName holds a whole PNG, WebP or JPEG image, for the downloads whose size the server did not tell
+def isCompleteImage(fileName):
+    size = os.path.getsize(fileName)
+    with open(fileName, "rb") as stream:
+        header = stream.read(12)
+        stream.seek(max(0, size - 12))
+        trailer = stream.read()
+    if header.startswith("\x89PNG\r\n\x1a\n"):
+        return trailer.endswith("IEND\xaeB`\x82")
+    if header[:4] == "RIFF" and header[8:12] == "WEBP":
+        # The RIFF header tells the size of the rest of the file
+        return size >= 8 + struct.unpack("<I", header[4:8])[0]
+    if header[:2] == "\xff\xd8":
+        return trailer.endswith("\xff\xd9")
+    return False
+
+
+# Function to stream url to fileName, a dropped transfer is retried from where it stopped
+def downloadFile(url, fileName, progress):
+    wait = ERROR_CHECK_WAIT
+    for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+        offset = os.path.getsize(fileName) if os.path.exists(fileName) else 0
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header("Range", "bytes=" + str(offset) + "-")
+        try:
+            response = streamOpener.open(request, timeout=DOWNLOAD_TIMEOUT)
+            try:
+                # The server ignored the Range, the whole image comes again
+                if offset and response.getcode() != 206:
+                    progress.add(-offset)
+                    offset = 0
+                length = response.info().getheader("Content-Length")
+                if length is not None:
+                    progress.setSize(fileName, offset + int(length))
+                received = 0
+                with open(fileName, "ab" if offset else "wb") as stream:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        stream.write(chunk)
+                        received = received + len(chunk)
+                        progress.add(len(chunk))
+            finally:
+                response.close()
+            if length is not None:
+                if received >= int(length):
+                    return
+            elif isCompleteImage(fileName):
+                return
+        except urllib2.HTTPError as ex:
+            # Only the errors of a busy server are worth another try
+            if (ex.code < 500 and ex.code not in (408, 429)) or attempt == MAX_DOWNLOAD_ATTEMPTS:
+                raise
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
+            if attempt == MAX_DOWNLOAD_ATTEMPTS:
+                raise
+        time.sleep(wait)
+        wait = wait * 2
+    raise Exception("Lost connection with the server while downloading your image. Please try again later.")
+
+
+# Function to save the generated images to files in directory, returns the file names in the same order
+def downloadImages(images, directory, onProgress=None, maxDownloads=MAX_DOWNLOADS):
+    """
+    The images given as urls are downloaded with up to maxDownloads of them
+    at the same time, each one streamed to its own file.  onProgress is
+    called with the bytes received and the bytes expected from the calling
+    thread, Gimp is only used from there.  When a download fails, the
+    files are removed and its error is raised.
+    """
+    prefix = "stablehorde-" + str(os.getpid()) + "-" + str(int(time.time() * 1000))
+    fileNames = [os.path.join(directory, prefix + "-" + str(index) + ".webp") for index in range(len(images))]
+    progress = DownloadProgress()
+    pending = []
+    for image, fileName in zip(images, fileNames):
+        if image["img"].startswith("https"):
+            pending.append((image["img"], fileName))
+        else:
+            with open(fileName, "wb") as stream:
+                stream.write(base64.b64decode(image["img"]))
+
+    errors = []
+
+    def work():
+        while True:
+            with progress.lock:
+                if not pending or errors:
+                    return
+                url, fileName = pending.pop(0)
+            try:
+                downloadFile(url, fileName, progress)
+            except Exception as ex:
+                with progress.lock:
+                    errors.append(ex)
+
+    workers = [threading.Thread(target=work) for _ in range(min(maxDownloads, len(pending)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    while any(worker.is_alive() for worker in workers):
+        if onProgress is not None:
+            onProgress(progress.received, progress.expected())
+        workers[0].join(0.2)
+        workers = [worker for worker in workers if worker.is_alive()]
+
+    if errors:
+        for fileName in fileNames:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+        raise errors[0]
+    return fileNames
+
+
+# PNG color type for each number of 8 bit channels: gray, gray with alpha, RGB and RGBA
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+# Function to write a PNG chunk
+def pngChunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+# Function to encode 8 bit pixels as a PNG in memory, rows top to bottom without padding
+def encodePng(pixels, width, height, channels, level=6):
+    stride = width * channels
+    header = struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0)
+    # Each row starts with its filter type, 0 means no filter
+    raw = "".join("\x00" + pixels[offset:offset + stride] for offset in range(0, stride * height, stride))
+    return "\x89PNG\r\n\x1a\n" + pngChunk("IHDR", header) + pngChunk("IDAT", zlib.compress(raw, level)) + pngChunk("IEND", "")
+
+
+# Most pixels the Horde generates in an image, 2048x2048
+MAX_PIXELS = 2048 * 2048
+SIZE_STEP = 64  # The sides of the generated images are multiples of it
+
+
+# Function to choose the size generated for a width x height image: the same proportions, sides
+# multiple of SIZE_STEP and at most maxPixels.  It is never bigger than the image, the image sent
+# is only downscaled.
+def generationSize(width, height, maxPixels=MAX_PIXELS):
+    scale = min(1.0, math.sqrt(float(maxPixels) / (width * height)))
+    return (
+        max(SIZE_STEP, int(width * scale) // SIZE_STEP * SIZE_STEP),
+        max(SIZE_STEP, int(height * scale) // SIZE_STEP * SIZE_STEP),
+    )